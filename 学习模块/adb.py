@@ -1,12 +1,217 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os,threading,traceback
+from __future__ import print_function
+
+import os,threading
+import array
+import contextlib
+import errno
+import functools
+import hashlib
+import io
+import json
+import math
 import random
 import re
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
 import time
+import uuid
+import zipfile
+from collections import deque, namedtuple
+from xml.etree import ElementTree
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _to_str(output):
+    """Decode command output to str on Python 3, on Python 2 it already is one."""
+    if output is None or isinstance(output, str):
+        return output
+    return output.decode('utf-8', 'replace')
+
+
+def _command_category(args):
+    """Classify adb arguments, without the -s serial, as shell, getprop, input, dumpsys, install, pull..."""
+    if not args:
+        return 'adb'
+    if args[0] not in ('shell', 'exec-out'):
+        return 'install' if args[0].startswith('install') else args[0]
+    words = " ".join(args[1:]).split()
+    if not words:
+        return 'shell'
+    if words[0] == 'pm' and len(words) > 1 and words[1].startswith('install'):
+        return 'install'
+    return words[0] if words[0] in ('getprop', 'input', 'dumpsys', 'screencap') else 'shell'
+
+
+_deadlines = threading.local()
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Make the adb commands of the block, in this thread, end within seconds from now.
+
+    Nested deadlines can only make it earlier. A command still running at
+    the deadline is killed and raises ADBTimeoutException, one starting
+    after it raises at once.
+    """
+    stack = getattr(_deadlines, 'stack', None)
+    if stack is None:
+        stack = _deadlines.stack = []
+    end = time.time() + seconds
+    stack.append(min(end, stack[-1]) if stack else end)
+    try:
+        yield stack[-1]
+    finally:
+        stack.pop()
+
+
+def _command_timeout(category):
+    """Return (seconds a command of category may take or None, end of the caller's deadline or None)."""
+    stack = getattr(_deadlines, 'stack', None)
+    return ADB.command_timeouts.get(category, ADB.default_timeout), stack[-1] if stack else None
+
+
+def _run_command(serial, args, run):
+    """Return run(timeout), with ADB's timeouts, retries and circuit breakers applied.
+
+    Timeouts, connection errors, adb client errors like an offline device and
+    dead sessions count as failures of the device; a command that exited,
+    even with an error, proves it answers. Only failures are retried,
+    command_retries times at most. Running out of the caller's deadline() is
+    not a failure of the device, it raises at once.
+    """
+    if not (ADB.command_timeouts or ADB.default_timeout is not None or ADB.command_retries
+            or ADB.circuit_breaker_threshold or getattr(_deadlines, 'stack', None)):
+        if ADB.command_hook is None:
+            return run(None)
+        return _attempt(serial, args, run, None)
+    category = _command_category(args)
+    limit, end = _command_timeout(category)
+    breaker = ADB.get_circuit_breaker(serial)
+    attempts = 1 + ADB.command_retries.get(category, 0)
+    for attempt in range(attempts):
+        if breaker is not None:
+            breaker.check()
+        timeout, by_deadline = limit, False
+        if end is not None:
+            remaining = end - time.time()
+            if remaining <= 0:
+                raise ADBTimeoutException("Deadline passed before the %s command." % category)
+            if timeout is None or remaining <= timeout:
+                timeout, by_deadline = remaining, True
+        try:
+            output = _attempt(serial, args, run, timeout)
+        except (ADBTimeoutException, ADBTransportException, ADBSocketException, ADBShellSessionException,
+                socket.error) as e:
+            if by_deadline and isinstance(e, ADBTimeoutException):
+                raise
+            if breaker is not None:
+                breaker.failure()
+            if attempt + 1 == attempts:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+            continue
+        except Exception:
+            if breaker is not None:
+                breaker.success()
+            raise
+        if breaker is not None:
+            breaker.success()
+        return output
+
+
+def _attempt(serial, args, run, timeout):
+    """Return run(timeout), reporting a CommandRecord to ADB.command_hook if one is set."""
+    hook = ADB.command_hook
+    if hook is None and timeout is None:
+        return run(None)
+    start = time.time()
+    output, status = None, 0
+    try:
+        output = run(timeout)
+        return output
+    except subprocess.CalledProcessError as e:
+        output, status = e.output, e.returncode
+        # Exit code of toybox timeout, and of GNU timeout -s 9.
+        if timeout is not None and args[0] == 'shell' and e.returncode in (124, 137):
+            raise ADBTimeoutException("%s on %s was killed after %.1f seconds." % (" ".join(args), serial, timeout))
+        raise
+    except socket.timeout:
+        status = None
+        raise ADBTimeoutException("%s on %s got no answer for %.1f seconds." % (" ".join(args), serial, timeout))
+    except Exception:
+        status = None
+        raise
+    finally:
+        if hook is not None:
+            size = output if isinstance(output, int) else len(output or b"")
+            hook(CommandRecord(_command_category(args), serial, " ".join(args), time.time() - start, size, status))
+
+
+class PopupRule(namedtuple('PopupRule', 'name when click')):
+    """Tap the node matching click when a node matching when is on screen.
+
+    when and click map node attributes to values, keyed like uiautomator
+    dumps (text, resource-id, class, content-desc, package) or like
+    uiautomator selectors (resourceId, className, description). click
+    defaults to when.
+    """
+
+    aliases = {'resourceId': 'resource-id', 'className': 'class', 'description': 'content-desc'}
+
+    def __new__(cls, name, when, click=None):
+        return super(PopupRule, cls).__new__(cls, name, cls._normalize(when), cls._normalize(click or when))
+
+    @classmethod
+    def _normalize(cls, selector):
+        return dict((cls.aliases.get(k, k), v) for k, v in selector.items())
+
+    @staticmethod
+    def _matches(node, selector):
+        return all(node.get(k) == v for k, v in selector.items())
+
+    def find(self, nodes):
+        """Return the node to tap among nodes, None if the rule doesn't apply."""
+        if not any(self._matches(x, self.when) for x in nodes):
+            return None
+        for node in nodes:
+            if self._matches(node, self.click):
+                return node
+        return None
+
+
+def _batchable(method):
+    """Inside ADB.batch(), queue the shell commands of method instead of waiting for them.
+
+    For methods that only send commands: they return a ShellFuture where
+    they returned the output of _adb_shell.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        batch = self._active_batch()
+        if batch is None or batch.queuing:
+            return method(self, *args, **kwargs)
+        batch.queuing = True
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            batch.queuing = False
+    return wrapper
 
 
 class ADB(object):
@@ -17,14 +222,101 @@ class ADB(object):
     re_apk_sdk_version = re.compile(r"^sdkVersion:\s*'(\d*)'.*$", 8)
     re_apk_launchable_activity = re.compile(r"^launchable\-activity:\s*name='([a-zA-Z0-9\.]*)'.*$", 8)
     re_apk_apk_label = re.compile(r"^launchable\-activity:.*?label='(.*?)'.*$", 8)
+    re_apk_permission = re.compile(r"^uses\-permission:\s*(?:name=)?'([^']*)'", 8)
+    re_apk_native_code = re.compile(r"^native\-code:(.*)$", 8)
     re_uid = re.compile(r'userId=(\d+).*')
     re_focused_app_window_token = re.compile(r'[a-zA-Z0-9\.]+/([a-zA-Z0-9\.]+)')
     re_device_properties = re.compile(r"^\[(.+)\]:.?\[(.*)\]$")
-
-    def __init__(self, device=None):
-        self.devices = self.list_devices()
-        if self.devices and self.devices[0].startswith("* daemon started"):
-            self.devices = self.list_devices()
+    # stderr of the adb client when it could not reach the device at all.
+    re_adb_client_error = re.compile(
+        r"^(adb: )?error: (device |no devices|closed|protocol fault|cannot connect|failed to connect|more than one)",
+        re.M)
+
+    # Old adbd accepts at most 4096 bytes for the whole "shell:<command>" request.
+    max_shell_command_length = 4000
+    keycodes_of_char = dict(
+        [(str(i), 7 + i) for i in range(10)] +
+        [(chr(ord('a') + i), 29 + i) for i in range(26)] +
+        [(' ', 62), (',', 55), ('.', 56), ('*', 17), ('#', 18), ('=', 70), ('\t', 61), ('\n', 66)])
+    # ApkInfoCache shared by get_apk_*, created on first use.
+    apk_info_cache = None
+    # How get_apk_* read an APK: "aapt", "python" (ApkManifestReader) or "auto",
+    # which reads in-process and falls back to aapt if that fails. The results differ
+    # on some APKs: for versionName='1.2-beta' aapt gives None, as re_apk_version_name
+    # only takes digits and dots, while ApkManifestReader gives '1.2-beta'.
+    apk_reader = "auto"
+    # Properties which change while the device runs, they are never served from the snapshot.
+    volatile_properties = frozenset(["dhcp.wlan0.ipaddress"])
+    # Seconds a ProcessTable snapshot is reused by get_pid and get_process_table.
+    process_table_ttl = 0.5
+    # Seconds a UITable is reused by find and tap_text, unless input was sent since.
+    ui_table_ttl = 2.0
+    # First words of shell commands after which the screen is taken to have changed.
+    screen_changing_commands = frozenset(['input', 'am', 'monkey', 'svc'])
+    # First words of shell commands which may start or stop processes, they drop the ProcessTable.
+    process_changing_commands = frozenset(['am', 'pm', 'kill', 'killall', 'monkey'])
+    # Called with a CommandRecord after every adb command, e.g. a CommandStats.
+    command_hook = None
+    # Seconds an adb command may take, per category of CommandRecord; None waits forever.
+    command_timeouts = {}
+    default_timeout = None
+    # Extra seconds the host waits for a shell command killed by the device's `timeout`.
+    device_timeout_grace = 1.0
+    # Extra attempts after a failure, per category; only for commands safe to repeat.
+    command_retries = {}
+    # Failures in a row that open a device's CircuitBreaker, None to never refuse commands.
+    circuit_breaker_threshold = None
+    circuit_breaker_reset = 30.0
+    _circuit_breakers = {}
+    _circuit_breakers_lock = threading.Lock()
+    # adb devices results shared by all instances, see DeviceRegistry.
+    device_registry = None
+    _instances = {}
+    _instances_lock = threading.Lock()
+    # What install_watch taps through, see PopupRule.
+    popup_rules = (
+        PopupRule('allowroot', {'text': u'允许'}),
+        PopupRule('allowro', {'text': u'删除'}),
+        PopupRule('allow', {'text': u'同意'}),
+        PopupRule('start_flag', {'text': u'跳过'}, {'text': u'跳过', 'className': 'android.widget.TextView'}),
+    )
+    # Seconds a PackageIndex is trusted; this library's own (un)installs drop it at once.
+    package_index_ttl = 300
+    # Where install_package stages APKs before pm installs them.
+    install_staging_dir = "/data/local/tmp"
+    # pm failures after which install_package(reinstall=True) uninstalls the app and tries again.
+    reinstall_install_failures = frozenset(['INSTALL_FAILED_VERSION_DOWNGRADE', 'INSTALL_FAILED_UPDATE_INCOMPATIBLE'])
+    _package_indexes = {}
+    _package_indexes_lock = threading.Lock()
+
+    def __init__(self, device=None, backend="subprocess", property_cache_ttl=60):
+        """Bind to a device.
+
+        backend may be "subprocess" (one adb process per command), "session"
+        (shell commands go through one long-lived adb shell, see ADBShellSession)
+        or "socket" (talk to the adb server directly, see ADBSocketClient).
+
+        Property getters share one `getprop` snapshot for property_cache_ttl
+        seconds, 0 makes every getter run its own `getprop <key>`.
+        """
+        if backend not in ("subprocess", "session", "socket"):
+            raise ADBException("Unknown backend %s." % backend)
+        self.backend = backend
+        self._session = None
+        self._properties = DevicePropertyCache(property_cache_ttl, self.volatile_properties)
+        self._process_table = None
+        self._ps_columns = None
+        # The ADBBatch open in each thread, instances are shared between threads by for_device.
+        self._batches = threading.local()
+        self._android_version = None
+        self._ui_table = None
+        self._recorder = None
+        self._gesture_remotes = {}
+
+        self.devices = self.device_registry.devices(backend)
+        if device is not None and device not in self.devices:
+            # Maybe plugged in since the registry last listed the devices.
+            self.devices = self.device_registry.devices(backend, max_age=0)
 
         if not self.devices:
             raise ADBNoDeviceFoundException("No device attached.")
@@ -36,34 +328,228 @@ class ADB(object):
         else:
             raise ADBNoDeviceFoundException("Device %s not found." % device)
 
-        self.android_version = self._get_android_version()
+    @property
+    def android_version(self):
+        """Release of the device, like "9", read on first use."""
+        if self._android_version is None:
+            self._android_version = self._get_android_version()
+        return self._android_version
+
+    @android_version.setter
+    def android_version(self, value):
+        self._android_version = value
+
+    @classmethod
+    def for_device(cls, device=None, backend="subprocess", property_cache_ttl=60, refresh=False):
+        """Return the ADB of device shared by all callers, creating it on first use.
+
+        Costs a dict lookup once created: the devices are listed again only
+        with refresh, or after a command found the device gone.
+        """
+        key = (cls, device, backend, property_cache_ttl)
+        with cls._instances_lock:
+            instance = cls._instances.get(key)
+        if instance is not None and not refresh:
+            return instance
+        if refresh:
+            cls.device_registry.invalidate()
+        instance = cls(device, backend, property_cache_ttl)
+        with cls._instances_lock:
+            previous = cls._instances.get(key)
+            if previous is not None and previous is not instance:
+                previous.close()
+            cls._instances[key] = instance
+        return instance
+
+    @classmethod
+    def forget_device(cls, serial):
+        """Make for_device and the device registry list the devices again, after serial went away."""
+        cls.device_registry.invalidate()
+        with cls._instances_lock:
+            for key, instance in list(cls._instances.items()):
+                if instance.device == serial:
+                    del cls._instances[key]
+
+    @classmethod
+    def clear_instances(cls):
+        """Close and forget the ADBs handed out by for_device."""
+        with cls._instances_lock:
+            instances, cls._instances = list(cls._instances.values()), {}
+        for instance in instances:
+            instance.close()
 
     @staticmethod
-    def _exec(cmd):
-        version = float("%s.%s" % sys.version_info[0:2])
-        print cmd
-        if version >= 2.7:
-            #print cmd
-            return subprocess.check_output(cmd)
-        else:
-            return subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+    def _exec(cmd, raw=False):
+        """Run cmd and return its output, as bytes if raw else as str."""
+        serial = cmd[2] if cmd[1:2] == ['-s'] else None
+        output = _run_command(serial, cmd[3:] if serial else cmd[1:], lambda timeout: ADB._check_output(cmd, timeout))
+        return output if raw else _to_str(output)
+
+    @staticmethod
+    def _check_output(cmd, timeout=None):
+        """Like subprocess.check_output, killing cmd and raising ADBTimeoutException after timeout seconds.
+
+        stderr is passed on once cmd exited. Errors of the adb client itself,
+        like a missing, offline or unauthorized device, raise ADBTransportException
+        instead of CalledProcessError.
+        """
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        expired = []
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, lambda: (expired.append(True), proc.kill()))
+            timer.start()
+        try:
+            output, errors = proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        errors = _to_str(errors)
+        if errors:
+            sys.stderr.write(errors)
+        if expired:
+            raise ADBTimeoutException("%s did not finish within %.1f seconds." % (" ".join(cmd), timeout))
+        if proc.returncode:
+            if cmd[0] == 'adb' and ADB.re_adb_client_error.search(errors):
+                if cmd[1:2] == ['-s']:
+                    ADB.forget_device(cmd[2])
+                raise ADBTransportException("%s: %s" % (" ".join(cmd), errors.strip()))
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+        return output
+
+    @classmethod
+    def get_circuit_breaker(cls, serial):
+        """Return the CircuitBreaker of serial, None if circuit_breaker_threshold is None."""
+        if not cls.circuit_breaker_threshold or serial is None:
+            return None
+        with cls._circuit_breakers_lock:
+            breaker = cls._circuit_breakers.get(serial)
+            if breaker is None:
+                breaker = cls._circuit_breakers[serial] = CircuitBreaker(
+                    serial, cls.circuit_breaker_threshold, cls.circuit_breaker_reset)
+            return breaker
+
+    deadline = staticmethod(deadline)
 
     def _adb_shell(self, *args):
         """Execute adb shell command."""        
-        cmd = ['adb', '-s', self.device, 'shell']
+        word = args[0].split(None, 1)[:1] if args else []
+        if word and word[0] in self.screen_changing_commands:
+            self._ui_table = None
+            if word[0] == 'input' and self._recorder is not None:
+                self._recorder(" ".join(args))
+        if word and word[0] in self.process_changing_commands:
+            self._process_table = None
+        batch = self._active_batch()
+        if batch is not None:
+            return batch.submit(" ".join(args))
+        return self._shell(*args)
+
+    def _shell(self, *args):
+        command = " ".join(args)
+        return _to_str(_run_command(self.device, ('shell',) + args,
+                                    lambda timeout: self._run_shell(command, timeout))).strip()
+
+    def _run_shell(self, command, timeout):
+        if timeout is not None:
+            # Have the device kill the command itself, where it has a `timeout`.
+            command = "t=; command -v timeout >/dev/null && t='timeout -s 9 %.3f'; $t sh -c '%s'" % (
+                timeout, command.replace("'", "'\\''"))
+            timeout += self.device_timeout_grace
+        if self.backend == "session":
+            return self._get_session().check_output(command, timeout)
+        if self.backend == "socket":
+            return self._pool().check_output(command, timeout)
+        return self._check_output(['adb', '-s', self.device, 'shell', command], timeout)
+
+    def _exec_out(self, *args):
+        """Execute command at device and return its raw binary output (Android 5.0+)."""
+        self._flush_batch()
+        if self.backend == "socket":
+            return _run_command(self.device, ('exec-out',) + args,
+                                lambda timeout: self._pool().exec_out(" ".join(args), timeout))
+        cmd = ['adb', '-s', self.device, 'exec-out']
         cmd.extend(args)
-        #print cmd
-        return self._exec(cmd).strip()
-
-    def _ps(self, package_name):
-        """This private method helps get pid of running app."""
-        cmd = ['adb', '-s', self.device, 'shell', 'ps | grep %s$' % package_name]
-        output = self._exec(cmd).strip()
-        if output:
-            fields = [x for x in output.split(' ') if x]
-            headers = ['user', 'pid', "ppid", 'vsize', 'rss', 'wchan', 'pc', 'stat', 'name']
-            return dict(zip(headers, fields))
-        return {}
+        return self._exec(cmd, raw=True)
+
+    def _pull(self, remote, local):
+        """Copy file remote at device to local at development machine."""
+        self._flush_batch()
+        if self.backend == "socket":
+            return _run_command(self.device, ('pull', remote, local),
+                                lambda timeout: self._pool().pull(remote, local, timeout=timeout))
+        return self._exec(['adb', '-s', self.device, 'pull', remote, local])
+
+    def _push(self, local, remote):
+        """Copy file local at development machine to remote at device."""
+        self._flush_batch()
+        if self.backend == "socket":
+            return _run_command(self.device, ('push', local, remote),
+                                lambda timeout: self._pool().push(local, remote, timeout=timeout))
+        return self._exec(['adb', '-s', self.device, 'push', local, remote])
+
+    def _push_data(self, data, remote):
+        """Write data to the file remote at device."""
+        self._flush_batch()
+        if self.backend == "socket":
+            return _run_command(self.device, ('push', remote),
+                                lambda timeout: self._pool().push_data(data, remote, timeout=timeout))
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return self._push(path, remote)
+        finally:
+            os.remove(path)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Send the shell commands of the block as few scripts as possible, see ADBBatch.
+
+        Methods that only send commands, like touch, key_* or clear_user_data,
+        are queued and return ShellFutures. Methods that need an output send
+        the queue together with their own command and return as usual.
+        Everything queued is sent when the block ends, then the first
+        failed command whose ShellFuture was never asked for its result
+        raises, as it would have outside the batch.
+        """
+        if self._active_batch() is not None:
+            yield self._active_batch()
+            return
+        batch = self._batches.batch = ADBBatch(self)
+        completed = False
+        try:
+            yield batch
+            completed = True
+        finally:
+            self._batches.batch = None
+            batch.flush()
+        if completed:
+            batch.raise_unobserved()
+
+    def _active_batch(self):
+        return getattr(self._batches, 'batch', None)
+
+    def _flush_batch(self):
+        """Send what the batch queued, before a command that doesn't go through _adb_shell."""
+        batch = self._active_batch()
+        if batch is not None:
+            batch.flush()
+
+    def _pool(self):
+        return ADBSocketClient.get_default().pool(self.device)
+
+    def _get_session(self):
+        """Return the shell session of this device, starting it on first use."""
+        if self._session is None:
+            self._session = ADBShellSession(self.device)
+        return self._session
+
+    def close(self):
+        """Terminate the long-lived shell session if one was started."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     def _get_uptime_of_system_and_idle(self):
         """Return a list object composed of two elements.
@@ -71,59 +557,103 @@ class ADB(object):
         The first one is uptime of the system (seconds), the second one is the amount
         of time spent in idle process (seconds).
         """
-        cmd = ['adb', '-s', self.device, 'shell', 'cat /proc/uptime']
-        output = self._exec(cmd).strip()
+        output = self._adb_shell('cat /proc/uptime')
         if output:
             return [float(x) for x in output.split(' ') if x]
         return [0, 0]
 
     def _get_android_version(self):
         """Get the Android Version such as 5.0.1, this method equals method self.get_device_os_version."""
-        cmd = ['adb', '-s', self.device, 'shell', 'getprop ro.build.version.release']
-        output = self._exec(cmd).strip()
-        return output
+        return self._get_device_prop('ro.build.version.release')
 
     def get_app_uid(self, package_name):
         """Get app's uid, if app is not installed, return None."""
-        cmd = ['adb', '-s', self.device, 'shell', 'dumpsys package %s | grep userId=' % package_name]
-        output = self._exec(cmd)
+        index = self.get_package_index()
+        if package_name not in index:
+            return None
+        if index.uid(package_name) is not None:
+            return str(index.uid(package_name))
+        # `pm list packages -U` is missing before Android 7.0.
+        output = self._adb_shell('dumpsys package %s | grep userId= || true' % package_name)
         candidate = self.re_uid.findall(output)
         return candidate[0] if candidate else None
 
+    def get_app_version_code(self, package_name):
+        """Get versionCode of an installed app as a str, None if unknown or not installed."""
+        version_code = self.get_package_index().version_code(package_name)
+        return str(version_code) if version_code is not None else None
+
     def get_current_activity(self):
         """Alias of method self.get_focused_app_window_token."""
         return self.get_focused_app_window_token()
 
     def get_focused_app_window_token(self):
         """Get the focused app package name as well as its activity."""
-        cmd = ['adb', '-s', self.device, 'shell', 'dumpsys window windows | grep -E "mCurrentFocus|mFocusedApp"']
-        output = self._exec(cmd)
+        output = self._adb_shell('dumpsys window windows | grep -E "mCurrentFocus|mFocusedApp"')
         token = self.re_focused_app_window_token.findall(output)
         return token[0] if token else None
 
+    def get_window_focus(self):
+        """Return the mCurrentFocus and mFocusedApp lines of dumpsys window, cheap to poll for changes."""
+        return self._adb_shell('dumpsys window windows | grep -E "mCurrentFocus|mFocusedApp" || true')
+
     def get_pid(self, package_name):
-        """Get app's pid."""
-        pid = self._ps(package_name).get('pid', None)
-        return int(pid) if pid else pid
+        """Get app's pid, from a process table at most process_table_ttl seconds old.
+
+        am, pm and kill commands sent through this instance drop the table,
+        see process_changing_commands.
+        """
+        return self.get_process_table().pid_of(package_name)
+
+    def get_process_table(self, max_age=None):
+        """Return a ProcessTable of all processes, reusing one younger than max_age seconds."""
+        if max_age is None:
+            max_age = self.process_table_ttl
+        table = self._process_table
+        if table is None or time.time() - table.timestamp > max_age:
+            table = self._process_table = self._read_process_table()
+        return table
+
+    def start_process_monitor(self, interval=1.0, callback=None):
+        """Start reporting started and gone processes, see ProcessMonitor."""
+        monitor = ProcessMonitor(self, interval, callback)
+        monitor.start()
+        return monitor
+
+    def _read_process_table(self):
+        # toybox ps (Android 8.0+) selects columns, older toolbox ps doesn't know -A / -o.
+        if self._ps_columns is not False:
+            table = ProcessTable.parse(self._adb_shell('ps -A -o PID,PPID,UID,RSS,NAME 2>/dev/null || true'))
+            self._ps_columns = len(table) > 0
+            if self._ps_columns:
+                return table
+        return ProcessTable.parse(self._adb_shell('ps'))
 
     # ------------------------------ Get Device Info ------------------------------
 
     def _get_device_prop(self, prop):
         """Don't call this method directly, using other proper methods builtin instead."""
-        cmd = ['adb', '-s', self.device, 'shell', 'getprop %s' % prop]
-        return self._exec(cmd).strip()
+        if self._properties.ttl > 0 and not self._properties.is_stale(prop):
+            return self._get_property_snapshot().get(prop, "")
+        value = self._adb_shell('getprop %s' % prop)
+        self._properties.set(prop, value)
+        return value
+
+    def _get_property_snapshot(self):
+        """Return the cached `getprop` dump, refreshing it once it is older than the TTL."""
+        properties = self._properties.get_all()
+        if properties is None:
+            properties = self.get_device_all_properties()
+        return properties
+
+    def invalidate_device_properties(self, *props):
+        """Re-read the given properties on next access, or the whole snapshot if none given."""
+        self._properties.invalidate(*props)
 
     def find_device_property_like(self, regexp):
         """Find device properties via regexp."""
-        properties = self.get_device_all_properties().items()
-        pattern = re.compile(regexp)
-        result = {}
-        for item in properties:
-            for i in item:
-                if pattern.findall(i):
-                    result.update((item,))
-                    break
-        return result
+        self._get_property_snapshot()
+        return self._properties.find_like(regexp)
 
     @staticmethod
     def list_devices():
@@ -134,13 +664,18 @@ class ADB(object):
 
     def get_device_all_properties(self):
         """Get info of device."""
-        cmd = ['adb', '-s', self.device, 'shell', 'getprop']
-        output = self._exec(cmd)
+        properties = self._parse_properties(self._adb_shell('getprop'))
+        self._properties.update(properties)
+        return properties
+
+    @classmethod
+    def _parse_properties(cls, output):
+        """Parse the output of `getprop` into a dict."""
         properties = {}
         if output is not None:
             lines = output.splitlines()
             for line in lines:
-                results = self.re_device_properties.findall(line.strip())
+                results = cls.re_device_properties.findall(line.strip())
                 if results:
                     properties.update(dict([results[0]]))
         return properties
@@ -199,79 +734,261 @@ class ADB(object):
         cmd = ['aapt', 'dump', 'badging', apk_path]
         return ADB._exec(cmd)
 
+    @classmethod
+    def _parse_badging_apk(cls, output):
+        """Parse the output of `aapt dump badging` into an ApkInfo."""
+        def first(regexp):
+            result = regexp.findall(output)
+            return result[0] if result else None
+        native_code = []
+        for line in cls.re_apk_native_code.findall(output):
+            native_code.extend(re.findall(r"'([^']*)'", line))
+        return ApkInfo(package_name=first(cls.re_apk_package_name),
+                       version_code=first(cls.re_apk_version_code),
+                       version_name=first(cls.re_apk_version_name),
+                       sdk_version=first(cls.re_apk_sdk_version),
+                       launchable_activity=first(cls.re_apk_launchable_activity),
+                       label=first(cls.re_apk_apk_label),
+                       permissions=cls.re_apk_permission.findall(output),
+                       native_code=native_code)
+
+    @classmethod
+    def get_apk_info(cls, apk_path):
+        """Get all info about APK, it is read at most once per APK content, see ApkInfoCache."""
+        if cls.apk_info_cache is None:
+            cls.apk_info_cache = ApkInfoCache()
+        return cls.apk_info_cache.get(apk_path, cls._read_apk_info)
+
+    @classmethod
+    def _read_apk_info(cls, apk_path):
+        if cls.apk_reader != "aapt":
+            try:
+                with ApkManifestReader(apk_path) as reader:
+                    return reader.read_info()
+            except ApkManifestException:
+                if cls.apk_reader == "python":
+                    raise
+        return cls._parse_badging_apk(cls._dump_badging_apk(apk_path))
+
     @classmethod
     def _get_apk_launchable_component(cls, apk_path):
-        return "%s/%s" % (cls.get_apk_launchable_activity(apk_path), cls.get_apk_launchable_activity(apk_path))
+        info = cls.get_apk_info(apk_path)
+        return "%s/%s" % (info.package_name, info.launchable_activity)
 
     @classmethod
     def get_apk_label(cls, apk_path):
         """Get the APK name displayed on screen."""
-        result = cls.re_apk_apk_label.findall(cls._dump_badging_apk(apk_path))
-        return result[0] if result else None
+        return cls.get_apk_info(apk_path).label
 
     @classmethod
     def get_apk_launchable_activity(cls, apk_path):
         """Get the main activity."""
-        result = cls.re_apk_launchable_activity.findall(cls._dump_badging_apk(apk_path))
-        return result[0] if result else None
+        return cls.get_apk_info(apk_path).launchable_activity
 
     @classmethod
     def get_apk_package_name(cls, apk_path):
         """Get the APK package name."""
-        print cls._dump_badging_apk(apk_path)
-        result = cls.re_apk_package_name.findall(cls._dump_badging_apk(apk_path))
-        return result[0] if result else None
+        return cls.get_apk_info(apk_path).package_name
 
     @classmethod
     def get_apk_sdk_version(cls, apk_path):
         """Get the APK SDK version."""
-        result = cls.re_apk_sdk_version.findall(cls._dump_badging_apk(apk_path))
-        return result[0] if result else None
+        return cls.get_apk_info(apk_path).sdk_version
 
     @classmethod
     def get_apk_version_code(cls, apk_path):
         """Get the APK version code such 1."""
-        result = cls.re_apk_version_code.findall(cls._dump_badging_apk(apk_path))
-        return result[0] if result else None
+        return cls.get_apk_info(apk_path).version_code
 
     @classmethod
     def get_apk_version_name(cls, apk_path):
         """Get the APK version name such as 8.0.1."""
-        result = cls.re_apk_version_name.findall(cls._dump_badging_apk(apk_path))
-        return result[0] if result else None
+        return cls.get_apk_info(apk_path).version_name
 
     # ------------------------------ Package Management ------------------------------
 
+    @_batchable
     def clear_user_data(self, package_name):
         """Clear application's user data."""
-        return self._adb_shell("pm", "clear", package_name)
+        try:
+            return self._adb_shell("pm", "clear", package_name)
+        finally:
+            self.invalidate_package_index()
 
-    def install_apk(self, apk_path):
+    def install_apk(self, apk_path, replace=False):
         """Install app using apk specified with apk_path at development machine."""
-        cmd = ['adb', '-s', self.device, 'install', apk_path]
-        return self._exec(cmd)
+        cmd = ['adb', '-s', self.device, 'install'] + (['-r'] if replace else []) + [apk_path]
+        self._flush_batch()
+        try:
+            return self._exec(cmd)
+        finally:
+            self.invalidate_package_index()
+
+    def install_package(self, apks, skip_if_current=True, reinstall=False):
+        """Install an ApkBundle or a list of APK paths, base first, return an InstallResult.
+
+        Nothing is transferred if skip_if_current and the device already has
+        the same versionCode built from the same APK files. Otherwise the
+        APKs are pushed and installed with `pm install -r`, or in one pm
+        install session if there are splits, like `adb install-multiple -r`.
+        If pm refuses a downgrade or an APK signed differently, reinstall
+        uninstalls the app, losing its data, and installs again; without it
+        ADBInstallException is raised.
+        """
+        if not isinstance(apks, ApkBundle):
+            apks = ApkBundle(apks)
+        timings = {}
+        start = time.time()
+        current = skip_if_current and self.is_package_current(apks)
+        timings['check'] = time.time() - start
+        if current:
+            return InstallResult(self.device, apks.package_name, 'skipped', timings)
+
+        start = time.time()
+        self._flush_batch()
+        remotes = ["%s/%s.apk" % (self.install_staging_dir, x) for x in apks.sha1s]
+        for path, data, remote in zip(apks.paths, apks.data, remotes):
+            if self.backend == "socket":
+                _run_command(self.device, ('push', path, remote),
+                             lambda timeout: self._pool().push_data(data, remote, timeout=timeout))
+            else:
+                self._push(path, remote)
+        timings['transfer'] = time.time() - start
+
+        start = time.time()
+        action = 'installed'
+        try:
+            try:
+                self._pm_install(apks, remotes)
+            except ADBInstallException as e:
+                if not reinstall or e.reason not in self.reinstall_install_failures:
+                    raise
+                self._adb_shell('pm uninstall %s || true' % apks.package_name)
+                self._pm_install(apks, remotes)
+                action = 'reinstalled'
+        finally:
+            self.invalidate_package_index()
+            self._adb_shell('rm -f %s' % " ".join(remotes))
+        timings['install'] = time.time() - start
+        return InstallResult(self.device, apks.package_name, action, timings)
+
+    def is_package_current(self, apks):
+        """Check whether the device has the app of an ApkBundle installed from the very same files."""
+        index = self.get_package_index()
+        if apks.package_name not in index:
+            return False
+        version_code = index.version_code(apks.package_name)
+        if version_code is not None and str(version_code) != str(apks.version_code):
+            return False
+        # Same content implies same signature; no sha1sum at device means not current.
+        output = self._adb_shell('for f in $(pm path %s); do sha1sum ${f#package:}; done 2>/dev/null || true'
+                                 % apks.package_name)
+        installed = sorted(x.split()[0] for x in output.splitlines() if x.strip())
+        return installed == sorted(apks.sha1s)
+
+    def _pm_install(self, apks, remotes):
+        if len(remotes) == 1:
+            output = self._adb_shell('pm install -r %s 2>&1 || true' % remotes[0])
+        else:
+            output = self._adb_shell('pm install-create -r -S %d' % sum(apks.sizes))
+            session = re.findall(r'\[(\d+)\]', output)
+            if not session:
+                raise ADBException("Creating install session at %s failed: %s" % (self.device, output))
+            try:
+                for i, (remote, size) in enumerate(zip(remotes, apks.sizes)):
+                    self._adb_shell('pm install-write -S %d %s %d_%s %s'
+                                    % (size, session[0], i, os.path.basename(apks.paths[i]), remote))
+            except Exception:
+                self._adb_shell('pm install-abandon %s || true' % session[0])
+                raise
+            output = self._adb_shell('pm install-commit %s 2>&1 || true' % session[0])
+        if 'Success' not in output:
+            reason = re.search(r'INSTALL_[A-Z_]+', output)
+            raise ADBInstallException("Installing %s at %s failed: %s" % (apks.package_name, self.device, output),
+                                      reason.group(0) if reason else None)
 
     def is_installed(self, package_name):
         """Check whether or not the app has been installed at device."""
-        return package_name in self.list_packages()
+        return package_name in self.get_package_index()
+
+    def get_package_index(self, max_age=None):
+        """Return the PackageIndex of the device, shared by all ADB instances of the device."""
+        index, stale = self._cached_package_index(self.device, max_age)
+        if stale:
+            for command in PackageIndex.commands(index):
+                index = PackageIndex.parse(self._adb_shell(command), command)
+                if len(index):
+                    break
+            self._store_package_index(self.device, index)
+        return index
+
+    def invalidate_package_index(self):
+        """Make the next package lookup list the packages again."""
+        self._expire_package_index(self.device)
+
+    # The package index cache, shared with AsyncADB.
+
+    @classmethod
+    def _cached_package_index(cls, device, max_age=None):
+        """Return the cached PackageIndex of device, None if there is none, and whether it is stale."""
+        if max_age is None:
+            max_age = cls.package_index_ttl
+        with cls._package_indexes_lock:
+            index = cls._package_indexes.get(device)
+        return index, index is None or time.time() - index.timestamp > max_age
 
+    @classmethod
+    def _store_package_index(cls, device, index):
+        with cls._package_indexes_lock:
+            cls._package_indexes[device] = index
+
+    @classmethod
+    def _expire_package_index(cls, device):
+        with cls._package_indexes_lock:
+            index = cls._package_indexes.get(device)
+            if index is not None:
+                index.timestamp = 0
+
+    @_batchable
     def launch_app(self, package_name, activity_name):
         """Launch app."""
-        self._adb_shell("am", "start", "%s/%s" % (package_name, activity_name))
+        return self._adb_shell("am", "start", "%s/%s" % (package_name, activity_name))
         
+    def launch_app_timed(self, package_name, activity_name, cold=False):
+        """Launch app and wait until it is drawn, return its LaunchTiming."""
+        return self.start_activity_timed("%s/%s" % (package_name, activity_name), cold)
+
+    def start_activity_timed(self, activity, cold=False, *extras):
+        """Start component activity with `am start -W` and return its LaunchTiming.
+
+        cold force-stops the app first (`-S`), extras are appended to the
+        command, like "-e", "open", "bmk".
+        """
+        args = ['am', 'start', '-W'] + (['-S'] if cold else []) + ['-n', activity] + list(extras)
+        start = time.time()
+        output = self._adb_shell(*args)
+        return LaunchTiming.parse(output, activity, time.time() - start)
+
+    def drop_caches(self):
+        """Drop the page cache of the device, return False if that needs root adbd is not running as."""
+        output = self._adb_shell('sync && echo 3 2>/dev/null >/proc/sys/vm/drop_caches && echo dropped || true')
+        return output == 'dropped'
+
+    @_batchable
     def launch_special_activity(self, package_name, activity_name, page_name):
         """Launch specail activity."""
-        self._adb_shell("am", "start", "-n","%s/%s" % (package_name, activity_name),"-e open", page_name)
+        return self._adb_shell("am", "start", "-n","%s/%s" % (package_name, activity_name),"-e open", page_name)
 
     def list_packages(self):
         """List all apps installed at device."""
-        cmd = ['adb', '-s', self.device, 'shell', 'pm list packages']
-        output = self._exec(cmd)
-        lines = output.strip().split('\n')
-        return [p.split(':')[1].strip() for p in lines]
+        return list(self.get_package_index().names)
 
     def get_screenshot(self, directory=None, filename=None):
-        """Get screenshot."""
+        """Get screenshot.
+
+        From Android 5.0 on the PNG is streamed with exec-out, nothing is
+        written at device.
+        """
         if directory is None:
             directory = os.getcwd()
         else:
@@ -283,42 +1000,78 @@ class ADB(object):
         if not filename.upper().endswith(".PNG"):
             filename += ".png"
 
-        cmd = ['screencap', '-p', '/sdcard/screenshot.png']
+        path = os.path.join(directory, filename)
         try:
-            self._adb_shell(*cmd)            
-            self._exec(['adb', 'pull', '/sdcard/screenshot.png', os.path.join(directory, filename)])
-            print os.path.join(directory, filename)
-            self._adb_shell(['rm', '/sdcard/screenshot.png'])
-            return os.path.join(directory, filename)
-        except Exception, e:
+            if self._android_major_version() >= 5:
+                with open(path, 'wb') as f:
+                    f.write(self.get_screenshot_data())
+            else:
+                # No exec-out before Android 5.0, use a remote file unique to this call.
+                remote = '/sdcard/screenshot_%s.png' % uuid.uuid4().hex
+                self._adb_shell('screencap', '-p', remote)
+                self._pull(remote, path)
+                self._adb_shell('rm', remote)
+            print(path)
+            return path
+        except Exception as e:
             return str(e)
 
+    def get_screenshot_data(self, raw=False):
+        """Get screenshot in memory: PNG bytes, or a RawScreenshot if raw (Android 5.0+).
+
+        Raw frames skip the PNG encoding at device and decoding at host.
+        """
+        if raw:
+            return self._parse_raw_screenshot(self._exec_out('screencap'))
+        return self._exec_out('screencap', '-p')
+
+    @staticmethod
+    def _parse_raw_screenshot(data):
+        """Parse `screencap` output: width, height, format (and dataspace since Android 9), then pixels."""
+        width, height, pixel_format = struct.unpack_from('<III', data, 0)
+        size = width * height * RawScreenshot.bytes_per_pixel.get(pixel_format, 4)
+        header = len(data) - size
+        if header not in (12, 16):
+            raise ADBException("Unexpected screencap output of %d bytes for %dx%d." % (len(data), width, height))
+        return RawScreenshot(width, height, pixel_format, data[header:])
+
+    def start_screen_capture(self, frames=30, interval=0.2, raw=True):
+        """Start keeping the last frames screenshots in memory, see ScreenCapture."""
+        capture = ScreenCapture(self, frames, interval, raw)
+        capture.start()
+        return capture
+
+    @_batchable
     def remove_folder(self, folder):
         """Remove folder at device.
 
         Note: you should uninstall the app before you remove folder.
         """
-        cmd = ['adb', '-s', self.device, 'shell', 'rm -r %s' % folder]
-        return self._exec(cmd)
+        return self._adb_shell('rm -r %s' % folder)
 
+    @_batchable
     def uninstall_apk(self, package_name):
         """Uninstall app from device."""
-        cmd = ['adb', '-s', self.device, 'shell', 'pm uninstall %s' % package_name]
-        return self._exec(cmd)
+        try:
+            return self._adb_shell('pm uninstall %s' % package_name)
+        finally:
+            self.invalidate_package_index()
 
     # ------------------------------ User Action ------------------------------
 
     def press_back(self):
-        self.key_back()
+        return self.key_back()
 
     def press_home(self):
-        self.key_home()
+        return self.key_home()
 
+    @_batchable
     def drag(self, start, end, duration, **kwargs):
         args = start + end + (duration * 1000,)
         args = [str(x) for x in args]
         return self._adb_shell("input", "swipe", *args)
 
+    @_batchable
     def long_press(self, dx, dy):
         return self.drag((dx, dy), (dx, dy), 5)
 
@@ -326,371 +1079,668 @@ class ADB(object):
     def sleep(seconds=0):
         time.sleep(seconds)
 
+    @_batchable
     def touch(self, x, y, **kwargs):
         return self._adb_shell("input", "tap", str(x), str(y))
 
+    def touch_node(self, node):
+        """Tap the center of a UINode, or of a node returned by dump_ui_nodes."""
+        if isinstance(node, UINode):
+            return self.touch(*node.center)
+        x1, y1, x2, y2 = [int(x) for x in re.findall(r'-?\d+', node['bounds'])]
+        return self.touch((x1 + x2) // 2, (y1 + y2) // 2)
+
+    def get_ui_table(self, max_age=None):
+        """Return a UITable of the screen, reusing one younger than max_age seconds.
+
+        The default max_age is ui_table_ttl. A table is never reused after
+        a touch, key, swipe or am command, see screen_changing_commands.
+        """
+        if max_age is None:
+            max_age = self.ui_table_ttl
+        table = self._ui_table
+        if table is None or time.time() - table.timestamp > max_age:
+            table = self._ui_table = UITable.parse(self.dump_ui_xml())
+        return table
+
+    def invalidate_ui_table(self):
+        """Make the next get_ui_table dump the UI, for screens that changed by themselves."""
+        self._ui_table = None
+
+    def find(self, text=None, resource_id=None, class_name=None, description=None, contains=False, timeout=0):
+        """Return the first UINode matching all given attributes, None if there is none.
+
+        contains matches text and description as substrings. With a timeout
+        the UI is dumped again until the node shows up or timeout seconds passed.
+        """
+        def lookup(max_age=None):
+            return self.get_ui_table(max_age).find_one(text, resource_id, class_name, description, contains)
+        node = lookup()
+        if node is None and timeout:
+            node = self.wait_until(lambda: lookup(0), timeout, 0.2).value
+        return node
+
+    @contextlib.contextmanager
+    def record_gestures(self):
+        """Record the input commands of touch, drag, long_press, keys and type into a GestureScript.
+
+        The commands still run. Step times are seconds since the block started.
+        """
+        script = GestureScript([])
+        start = time.time()
+        self._recorder = lambda command: script.steps.append(GestureStep(round(time.time() - start, 3), command))
+        try:
+            yield script
+        finally:
+            self._recorder = None
+
+    def record_getevent(self, seconds, device=None):
+        """Record the raw touch and key events of the device for seconds, return a GestureScript.
+
+        device, like /dev/input/event2, limits the recording to one input device.
+        """
+        command = "getevent -t" + (" " + device if device else "")
+        self._flush_batch()
+        if self.backend == "socket":
+            # The legacy shell service runs getevent on a pty, so it writes line by line.
+            sock = self._pool()._open_service("shell:%s" % command)
+            stop = lambda: sock.shutdown(socket.SHUT_RDWR)
+            read = lambda: ADBSocketClient._recv_all(sock)
+        else:
+            proc = subprocess.Popen(['adb', '-s', self.device, 'shell', '-t', '-t', command],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            stop = proc.kill
+            read = lambda: proc.communicate()[0]
+        timer = threading.Timer(seconds, stop)
+        timer.start()
+        try:
+            output = read()
+        finally:
+            timer.cancel()
+            if self.backend == "socket":
+                sock.close()
+            else:
+                proc.wait()
+        return GestureScript.from_getevent(_to_str(output))
+
+    def prepare_gestures(self, script):
+        """Push the device side player of script once, return its path at device."""
+        text = script.render()
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        remote = self._gesture_remotes.get(key)
+        if remote is None:
+            remote = "%s/gestures_%s.sh" % (self.install_staging_dir, key)
+            self._push_data(text.encode('utf-8'), remote)
+            self._gesture_remotes[key] = remote
+        return remote
+
+    def play_gestures(self, script):
+        """Replay a GestureScript in one shell invocation timed at device, return a ReplayResult."""
+        output = self._adb_shell('sh', self.prepare_gestures(script))
+        actual = [int(x) / 100.0 for x in re.findall(r'^@\d+ (-?\d+)\s*$', output, re.M)]
+        return ReplayResult(self.device, [x.at for x in script.steps], actual)
+
+    def tap_text(self, text, contains=False, timeout=0):
+        """Tap the first node showing text, return it, None if it wasn't found."""
+        node = self.find(text, contains=contains, timeout=timeout)
+        if node is not None:
+            self.touch_node(node)
+        return node
+
+    def dump_ui_xml(self):
+        """Dump the UI hierarchy with uiautomator and return its XML."""
+        output = ""
+        if self._android_major_version() >= 5:
+            output = _to_str(self._exec_out('uiautomator', 'dump', '/dev/tty'))
+        if '<?xml' not in output:
+            output = self._adb_shell('uiautomator dump /sdcard/window_dump.xml >/dev/null && '
+                                     'cat /sdcard/window_dump.xml')
+        start, end = output.find('<?xml'), output.rfind('>')
+        if start < 0:
+            raise ADBException("uiautomator dump failed: %s" % output.strip())
+        return output[start:end + 1]
+
+    def dump_ui_nodes(self):
+        """Return the attribute dicts of all nodes of the UI hierarchy, in document order."""
+        root = ElementTree.fromstring(self.dump_ui_xml().encode('utf-8'))
+        return [x.attrib for x in root.iter('node')]
+
     def type(self, message):
-        """Send text to device."""
-        return self._adb_shell("input", "text", message.replace(" ", "%s"))
+        """Send text to device.
+
+        The text is quoted for the device shell, so shell metacharacters are typed
+        as they are. Long text is split into as few `input text` calls as the
+        command line length allows. Note `input text` itself turns "%s" into a space.
+        """
+        output = []
+        for chunk in self._split_for_command_line(message, self._quote_input_text, len("input text ")):
+            output.append(self._adb_shell("input", "text", self._quote_input_text(chunk)))
+        return "\n".join(output)
+
+    @staticmethod
+    def _quote_input_text(text):
+        return "'%s'" % text.replace(" ", "%s").replace("'", "'\\''")
+
+    def _split_for_command_line(self, items, render, overhead):
+        """Split items into chunks whose rendered command fits in max_shell_command_length."""
+        limit = self.max_shell_command_length - overhead
+        chunks = []
+        start = 0
+        while start < len(items):
+            end = start + 1
+            while end < len(items) and len(render(items[start:end + 1])) <= limit:
+                end += 1
+            chunks.append(items[start:end])
+            start = end
+        return chunks
 
     def wait(self, seconds=0):
         self.sleep(seconds)
 
+    def wait_until(self, condition, timeout=10, interval=0.1, max_interval=1.0):
+        """Poll condition() until it returns a true value or timeout seconds passed.
+
+        Polls start interval seconds apart and back off up to max_interval.
+        adb commands of condition are cut at the deadline. A probe command
+        that times out or exits with an error counts as not yet; other
+        exceptions propagate. Returns a WaitResult with the last value and
+        the seconds actually waited.
+        """
+        start = time.time()
+        end = start + timeout
+        polls = 0
+        value = None
+        while True:
+            polls += 1
+            try:
+                with deadline(max(end - time.time(), 0.001)):
+                    value = condition()
+            except (ADBTimeoutException, subprocess.CalledProcessError):
+                value = None
+            now = time.time()
+            if value or now >= end:
+                return WaitResult(bool(value), value, now - start, polls)
+            time.sleep(min(interval, end - now))
+            interval = min(interval * 1.5, max_interval)
+
+    def wait_for_activity(self, activity, timeout=10, interval=0.1):
+        """Wait until activity, like .Main, com.app.Main or com.app/.Main, has the focus."""
+        package, _, name = activity.rpartition('/')
+        names = set([name, package + name if name.startswith('.') else name])
+        return self.wait_until(lambda: self.get_focused_app_window_token() in names and activity,
+                               timeout, interval)
+
+    def wait_for_process(self, package_name, timeout=10, interval=0.1):
+        """Wait until a process of package_name runs, the WaitResult value is its pid."""
+        return self.wait_until(lambda: self.get_process_table(max_age=0).pid_of(package_name),
+                               timeout, interval)
+
+    def wait_for_screen_stable(self, timeout=10, stable_for=1.0, threshold=0.01, interval=0.1, step=8):
+        """Wait until raw screenshots stop changing for stable_for seconds (Android 5.0+).
+
+        Frames are compared on every step-th pixel of every step-th row, as
+        the mean absolute channel difference relative to 255; below threshold
+        counts as unchanged. Uses NumPy when it is installed. The WaitResult
+        value is the last RawScreenshot.
+        """
+        if self._android_major_version() < 5:
+            raise ADBException("Raw screenshots need Android 5.0+, not %s." % self.android_version)
+        state = {'sample': None, 'since': None}
+
+        def stable():
+            frame = self.get_screenshot_data(raw=True)
+            sample = _frame_sample(frame, step)
+            now = time.time()
+            previous, state['sample'] = state['sample'], sample
+            if previous is None or _frame_difference(previous, sample) > threshold:
+                state['since'] = now
+            return frame if now - state['since'] >= stable_for else None
+
+        # A changing screen has to be checked at its own pace, not backed off.
+        return self.wait_until(stable, timeout, interval, interval)
+
+    @_batchable
     def powerstayon(self, stayon=True):
         if stayon == True:
-            self._adb_shell("svc","power","stayon", "true")
+            return self._adb_shell("svc","power","stayon", "true")
         else:
-            self._adb_shell("svc","power","stayon", "false")
+            return self._adb_shell("svc","power","stayon", "false")
      
     # need root       
+    @_batchable
     def wifienableordis(self, enable = True):
         if enable == True:
-            self._adb_shell("svc","wifi","enable")
+            return self._adb_shell("svc","wifi","enable")
         else:
-            self._adb_shell("svc","wifi","disable")
+            return self._adb_shell("svc","wifi","disable")
     # ----------------------------- Key Event -----------------------------
 
+    @_batchable
     def _keyevent(self, keycode):
-        self._adb_shell("input", "keyevent", str(keycode))
+        return self._adb_shell("input", "keyevent", str(keycode))
+
+    def _android_major_version(self):
+        """Return 5 for Android 5.0.1, a large number if the version isn't numeric (previews)."""
+        try:
+            return int(self.android_version.split('.')[0])
+        except ValueError:
+            return sys.maxsize
+
+    def _supports_multiple_keyevents(self):
+        """`input keyevent` accepts several key codes since Android 5.0."""
+        return self._android_major_version() >= 5
+
+    @_batchable
+    def send_keys(self, keycodes):
+        """Send a sequence of key codes with as few adb shell calls as possible.
+
+        On Android 5.0+ this is `input keyevent k1 k2 ...`, on older versions the
+        `input keyevent` calls are chained in one shell command instead.
+        """
+        keycodes = [str(x) for x in keycodes]
+        if self._supports_multiple_keyevents():
+            render = lambda codes: "input keyevent " + " ".join(codes)
+        else:
+            render = lambda codes: "; ".join("input keyevent " + x for x in codes)
+        output = None
+        for chunk in self._split_for_command_line(keycodes, render, 0):
+            output = self._adb_shell(render(chunk))
+        return output
 
     def key_menu(self):
-        self._keyevent(82)
+        return self._keyevent(82)
 
     def key_soft_right(self):
-        self._keyevent(2)
+        return self._keyevent(2)
 
     def key_home(self):
-        self._keyevent(3)
+        return self._keyevent(3)
 
     def key_back(self):
-        self._keyevent(4)
+        return self._keyevent(4)
 
     def key_call(self):
-        self._keyevent(5)
+        return self._keyevent(5)
 
     def key_end_call(self):
-        self._keyevent(6)
+        return self._keyevent(6)
 
     def key_0(self):
-        self._keyevent(7)
+        return self._keyevent(7)
 
     def key_1(self):
-        self._keyevent(8)
+        return self._keyevent(8)
 
     def key_2(self):
-        self._keyevent(9)
+        return self._keyevent(9)
 
     def key_3(self):
-        self._keyevent(10)
+        return self._keyevent(10)
 
     def key_4(self):
-        self._keyevent(11)
+        return self._keyevent(11)
 
     def key_5(self):
-        self._keyevent(12)
+        return self._keyevent(12)
 
     def key_6(self):
-        self._keyevent(13)
+        return self._keyevent(13)
 
     def key_7(self):
-        self._keyevent(14)
+        return self._keyevent(14)
 
     def key_8(self):
-        self._keyevent(15)
+        return self._keyevent(15)
 
     def key_9(self):
-        self._keyevent(16)
+        return self._keyevent(16)
 
     def key_star(self):
         """char *"""
-        self._keyevent(17)
+        return self._keyevent(17)
 
     def key_pound(self):
         """char #"""
-        self._keyevent(18)
+        return self._keyevent(18)
 
     def key_d_pad_up(self):
         """Directional Pad Up key."""
-        self._keyevent(19)
+        return self._keyevent(19)
 
     def key_d_pad_down(self):
         """Directional Pad Down key."""
-        self._keyevent(20)
+        return self._keyevent(20)
 
     def key_d_pad_left(self):
         """Directional Pad Left key."""
-        self._keyevent(21)
+        return self._keyevent(21)
 
     def key_d_pad_right(self):
         """Directional Pad Right key."""
-        self._keyevent(22)
+        return self._keyevent(22)
 
     def key_d_pad_center(self):
         """Directional Pad Center key."""
-        self._keyevent(23)
+        return self._keyevent(23)
 
     def key_volume_up(self):
-        self._keyevent(24)
+        return self._keyevent(24)
 
     def key_volume_down(self):
-        self._keyevent(25)
+        return self._keyevent(25)
 
     def key_volume_power(self):
-        self._keyevent(26)
+        return self._keyevent(26)
 
     def key_camera(self):
-        self._keyevent(27)
+        return self._keyevent(27)
 
     def key_clear(self):
-        self._keyevent(28)
+        return self._keyevent(28)
 
     def key_a(self):
-        self._keyevent(29)
+        return self._keyevent(29)
 
     def key_b(self):
-        self._keyevent(30)
+        return self._keyevent(30)
 
     def key_c(self):
-        self._keyevent(31)
+        return self._keyevent(31)
 
     def key_d(self):
-        self._keyevent(32)
+        return self._keyevent(32)
 
     def key_e(self):
-        self._keyevent(33)
+        return self._keyevent(33)
 
     def key_f(self):
-        self._keyevent(34)
+        return self._keyevent(34)
 
     def key_g(self):
-        self._keyevent(35)
+        return self._keyevent(35)
 
     def key_h(self):
-        self._keyevent(36)
+        return self._keyevent(36)
 
     def key_i(self):
-        self._keyevent(37)
+        return self._keyevent(37)
 
     def key_j(self):
-        self._keyevent(38)
+        return self._keyevent(38)
 
     def key_k(self):
-        self._keyevent(39)
+        return self._keyevent(39)
 
     def key_l(self):
-        self._keyevent(40)
+        return self._keyevent(40)
 
     def key_m(self):
-        self._keyevent(41)
+        return self._keyevent(41)
 
     def key_n(self):
-        self._keyevent(42)
+        return self._keyevent(42)
 
     def key_o(self):
-        self._keyevent(43)
+        return self._keyevent(43)
 
     def key_p(self):
-        self._keyevent(44)
+        return self._keyevent(44)
 
     def key_q(self):
-        self._keyevent(45)
+        return self._keyevent(45)
 
     def key_r(self):
-        self._keyevent(46)
+        return self._keyevent(46)
 
     def key_s(self):
-        self._keyevent(47)
+        return self._keyevent(47)
 
     def key_t(self):
-        self._keyevent(48)
+        return self._keyevent(48)
 
     def key_u(self):
-        self._keyevent(49)
+        return self._keyevent(49)
 
     def key_v(self):
-        self._keyevent(50)
+        return self._keyevent(50)
 
     def key_w(self):
-        self._keyevent(51)
+        return self._keyevent(51)
 
     def key_x(self):
-        self._keyevent(52)
+        return self._keyevent(52)
 
     def key_y(self):
-        self._keyevent(53)
+        return self._keyevent(53)
 
     def key_z(self):
-        self._keyevent(54)
+        return self._keyevent(54)
 
     def key_comma(self):
-        self._keyevent(55)
+        return self._keyevent(55)
 
     def key_period(self):
-        self._keyevent(56)
+        return self._keyevent(56)
 
     def key_alt_left(self):
-        self._keyevent(57)
+        return self._keyevent(57)
 
     def key_alt_right(self):
-        self._keyevent(58)
+        return self._keyevent(58)
 
     def key_shift_left(self):
-        self._keyevent(59)
+        return self._keyevent(59)
 
     def key_shift_right(self):
-        self._keyevent(60)
+        return self._keyevent(60)
 
     def key_tab(self):
-        self._keyevent(61)
+        return self._keyevent(61)
 
     def key_space(self):
-        self._keyevent(62)
+        return self._keyevent(62)
 
     def key_sym(self):
-        self._keyevent(63)
+        return self._keyevent(63)
 
     def key_explorer(self):
-        self._keyevent(64)
+        return self._keyevent(64)
 
     def key_enter(self):
-        self._keyevent(66)
+        return self._keyevent(66)
         
     def key_equals(self):
         """ '=' key."""
-        self._keyevent(70)
+        return self._keyevent(70)
 
     def key_mute(self):
-        self._keyevent(91)
+        return self._keyevent(91)
 
     def key_escape(self):
-        self._keyevent(111)
+        return self._keyevent(111)
 
     def key_f1(self):
-        self._keyevent(131)
+        return self._keyevent(131)
 
     def key_f2(self):
-        self._keyevent(132)
+        return self._keyevent(132)
 
     def key_f3(self):
-        self._keyevent(133)
+        return self._keyevent(133)
 
     def key_f4(self):
-        self._keyevent(134)
+        return self._keyevent(134)
 
     def key_f5(self):
-        self._keyevent(135)
+        return self._keyevent(135)
 
     def key_f6(self):
-        self._keyevent(136)
+        return self._keyevent(136)
 
     def key_f7(self):
-        self._keyevent(137)
+        return self._keyevent(137)
 
     def key_f8(self):
-        self._keyevent(138)
+        return self._keyevent(138)
 
     def key_f9(self):
-        self._keyevent(139)
+        return self._keyevent(139)
 
     def key_f10(self):
-        self._keyevent(140)
+        return self._keyevent(140)
 
     def key_f11(self):
-        self._keyevent(141)
+        return self._keyevent(141)
 
     def key_f12(self):
-        self._keyevent(142)   
+        return self._keyevent(142)   
     
-    def get_cpu_usage(self,package_name):
-        '''Get the cpu usage of package name'''
-        cmd = ['adb', '-s', self.device, 'shell', ' dumpsys cpuinfo | grep %s'%package_name]
-        output = self._exec(cmd).strip()
-        cmd = ['adb', '-s', self.device, 'shell', ' dumpsys cpuinfo | grep TOTAL']
-        mobile_total = self._exec(cmd).strip()
-        mobile_total = float(mobile_total.split('%')[0])
-
-        if output=='':
-            return (mobile_total,0,0,0)
-        print 'output....',output
-        tmp = output.split('%')
-        print 'tmp....',tmp
-        total = float(tmp[0])
-        if total == 0:
-            return (mobile_total,0,0,0)
-        else:
-            user=float(tmp[1][tmp[1].rindex(':')+1:len(tmp[1])].strip())
-            kernel=float(tmp[2][tmp[2].rindex('+')+1:len(tmp[2])].strip())
-            return (mobile_total,total,user,kernel)
+    def get_cpu_usage(self, package_name, interval=1.0):
+        """Return CPU usage of the device and of package_name over the next interval seconds.
 
+        The result is (device total, package total, package user, package
+        kernel), in percent of all CPUs like `dumpsys cpuinfo`, from two /proc
+        snapshots taken by a CpuSampler. The package values are 0 if it isn't running.
+        """
+        sampler = CpuSampler(self, [package_name])
+        sampler.sample()
+        time.sleep(interval)
+        row = sampler.sample()
+        return (row['total'], row.get(package_name, 0), row.get(package_name + '.user', 0),
+                row.get(package_name + '.kernel', 0))
+
+    def start_cpu_sampler(self, packages=(), interval=0.1, capacity=None):
+        """Start sampling CPU usage of the device and packages, see CpuSampler."""
+        sampler = CpuSampler(self, packages, interval, capacity)
+        sampler.start()
+        return sampler
+
+    def start_memory_sampler(self, packages, interval=1.0, capacity=3600):
+        """Start sampling PSS/RSS of packages, see MemorySampler."""
+        sampler = MemorySampler(self, packages, interval, capacity)
+        sampler.start()
+        return sampler
+
+    def start_frame_stats(self, package_name, interval=1.0, capacity=10000):
+        """Start collecting frame times of package_name, see FrameStatsCollector."""
+        collector = FrameStatsCollector(self, package_name, interval, capacity)
+        collector.start()
+        return collector
+
+    def logcat(self, pid=None, package=None, tags=None, level=None, dump=False, tail=None):
+        """Stream logcat of the device as LogcatRecords, see LogcatStream.
+
+        tags is a list of tags, or a dict of tag to minimum level, level the
+        minimum level of everything else shown. package is resolved to the
+        pid the app runs as now. Filters are given to logcat itself, --pid
+        from Android 7.0, and applied again to the parsed lines. dump stops
+        at the end of the buffer, tail starts at the last tail lines.
+        """
+        if package is not None:
+            pid = self.get_pid(package)
+            if pid is None:
+                raise ADBException("%s is not running." % package)
+        args = ['-v', 'threadtime']
+        if pid is not None and self._android_major_version() >= 7:
+            args.append('--pid=%d' % pid)
+        if dump:
+            args.append('-d')
+        if tail is not None:
+            args.extend(['-T', str(tail)])
+        if isinstance(tags, dict):
+            tag_levels = dict(tags)
+        else:
+            tag_levels = dict((x, level or 'V') for x in tags or ())
+        if tag_levels:
+            args.extend("%s:%s" % x for x in sorted(tag_levels.items()))
+            args.append('*:S')
+        elif level is not None:
+            args.append('*:%s' % level)
+        self._flush_batch()
+        return LogcatStream(self, args, pid, tag_levels or None, None if tag_levels else level)
+
+    def start_logcat_monitor(self, capacity=10000, callback=None, **filters):
+        """Start keeping logcat in a ring buffer, calling callback on crashes and ANRs, see LogcatMonitor."""
+        monitor = LogcatMonitor(self, capacity, **filters)
+        if callback is not None:
+            for pattern in LogcatMonitor.crash_patterns:
+                monitor.watch(pattern, callback)
+        monitor.start()
+        return monitor
+
+    def start_popup_watcher(self, rules=None, **kwargs):
+        """Start tapping through popups, self.popup_rules by default, see PopupWatcher."""
+        watcher = PopupWatcher(self, self.popup_rules if rules is None else rules, **kwargs)
+        watcher.start()
+        return watcher
+
+    @_batchable
     def start_activity(self,activity):
         cmd = 'am start -n {activity}'.format(activity = activity)
-        self._adb_shell(cmd)
+        return self._adb_shell(cmd)
         
     '''input  string'''
-    def input_text(self,text):
-        for i in text:
-            if i==" ":
-                adb_com="key_"+"space"
-                key_event = getattr(adb, adb_com)
-                key_event()
-            else:
-                adb_com="key_"+i
-                key_event = getattr(adb, adb_com)
-                key_event()
-        adb.key_enter()
-        time.sleep(3)
+    def input_text(self,text,wait=3):
+        '''
+        按键输入text并回车, 等待界面稳定, 最多wait秒
+        '''
+        unknown = [x for x in text if x not in self.keycodes_of_char]
+        if unknown:
+            raise ADBException("No key code for %r." % "".join(unknown))
+        self.send_keys([self.keycodes_of_char[x] for x in text] + [self.keycodes_of_char['\n']])
+        if wait and self._android_major_version() >= 5:
+            self.wait_for_screen_stable(timeout=wait, stable_for=min(0.5, wait))
+        elif wait:
+            time.sleep(wait)
 
     def runwatch(self,d,data):
+        '''
+        运行d的uiautomator watchers, data为1或已set的threading.Event时停止. 建议改用start_popup_watcher
+        '''
         times = 50
-        print "...................................监控系统弹窗中..................................."
+        print("...................................监控系统弹窗中...................................")
         while True:
-            if data == 1:                
+            if data == 1 or (hasattr(data, 'is_set') and data.is_set()):
                 return True
             # d.watchers.reset()
             d.watchers.run()        
             times -= 1
-            print times
+            print(times)
             if times == 0:
                 break
             else:
                 time.sleep(0.5)
                 
     def install_watch(self,d,pkg_path):
-        self.uninstall_apk("com.UCMobile")
-        try:
-            d.watcher('allowroot').when(text=u'允许').click(text=u'允许')
-            d.watcher('allowro').when(text=u'删除').click(text=u'删除')
-            d.watcher('allow').when(text=u'同意').click(text=u'同意')
-            d.watcher('start_flag').when(text=u'跳过').click(text=u'跳过',className='android.widget.TextView')
-            t=threading.Thread(target=self.runwatch,args=(d,0))
-            t.setDaemon(True)
-            t.start()
-            self.install_apk(pkg_path)
+        '''
+        安装并启动UC, 由start_popup_watcher按popup_rules处理弹窗, d不再使用
+        降级或签名不同时先卸载再安装, 其他安装失败抛出ADBInstallException
+        '''
+        with self.start_popup_watcher() as watcher:
+            self.install_package(pkg_path, reinstall=True)
             self.launch_app('com.UCMobile','com.uc.browser.InnerUCMobile')
-            time.sleep(10)
-            #print "start UCMobile time",device.start_app('com.UCMobile','com.uc.browser.InnerUCMobile')
-        except Exception,e:
-            traceback.print_exc()
-            print Exception,":",e
-        if d(text=u"跳过"):
-            d(text=u"跳过").click(text=u'跳过',className='android.widget.TextView')
-        print "install success"
-        
-        
+            # 弹窗处理完且界面2秒无变化即返回, 最多等10秒
+            watcher.wait_quiet(2, timeout=10)
+        #print "start UCMobile time",device.start_app('com.UCMobile','com.uc.browser.InnerUCMobile')
+        print("install success")
+
+
+    @_batchable
     def uc_openwindow(self,window):
         '''
         ex:account,appmgmt,bmk,bmkmgmt,clip,file,search具体参照ucinitent调用说明
         '''
         cmd=" am start -n com.UCMobile/.main.UCMobile -e open "+window
-        self._adb_shell(cmd)
+        return self._adb_shell(cmd)
         
         
+    @_batchable
     def uc_clickfunc(self,func):
         '''
         ex:点击home等操作，具体可用点击参照ucintent说明
         '''
         cmd=" am start -n com.UCMobile/.main.UCMobile -e click "+func
-        self._adb_shell(cmd)
+        return self._adb_shell(cmd)
 
 class ADBException(Exception):
     pass
@@ -698,6 +1748,2552 @@ class ADBException(Exception):
 class ADBNoDeviceFoundException(ADBException):
     pass
 
+class ADBShellSessionException(ADBException):
+    pass
+
+class ADBTimeoutException(ADBException):
+    pass
+
+class ADBTransportException(ADBException):
+    pass
+
+class ADBCircuitOpenException(ADBException):
+    pass
+
+class ADBInstallException(ADBException):
+    """pm refused an install, reason is its INSTALL_FAILED_* code if it gave one."""
+
+    def __init__(self, message, reason=None):
+        ADBException.__init__(self, message)
+        self.reason = reason
+
+
+class CircuitBreaker(object):
+    """Refuse commands to a device after threshold failures in a row.
+
+    While open, commands fail at once with ADBCircuitOpenException. After
+    reset_timeout seconds one trial command is let through (half-open): if
+    it succeeds the breaker closes, if it fails it opens again.
+    """
+
+    def __init__(self, serial, threshold=5, reset_timeout=30.0):
+        self.serial = serial
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self._trial or time.time() - self.opened_at >= self.reset_timeout else 'open'
+
+    def check(self):
+        """Raise ADBCircuitOpenException unless a command may be sent now."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trial or time.time() - self.opened_at < self.reset_timeout:
+                raise ADBCircuitOpenException("%s failed %d times in a row, commands refused for %g seconds."
+                                              % (self.serial, self.failures, self.reset_timeout))
+            self._trial = True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.time()
+                self._trial = False
+
+    def reset(self):
+        self.success()
+
+
+class ShellFuture(object):
+    """Output of a shell command queued by ADB.batch().
+
+    result() sends the batch if the command is still queued, then returns
+    the stripped output or raises like _adb_shell would have.
+    """
+
+    def __init__(self, batch, command):
+        self.batch = batch
+        self.command = command
+        self.output = None
+        self.exit_code = None
+        self.exception = None
+        self.observed = False
+        self._done = False
+
+    def done(self):
+        return self._done
+
+    def _set(self, output=None, exit_code=None, exception=None):
+        self.output, self.exit_code, self.exception = output, exit_code, exception
+        self._done = True
+
+    def result(self):
+        self.observed = True
+        if not self._done:
+            self.batch.flush()
+        if self.exception is not None:
+            raise self.exception
+        if self.exit_code:
+            raise subprocess.CalledProcessError(self.exit_code, self.command, self.output)
+        return self.output
+
+    def __repr__(self):
+        return "ShellFuture(%r, done=%s)" % (self.command, self._done)
+
+
+class ADBBatch(object):
+    """Shell commands of one thread queued to be sent as one script.
+
+    Each command runs in braces with stdin closed, followed by a marker line
+    with its exit code, like ADBShellSession does, so a failing command does
+    not stop the next ones. Scripts longer than max_shell_command_length are
+    split. round_trips counts the scripts sent.
+    """
+
+    def __init__(self, adb):
+        self.adb = adb
+        self.queuing = False
+        self.round_trips = 0
+        self._pending = []
+        self._futures = []
+        self._marker = "__ADB_BATCH_%s__" % uuid.uuid4().hex
+
+    def submit(self, command):
+        """Queue command; unless queuing, send the queue and return its output."""
+        future = ShellFuture(self, command)
+        self._pending.append(future)
+        self._futures.append(future)
+        if self.queuing:
+            return future
+        return future.result()
+
+    def _render(self, futures):
+        return "".join("{ %s\n} </dev/null; printf '\\n%s %%d\\n' $?\n" % (x.command, self._marker)
+                       for x in futures)
+
+    def flush(self):
+        """Send the queued commands and resolve their futures."""
+        while self._pending:
+            pending, self._pending = self._pending, []
+            for chunk in self.adb._split_for_command_line(pending, self._render, 0):
+                self._send(chunk)
+
+    def raise_unobserved(self):
+        """Raise the error of the first failed command nobody called result() on."""
+        for future in self._futures:
+            if not future.observed and (future.exception is not None or future.exit_code):
+                future.result()
+
+    def _send(self, futures):
+        self.round_trips += 1
+        exit_code = None
+        try:
+            output = self.adb._shell(self._render(futures))
+        except subprocess.CalledProcessError as e:
+            # A command called exit, the ones before it have their markers.
+            output, exit_code = _to_str(e.output or b"").strip(), e.returncode
+        except Exception as e:
+            for future in futures:
+                future._set(exception=e)
+            raise
+        parts = re.split(r'\n?%s (\d+)\n?' % self._marker, '\n' + output)
+        finished = len(parts) // 2
+        for i, future in enumerate(futures):
+            if i < finished:
+                future._set(parts[2 * i].strip(), int(parts[2 * i + 1]))
+            elif i == finished and exit_code is not None:
+                future._set(parts[-1].strip(), exit_code)
+            else:
+                future._set(exception=ADBException("Batch script ended before %r." % future.command))
+
+
+class DeviceRegistry(object):
+    """Process-wide cache of the attached devices, at most ttl seconds old.
+
+    The socket backend asks the adb server, the others run `adb devices`.
+    """
+
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def _list(self, source):
+        if source == "socket":
+            return ADBSocketClient.get_default().list_devices()
+        devices = ADB.list_devices()
+        if devices and devices[0].startswith("* daemon started"):
+            devices = ADB.list_devices()
+        return devices
+
+    def devices(self, backend="subprocess", max_age=None):
+        """Return the serials of the attached devices."""
+        source = "socket" if backend == "socket" else "adb"
+        if max_age is None:
+            max_age = self.ttl
+        with self._lock:
+            entry = self._devices.get(source)
+        if entry is not None and time.time() - entry[0] <= max_age:
+            return list(entry[1])
+        devices = self._list(source)
+        with self._lock:
+            self._devices[source] = (time.time(), devices)
+        return list(devices)
+
+    def invalidate(self):
+        with self._lock:
+            self._devices.clear()
+
+
+class ADBShellSession(object):
+    """One long-lived `adb shell` per device, commands are written to its stdin.
+
+    Every command is followed by a printf of a sentinel line carrying the exit
+    code, so output of consecutive commands can be told apart without spawning
+    a new adb process per call. The sentinel is printed as two halves so that
+    a shell echoing its input never produces a false match. Each command is
+    eval'ed in a subshell, so cd, variables, exit and syntax errors don't
+    outlive it, like with one `adb shell` per command.
+    """
+
+    def __init__(self, device, adb='adb'):
+        self.device = device
+        self.adb = adb
+        self._proc = None
+        self._lock = threading.Lock()
+        self._token = uuid.uuid4().hex[:12]
+        self._sentinel = re.compile(b"\r?\n__ADB_END_" + self._token.encode('ascii') + b"__ (\\d+)\r?\n")
+
+    def _start(self):
+        cmd = [self.adb, '-s', self.device, 'shell']
+        # In a process group of its own, so a kill also stops what adb started
+        # instead of leaving it to hold the output pipe open.
+        group = {'preexec_fn': os.setsid} if hasattr(os, 'setsid') else {}
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0, **group)
+
+    @staticmethod
+    def _kill_process(proc):
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except OSError:
+            pass
+
+    def _alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def _send(self, command):
+        # Through a quoted eval, a syntax error or an open quote in command fails
+        # in the subshell with an exit code instead of swallowing the sentinel.
+        script = "( eval '%s' ) </dev/null; printf '\\n%%s%%s %%s\\n' __ADB_ END_%s__ $?\n" % (
+            command.replace("'", "'\\''"), self._token)
+        self._proc.stdin.write(script.encode('utf-8') if not isinstance(script, bytes) else script)
+        self._proc.stdin.flush()
+
+    def _receive(self):
+        fd = self._proc.stdout.fileno()
+        buf = b""
+        while True:
+            match = self._sentinel.search(buf)
+            if match:
+                return buf[:match.start()], int(match.group(1))
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise ADBShellSessionException("adb shell on %s exited." % self.device)
+            buf += chunk
+
+    def execute(self, command, timeout=None):
+        """Run command in the session and return (output, exit code).
+
+        After timeout seconds the session is killed, to be restarted by the
+        next command, and ADBTimeoutException is raised.
+        """
+        with self._lock:
+            if not self._alive():
+                self._start()
+            try:
+                self._send(command)
+            except (IOError, OSError):
+                # The shell died between two calls, the command was not delivered.
+                self._kill()
+                self._start()
+                self._send(command)
+            expired = []
+            timer = None
+            if timeout is not None:
+                proc = self._proc
+                timer = threading.Timer(timeout, lambda: (expired.append(True), self._kill_process(proc)))
+                timer.start()
+            try:
+                return self._receive()
+            except ADBShellSessionException:
+                self._kill()
+                if expired:
+                    raise ADBTimeoutException("%s on %s did not finish within %.1f seconds."
+                                              % (command, self.device, timeout))
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    def check_output(self, command, timeout=None):
+        """Like subprocess.check_output: raise CalledProcessError on non-zero exit code."""
+        output, returncode = self.execute(command, timeout)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command, output)
+        return _to_str(output)
+
+    def _kill(self):
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                self._kill_process(self._proc)
+            self._proc.wait()
+            self._proc = None
+
+    def close(self):
+        with self._lock:
+            if self._alive():
+                try:
+                    self._proc.stdin.write(b"exit\n")
+                    self._proc.stdin.close()
+                except (IOError, OSError):
+                    pass
+            self._kill()
+
+class ApkInfo(object):
+    """Everything ADB.get_apk_* report about one APK, parsed once."""
+
+    fields = ('package_name', 'version_code', 'version_name', 'sdk_version',
+              'launchable_activity', 'label', 'permissions', 'native_code')
+
+    def __init__(self, **kwargs):
+        for field in self.fields:
+            setattr(self, field, kwargs.get(field))
+        self.permissions = list(self.permissions or [])
+        self.native_code = list(self.native_code or [])
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**dict((str(k), v) for k, v in data.items() if k in cls.fields))
+
+    def __eq__(self, other):
+        return isinstance(other, ApkInfo) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "ApkInfo(%s)" % ", ".join("%s=%r" % (f, getattr(self, f)) for f in self.fields)
+
+
+class ApkInfoCache(object):
+    """Memoize ApkInfo in memory and in a directory on disk.
+
+    In memory an APK is keyed by path, size and mtime. On disk the parsed
+    info is stored under the SHA-1 of the APK content, next to a small entry
+    mapping path, size and mtime to that hash, so an unchanged file is not
+    even hashed again and a copy of a known build at another path is not
+    parsed again.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get('ADB_APK_CACHE_DIR',
+                                       os.path.join(os.path.expanduser('~'), '.cache', 'adb_apk_info'))
+        self.directory = directory
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _content_hash(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    return digest.hexdigest()
+                digest.update(chunk)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, name, data):
+        # Write then rename, so concurrent CI workers never read half a file.
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            path = os.path.join(self.directory, name)
+            tmp = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+    def get(self, apk_path, parse):
+        """Return the ApkInfo of apk_path, calling parse(apk_path) only on a miss."""
+        path = os.path.abspath(apk_path)
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime)
+        with self._lock:
+            if key in self._memory:
+                return self._memory[key]
+        info = None
+        if self.directory:
+            stat_name = "stat-%s.json" % hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+            entry = self._read(stat_name)
+            content_hash = entry.get('sha1') if entry else None
+            if content_hash is None:
+                content_hash = self._content_hash(path)
+                self._write(stat_name, {'path': path, 'size': st.st_size, 'mtime': st.st_mtime, 'sha1': content_hash})
+            data = self._read("apk-%s.json" % content_hash)
+            if data is not None:
+                info = ApkInfo.from_dict(data)
+            else:
+                info = parse(path)
+                self._write("apk-%s.json" % content_hash, info.to_dict())
+        else:
+            info = parse(path)
+        with self._lock:
+            self._memory[key] = info
+        return info
+
+    def clear(self):
+        """Forget the in-memory entries, the disk cache is left alone."""
+        with self._lock:
+            self._memory.clear()
+
+
+class ApkManifestException(ADBException):
+    pass
+
+
+ResourceReference = namedtuple('ResourceReference', 'id')
+
+
+class ApkManifestReader(object):
+    """Read the same info as `aapt dump badging` without leaving the process.
+
+    The APK is opened as a zip and only AndroidManifest.xml is read, plus
+    resources.arsc when a value is a reference such as @string/app_name.
+    Both are binary resource chunks: a type (u16), a header size (u16) and
+    a total size (u32), little-endian, followed by the chunk body.
+    """
+
+    MAIN_ACTION = 'android.intent.action.MAIN'
+    LAUNCHER_CATEGORY = 'android.intent.category.LAUNCHER'
+    # android:* attribute resource ids, used because release builds may strip attribute names.
+    attribute_ids = {0x01010001: 'label', 0x01010003: 'name', 0x0101020c: 'minSdkVersion',
+                     0x0101021b: 'versionCode', 0x0101021c: 'versionName'}
+
+    CHUNK_STRING_POOL = 0x0001
+    CHUNK_TABLE = 0x0002
+    CHUNK_XML = 0x0003
+    CHUNK_XML_START_ELEMENT = 0x0102
+    CHUNK_XML_END_ELEMENT = 0x0103
+    CHUNK_XML_RESOURCE_MAP = 0x0180
+    CHUNK_TABLE_PACKAGE = 0x0200
+    CHUNK_TABLE_TYPE = 0x0201
+
+    TYPE_REFERENCE = 0x01
+    TYPE_STRING = 0x03
+    TYPE_INT_DEC = 0x10
+    TYPE_INT_BOOLEAN = 0x12
+    TYPE_LAST_INT = 0x1f
+
+    NO_ENTRY = 0xffffffff
+    ENTRY_FLAG_COMPLEX = 0x0001
+    TYPE_FLAG_SPARSE = 0x01
+    TYPE_FLAG_OFFSET16 = 0x02
+
+    def __init__(self, apk_path):
+        self.apk_path = apk_path
+        self._zip = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def _member(self, name):
+        try:
+            if self._zip is None:
+                self._zip = zipfile.ZipFile(self.apk_path)
+            return self._zip.read(name)
+        except (zipfile.BadZipfile, KeyError, IOError) as e:
+            raise ApkManifestException("Can't read %s from %s: %s" % (name, self.apk_path, e))
+
+    @staticmethod
+    def _chunks(data, start, end):
+        """Yield (type, offset, header size, size) of the chunks in data[start:end]."""
+        offset = start
+        while offset + 8 <= end:
+            chunk_type, header_size, size = struct.unpack_from('<HHI', data, offset)
+            if size < 8 or offset + size > end:
+                raise ApkManifestException("Corrupt chunk at offset %d." % offset)
+            yield chunk_type, offset, header_size, size
+            offset += size
+
+    @staticmethod
+    def _parse_string_pool(data, offset):
+        header_size = struct.unpack_from('<H', data, offset + 2)[0]
+        count, _, flags, strings_start, _ = struct.unpack_from('<5I', data, offset + 8)
+        offsets = struct.unpack_from('<%dI' % count, data, offset + header_size)
+        base = offset + strings_start
+        strings = []
+        for string_offset in offsets:
+            pos = base + string_offset
+            if flags & 0x100:
+                # UTF-8: length in chars then in bytes, each 1 or 2 bytes long.
+                for _ in range(2):
+                    length = struct.unpack_from('<B', data, pos)[0]
+                    if length & 0x80:
+                        length = ((length & 0x7f) << 8) | struct.unpack_from('<B', data, pos + 1)[0]
+                        pos += 2
+                    else:
+                        pos += 1
+                strings.append(data[pos:pos + length].decode('utf-8', 'replace'))
+            else:
+                length = struct.unpack_from('<H', data, pos)[0]
+                pos += 2
+                if length & 0x8000:
+                    length = ((length & 0x7fff) << 16) | struct.unpack_from('<H', data, pos)[0]
+                    pos += 2
+                strings.append(data[pos:pos + length * 2].decode('utf-16-le', 'replace'))
+        return strings
+
+    def _value(self, strings, raw, value_type, data):
+        if value_type == self.TYPE_STRING:
+            return strings[data]
+        if value_type == self.TYPE_REFERENCE:
+            return ResourceReference(data)
+        if value_type == self.TYPE_INT_BOOLEAN:
+            return 'true' if data else 'false'
+        if value_type == self.TYPE_INT_DEC:
+            return str(data - (1 << 32) if data & 0x80000000 else data)
+        if self.TYPE_INT_DEC < value_type <= self.TYPE_LAST_INT:
+            return '0x%08x' % data
+        if raw != self.NO_ENTRY:
+            return strings[raw]
+        return None
+
+    def _iter_elements(self, data):
+        """Yield ('start', tag, attributes) and ('end', tag, None) for the binary XML data."""
+        chunk_type, header_size, size = struct.unpack_from('<HHI', data, 0)
+        if chunk_type != self.CHUNK_XML:
+            raise ApkManifestException("%s has no binary AndroidManifest.xml." % self.apk_path)
+        strings = []
+        resource_ids = ()
+        for chunk_type, offset, header_size, size in self._chunks(data, header_size, min(size, len(data))):
+            if chunk_type == self.CHUNK_STRING_POOL:
+                strings = self._parse_string_pool(data, offset)
+            elif chunk_type == self.CHUNK_XML_RESOURCE_MAP:
+                resource_ids = struct.unpack_from('<%dI' % ((size - header_size) // 4), data, offset + header_size)
+            elif chunk_type == self.CHUNK_XML_START_ELEMENT:
+                pos = offset + header_size
+                _, name, attribute_start, attribute_size, attribute_count = struct.unpack_from('<IIHHH', data, pos)
+                attributes = {}
+                pos += attribute_start
+                for _ in range(attribute_count):
+                    _, key, raw, _, _, value_type, value = struct.unpack_from('<IIIHBBI', data, pos)
+                    name_of_id = self.attribute_ids.get(resource_ids[key]) if key < len(resource_ids) else None
+                    attributes[name_of_id or strings[key]] = self._value(strings, raw, value_type, value)
+                    pos += attribute_size
+                yield 'start', strings[name], attributes
+            elif chunk_type == self.CHUNK_XML_END_ELEMENT:
+                name = struct.unpack_from('<I', data, offset + header_size + 4)[0]
+                yield 'end', strings[name], None
+
+    def _resolve(self, references):
+        """Return {resource id: value} for the ResourceReference in references.
+
+        Values of the default configuration win, references to references are
+        followed a few levels deep.
+        """
+        data = self._member('resources.arsc')
+        table_type, table_header_size = struct.unpack_from('<HH', data, 0)
+        if table_type != self.CHUNK_TABLE:
+            raise ApkManifestException("%s has a corrupt resources.arsc." % self.apk_path)
+        wanted = set(x.id for x in references)
+        resolved = {}
+        for _ in range(5):
+            found = {}
+            strings = []
+            for chunk_type, offset, header_size, size in self._chunks(data, table_header_size, len(data)):
+                if chunk_type == self.CHUNK_STRING_POOL:
+                    strings = self._parse_string_pool(data, offset)
+                elif chunk_type == self.CHUNK_TABLE_PACKAGE:
+                    self._find_entries(data, offset, header_size, size, wanted, found)
+            wanted = set()
+            for res_id, (value_type, value) in found.items():
+                value = self._value(strings, self.NO_ENTRY, value_type, value)
+                resolved[res_id] = value
+                if isinstance(value, ResourceReference) and value.id not in resolved:
+                    wanted.add(value.id)
+            if not wanted:
+                break
+        for res_id in list(resolved):
+            value = resolved[res_id]
+            for _ in range(5):
+                if not isinstance(value, ResourceReference):
+                    break
+                value = resolved.get(value.id)
+            resolved[res_id] = value if not isinstance(value, ResourceReference) else None
+        return resolved
+
+    def _find_entries(self, data, offset, header_size, size, wanted, found):
+        """Collect (value type, value) of the wanted ids from one package chunk into found."""
+        package_id = struct.unpack_from('<I', data, offset + 8)[0]
+        for chunk_type, pos, type_header_size, _ in self._chunks(data, offset + header_size, offset + size):
+            if chunk_type != self.CHUNK_TABLE_TYPE:
+                continue
+            type_id, flags = struct.unpack_from('<BB', data, pos + 8)
+            entry_count, entries_start = struct.unpack_from('<II', data, pos + 12)
+            prefix = (package_id << 24) | (type_id << 16)
+            if not any(prefix <= x < prefix + 0x10000 for x in wanted):
+                continue
+            # ResTable_config starts at pos + 20, the locale is at bytes 8-11 of it.
+            is_default = data[pos + 28:pos + 32] == b'\0\0\0\0'
+            if flags & self.TYPE_FLAG_SPARSE:
+                pairs = struct.unpack_from('<%dH' % (entry_count * 2), data, pos + type_header_size)
+                offsets = dict((pairs[i], pairs[i + 1] * 4) for i in range(0, len(pairs), 2))
+            elif flags & self.TYPE_FLAG_OFFSET16:
+                raw = struct.unpack_from('<%dH' % entry_count, data, pos + type_header_size)
+                offsets = dict((i, x * 4) for i, x in enumerate(raw) if x != 0xffff)
+            else:
+                raw = struct.unpack_from('<%dI' % entry_count, data, pos + type_header_size)
+                offsets = dict((i, x) for i, x in enumerate(raw) if x != self.NO_ENTRY)
+            for res_id in wanted:
+                index = res_id - prefix
+                if not 0 <= index < 0x10000 or index not in offsets:
+                    continue
+                if res_id in found and not is_default:
+                    continue
+                entry = pos + entries_start + offsets[index]
+                entry_size, entry_flags = struct.unpack_from('<HH', data, entry)
+                if entry_flags & self.ENTRY_FLAG_COMPLEX:
+                    continue
+                value_type, value = struct.unpack_from('<BI', data, entry + entry_size + 3)
+                found[res_id] = (value_type, value)
+
+    def read_info(self):
+        """Return the ApkInfo of the APK."""
+        try:
+            return self._read_info()
+        except (struct.error, IndexError, UnicodeError) as e:
+            raise ApkManifestException("Can't parse %s: %s" % (self.apk_path, e))
+
+    def _read_info(self):
+        manifest = {}
+        sdk = {}
+        permissions = []
+        activities = []
+        stack = []
+        for event, tag, attributes in self._iter_elements(self._member('AndroidManifest.xml')):
+            if event == 'end':
+                if stack:
+                    stack.pop()
+                continue
+            parent = stack[-1] if stack else None
+            stack.append(tag)
+            if tag == 'manifest' and parent is None:
+                manifest = attributes
+            elif tag == 'uses-sdk' and parent == 'manifest':
+                sdk = attributes
+            elif tag == 'uses-permission' and parent == 'manifest':
+                permissions.append(attributes.get('name'))
+            elif tag in ('activity', 'activity-alias') and parent == 'application':
+                activities.append({'name': attributes.get('name'), 'label': attributes.get('label'),
+                                   'launchable': False, 'actions': set(), 'categories': set()})
+            elif tag == 'intent-filter' and parent in ('activity', 'activity-alias') and activities:
+                activities[-1]['actions'] = set()
+                activities[-1]['categories'] = set()
+            elif tag in ('action', 'category') and parent == 'intent-filter' and activities:
+                activity = activities[-1]
+                activity['actions' if tag == 'action' else 'categories'].add(attributes.get('name'))
+                if self.MAIN_ACTION in activity['actions'] and self.LAUNCHER_CATEGORY in activity['categories']:
+                    activity['launchable'] = True
+
+        launchable = [x for x in activities if x['launchable']]
+        activity = launchable[0] if launchable else None
+        values = [manifest.get('package'), manifest.get('versionCode'), manifest.get('versionName'),
+                  sdk.get('minSdkVersion'), activity and activity['name'], activity and activity['label']]
+        references = [x for x in values if isinstance(x, ResourceReference)]
+        if references:
+            resolved = self._resolve(references)
+            values = [resolved.get(x.id) if isinstance(x, ResourceReference) else x for x in values]
+        package_name, version_code, version_name, sdk_version, activity_name, label = values
+
+        if activity_name and package_name:
+            if activity_name.startswith('.'):
+                activity_name = package_name + activity_name
+            elif '.' not in activity_name:
+                activity_name = "%s.%s" % (package_name, activity_name)
+        if activity is not None and label is None:
+            label = ''
+
+        native_code = set()
+        for name in self._zip.namelist():
+            parts = name.split('/')
+            if len(parts) > 2 and parts[0] == 'lib' and parts[1]:
+                native_code.add(parts[1])
+
+        return ApkInfo(package_name=package_name,
+                       version_code=version_code,
+                       version_name=version_name,
+                       sdk_version=sdk_version,
+                       launchable_activity=activity_name,
+                       label=label,
+                       permissions=[x for x in permissions if x],
+                       native_code=sorted(native_code))
+
+
+class DevicePropertyCache(object):
+    """Snapshot of a device's `getprop` dump with a TTL.
+
+    find_like answers are memoized per regexp until the snapshot changes, so
+    repeated lookups don't scan every key and value again.
+    """
+
+    def __init__(self, ttl=60, volatile=()):
+        self.ttl = ttl
+        self.volatile = frozenset(volatile)
+        self._properties = None
+        self._items = ()
+        self._timestamp = 0
+        self._queries = {}
+        self._stale = set()
+        self._lock = threading.Lock()
+
+    def _is_fresh(self):
+        return self._properties is not None and time.time() - self._timestamp < self.ttl
+
+    def update(self, properties):
+        """Replace the snapshot with properties, a dict parsed from `getprop`."""
+        with self._lock:
+            self._properties = dict(properties)
+            self._items = tuple(self._properties.items())
+            self._timestamp = time.time()
+            self._queries = {}
+            self._stale = set()
+
+    def is_stale(self, key):
+        """Whether key must be read from the device rather than the snapshot."""
+        return key in self.volatile or key in self._stale
+
+    def set(self, key, value):
+        """Store a value fetched on its own, e.g. a volatile property."""
+        with self._lock:
+            self._stale.discard(key)
+            if self._properties is not None and self._properties.get(key) != value:
+                self._properties[key] = value
+                self._items = tuple(self._properties.items())
+                self._queries = {}
+
+    def get_all(self):
+        """Return the snapshot, or None if there is none or it expired."""
+        with self._lock:
+            return self._properties if self._is_fresh() else None
+
+    def invalidate(self, *keys):
+        """Mark keys stale, or drop the whole snapshot if no key is given."""
+        with self._lock:
+            if keys:
+                self._stale.update(keys)
+            else:
+                self._properties = None
+                self._items = ()
+                self._queries = {}
+                self._stale = set()
+
+    def find_like(self, regexp):
+        """Return {key: value} of the snapshot whose key or value matches regexp."""
+        with self._lock:
+            if regexp not in self._queries:
+                pattern = re.compile(regexp)
+                self._queries[regexp] = dict(
+                    (k, v) for k, v in self._items if pattern.search(k) or pattern.search(v))
+            return dict(self._queries[regexp])
+
+
+class ADBSocketException(ADBException):
+    pass
+
+
+class ADBSocketClient(object):
+    """Speak the adb host protocol with the local adb server over TCP.
+
+    Requests are a 4 hex digit length followed by the payload, the server
+    answers OKAY or FAIL plus a length-prefixed message. Device services are
+    reached by switching a fresh connection with host:transport:<serial>.
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, host='127.0.0.1', port=None, pool_size=4):
+        if port is None:
+            port = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_default(cls):
+        """Return the client shared by all ADB instances using the socket backend."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    @staticmethod
+    def _recv_exactly(sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ADBSocketException("Connection closed by adb server.")
+            data += chunk
+        return data
+
+    @staticmethod
+    def _recv_all(sock):
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+    def _connect(self, timeout=None):
+        try:
+            return socket.create_connection((self.host, self.port), timeout)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED:
+                raise
+        # Same as the adb binary: start the server on demand.
+        subprocess.call(['adb', '-P', str(self.port), 'start-server'])
+        return socket.create_connection((self.host, self.port), timeout)
+
+    def _request(self, sock, payload):
+        payload = payload.encode('utf-8') if not isinstance(payload, bytes) else payload
+        sock.sendall(("%04x" % len(payload)).encode('ascii') + payload)
+        status = self._recv_exactly(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            message = self._recv_exactly(sock, int(self._recv_exactly(sock, 4), 16))
+            raise ADBSocketException(message.decode('utf-8', 'replace'))
+        raise ADBSocketException("Unexpected adb server status %r." % status)
+
+    def host_command(self, payload):
+        """Run a host: service and return its length-prefixed answer."""
+        sock = self._connect()
+        try:
+            self._request(sock, payload)
+            return self._recv_exactly(sock, int(self._recv_exactly(sock, 4), 16))
+        finally:
+            sock.close()
+
+    def list_devices(self):
+        """List all devices attached, like ADB.list_devices."""
+        output = self.host_command("host:devices").decode('utf-8')
+        return [x.split("\t")[0] for x in output.splitlines() if x.strip()]
+
+    def transport(self, serial, timeout=None):
+        """Return a new connection switched to the device serial, reads time out after timeout seconds."""
+        sock = self._connect(timeout)
+        try:
+            self._request(sock, "host:transport:%s" % serial)
+        except ADBSocketException:
+            sock.close()
+            # The server refuses the transport of a device that is gone or offline.
+            ADB.forget_device(serial)
+            raise
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def pool(self, serial):
+        """Return the connection pool of the device serial."""
+        with self._lock:
+            if serial not in self._pools:
+                self._pools[serial] = ADBConnectionPool(self, serial, self.pool_size)
+            return self._pools[serial]
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
+
+
+class ADBConnectionPool(object):
+    """Bounded set of connections to one device.
+
+    At most size connections to the device are open at once. shell: and exec:
+    connections are consumed by the adb server, sync: connections stay open
+    and are handed out again until they fail.
+    """
+
+    SHELL_V2_STDOUT = 1
+    SHELL_V2_STDERR = 2
+    SHELL_V2_EXIT = 3
+
+    def __init__(self, client, serial, size=4):
+        self.client = client
+        self.serial = serial
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle_sync = []
+        self._lock = threading.Lock()
+        self._shell_v2 = True
+
+    @contextlib.contextmanager
+    def _slot(self):
+        self._slots.acquire()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _open_service(self, service, timeout=None):
+        sock = self.client.transport(self.serial, timeout)
+        try:
+            self.client._request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def shell(self, command, timeout=None):
+        """Run command with the shell service and return (output, exit code).
+
+        Uses the shell v2 protocol for the exit code, devices without it
+        fall back to the legacy shell: service and always report 0. Reads
+        raise socket.timeout after timeout seconds without data.
+        """
+        with self._slot():
+            if self._shell_v2:
+                sock = self.client.transport(self.serial, timeout)
+                try:
+                    self.client._request(sock, "shell,v2,raw:%s" % command)
+                except ADBSocketException:
+                    # Only the service was refused, the device itself is there.
+                    self._shell_v2 = False
+                    sock.close()
+                else:
+                    try:
+                        return self._read_shell_v2(sock)
+                    finally:
+                        sock.close()
+            sock = self._open_service("shell:%s" % command, timeout)
+            try:
+                return self.client._recv_all(sock), 0
+            finally:
+                sock.close()
+
+    def _read_shell_v2(self, sock):
+        stdout = []
+        while True:
+            header = sock.recv(1)
+            if not header:
+                raise ADBSocketException("Shell on %s closed without exit code." % self.serial)
+            header += self.client._recv_exactly(sock, 4)
+            packet_id, length = struct.unpack("<BI", header)
+            data = self.client._recv_exactly(sock, length)
+            if packet_id == self.SHELL_V2_STDOUT:
+                stdout.append(data)
+            elif packet_id == self.SHELL_V2_STDERR:
+                sys.stderr.write(data.decode('utf-8', 'replace'))
+            elif packet_id == self.SHELL_V2_EXIT:
+                return b"".join(stdout), ord(data[:1])
+
+    def check_output(self, command, timeout=None):
+        """Like subprocess.check_output: raise CalledProcessError on non-zero exit code."""
+        output, returncode = self.shell(command, timeout)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command, output)
+        return _to_str(output)
+
+    def exec_out(self, command, timeout=None):
+        """Run command with the exec: service and return its raw binary output."""
+        with self._slot():
+            sock = self._open_service("exec:%s" % command, timeout)
+            try:
+                return self.client._recv_all(sock)
+            finally:
+                sock.close()
+
+    @contextlib.contextmanager
+    def sync(self, timeout=None):
+        """Yield an ADBSyncConnection, reusing an idle one if possible."""
+        with self._slot():
+            with self._lock:
+                conn = self._idle_sync.pop() if self._idle_sync else None
+            if conn is None:
+                conn = ADBSyncConnection(self.client, self._open_service("sync:"))
+            conn.sock.settimeout(timeout)
+            try:
+                yield conn
+            except Exception:
+                conn.close()
+                raise
+            conn.sock.settimeout(None)
+            with self._lock:
+                self._idle_sync.append(conn)
+
+    def pull(self, remote, local, timeout=None):
+        with self.sync(timeout) as conn:
+            return conn.pull(remote, local)
+
+    def push(self, local, remote, mode=0o644, timeout=None):
+        with self.sync(timeout) as conn:
+            return conn.push(local, remote, mode)
+
+    def push_data(self, data, remote, mode=0o644, mtime=None, timeout=None):
+        with self.sync(timeout) as conn:
+            return conn.push_data(data, remote, mode, mtime)
+
+    def stat(self, remote):
+        with self.sync() as conn:
+            return conn.stat(remote)
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle_sync:
+                conn.close()
+            self._idle_sync = []
+
+
+class ADBSyncConnection(object):
+    """A sync: connection: 4 byte ids followed by little-endian lengths."""
+
+    MAX_DATA = 64 * 1024
+
+    def __init__(self, client, sock):
+        self.client = client
+        self.sock = sock
+
+    def _send(self, ident, payload):
+        payload = payload.encode('utf-8') if not isinstance(payload, bytes) else payload
+        self.sock.sendall(ident + struct.pack("<I", len(payload)) + payload)
+
+    def _read_header(self):
+        header = self.client._recv_exactly(self.sock, 8)
+        return header[:4], struct.unpack("<I", header[4:])[0]
+
+    def _fail(self, length):
+        message = self.client._recv_exactly(self.sock, length)
+        raise ADBSocketException(message.decode('utf-8', 'replace'))
+
+    def stat(self, remote):
+        """Return (mode, size, mtime) of remote, mode is 0 if it doesn't exist."""
+        self._send(b"STAT", remote)
+        data = self.client._recv_exactly(self.sock, 16)
+        if data[:4] != b"STAT":
+            raise ADBSocketException("Unexpected sync answer %r." % data[:4])
+        return struct.unpack("<III", data[4:])
+
+    def pull(self, remote, local):
+        """Copy remote to local, return the number of bytes received."""
+        self._send(b"RECV", remote)
+        size = 0
+        with open(local, 'wb') as f:
+            while True:
+                ident, length = self._read_header()
+                if ident == b"DATA":
+                    f.write(self.client._recv_exactly(self.sock, length))
+                    size += length
+                elif ident == b"DONE":
+                    return size
+                elif ident == b"FAIL":
+                    self._fail(length)
+                else:
+                    raise ADBSocketException("Unexpected sync answer %r." % ident)
+
+    def push(self, local, remote, mode=0o644):
+        """Copy local to remote, return the number of bytes sent."""
+        with open(local, 'rb') as f:
+            chunks = iter(lambda: f.read(self.MAX_DATA), b"")
+            return self._send_file(chunks, remote, mode, os.path.getmtime(local))
+
+    def push_data(self, data, remote, mode=0o644, mtime=None):
+        """Write the bytes data to remote, return the number of bytes sent."""
+        chunks = (data[i:i + self.MAX_DATA] for i in range(0, len(data), self.MAX_DATA))
+        return self._send_file(chunks, remote, mode, time.time() if mtime is None else mtime)
+
+    def _send_file(self, chunks, remote, mode, mtime):
+        self._send(b"SEND", "%s,%d" % (remote, mode))
+        size = 0
+        for data in chunks:
+            self._send(b"DATA", data)
+            size += len(data)
+        self.sock.sendall(b"DONE" + struct.pack("<I", int(mtime)))
+        ident, length = self._read_header()
+        if ident == b"FAIL":
+            self._fail(length)
+        return size
+
+    def close(self):
+        try:
+            self._send(b"QUIT", b"")
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class RawScreenshot(namedtuple('RawScreenshot', 'width height format pixels')):
+    """Uncompressed screencap frame, format is an android PixelFormat, RGBA_8888 is 1."""
+
+    bytes_per_pixel = {1: 4, 2: 4, 3: 3, 4: 2, 5: 4}
+
+
+class ProcessRecord(object):
+    """One line of `ps`, uid is None if it can't be told from the user name."""
+
+    __slots__ = ('pid', 'ppid', 'uid', 'rss', 'name')
+
+    def __init__(self, pid, ppid, uid, rss, name):
+        self.pid = pid
+        self.ppid = ppid
+        self.uid = uid
+        self.rss = rss
+        self.name = name
+
+    def __repr__(self):
+        return "ProcessRecord(pid=%r, ppid=%r, uid=%r, rss=%r, name=%r)" % (
+            self.pid, self.ppid, self.uid, self.rss, self.name)
+
+
+class ProcessTable(object):
+    """Snapshot of the processes of a device, indexed by pid, name and uid."""
+
+    # Android ids of the users listed by name in old `ps` output.
+    uid_of_user = {'root': 0, 'system': 1000, 'radio': 1001, 'bluetooth': 1002, 'graphics': 1003,
+                   'input': 1004, 'audio': 1005, 'camera': 1006, 'log': 1007, 'wifi': 1010,
+                   'media': 1013, 'dhcp': 1014, 'drm': 1019, 'gps': 1021, 'nfc': 1027,
+                   'shell': 2000, 'nobody': 9999}
+    re_app_user = re.compile(r'^u(\d+)_([ai])(\d+)$')
+
+    def __init__(self, records, timestamp=None):
+        self.records = list(records)
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.by_pid = {}
+        self.by_name = {}
+        self.by_uid = {}
+        for record in self.records:
+            self.by_pid[record.pid] = record
+            self.by_name.setdefault(record.name, []).append(record)
+            self.by_uid.setdefault(record.uid, []).append(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __contains__(self, pid):
+        return pid in self.by_pid
+
+    @classmethod
+    def _uid(cls, user):
+        if user.isdigit():
+            return int(user)
+        match = cls.re_app_user.match(user)
+        if match:
+            # u<user>_a<app> is an app, u<user>_i<n> an isolated process.
+            base = 10000 if match.group(2) == 'a' else 99000
+            return int(match.group(1)) * 100000 + base + int(match.group(3))
+        return cls.uid_of_user.get(user)
+
+    @classmethod
+    def parse(cls, output):
+        """Parse toybox `ps -A -o PID,PPID,UID,RSS,NAME` or old toolbox `ps` output."""
+        lines = output.splitlines()
+        if not lines:
+            return cls([])
+        header = lines[0].split()
+        records = []
+        for line in lines[1:]:
+            try:
+                if header[:1] == ['PID']:
+                    pid, ppid, uid, rss, name = line.split(None, 4)
+                    records.append(ProcessRecord(int(pid), int(ppid), cls._uid(uid), int(rss), name.strip()))
+                else:
+                    # USER PID PPID VSIZE RSS [PRIO ...] WCHAN PC S NAME
+                    fields = line.split()
+                    records.append(ProcessRecord(int(fields[1]), int(fields[2]), cls._uid(fields[0]),
+                                                 int(fields[4]), fields[-1]))
+            except (ValueError, IndexError):
+                continue
+        return cls(records)
+
+    def get(self, pid):
+        return self.by_pid.get(pid)
+
+    def find(self, name):
+        """Return the processes called name."""
+        return list(self.by_name.get(name, []))
+
+    def of_uid(self, uid):
+        return list(self.by_uid.get(uid, []))
+
+    def of_package(self, package_name):
+        """Return the processes of a package: its main process and package:suffix ones."""
+        prefix = package_name + ':'
+        return [x for x in self.records if x.name == package_name or x.name.startswith(prefix)]
+
+    def pid_of(self, name):
+        """Return the pid of the process called name, None if it isn't running."""
+        records = self.by_name.get(name)
+        return records[0].pid if records else None
+
+    def diff(self, previous):
+        """Return (added, removed) processes since previous, a restart shows up in both."""
+        current = set((x.pid, x.name) for x in self.records)
+        before = set((x.pid, x.name) for x in previous.records)
+        added = [x for x in self.records if (x.pid, x.name) not in before]
+        removed = [x for x in previous.records if (x.pid, x.name) not in current]
+        return added, removed
+
+
+class PackageIndex(object):
+    """Installed packages of a device with their uid and versionCode.
+
+    Built from one `pm list packages -U --show-versioncode`, uid and
+    versionCode are None when the device's pm can't list them.
+    """
+
+    # --show-versioncode needs Android 9, -U Android 7.
+    list_commands = ('pm list packages -U --show-versioncode 2>/dev/null || true',
+                     'pm list packages -U 2>/dev/null || true',
+                     'pm list packages 2>/dev/null || true')
+
+    def __init__(self, entries, options=None, timestamp=None):
+        self.names = [x[0] for x in entries]
+        self.options = options
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self._entries = dict((x[0], x[1:]) for x in entries)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, package_name):
+        return package_name in self._entries
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def uid(self, package_name):
+        entry = self._entries.get(package_name)
+        return entry[0] if entry else None
+
+    def version_code(self, package_name):
+        entry = self._entries.get(package_name)
+        return entry[1] if entry else None
+
+    @classmethod
+    def commands(cls, previous=None):
+        """Return the commands to try in turn, from the one that built previous on."""
+        if previous is not None and previous.options in cls.list_commands:
+            return cls.list_commands[cls.list_commands.index(previous.options):]
+        return cls.list_commands
+
+    @classmethod
+    def parse(cls, output, options=None):
+        """Parse lines like `package:com.foo versionCode:12 uid:10061`, options is the command that printed them."""
+        entries = []
+        for line in output.splitlines():
+            fields = line.strip().split()
+            if not fields or not fields[0].startswith('package:'):
+                continue
+            values = dict(x.split(':', 1) for x in fields[1:] if ':' in x)
+            try:
+                # A package installed for several users lists several uids.
+                uid = int(values['uid'].split(',')[0]) if 'uid' in values else None
+                version_code = int(values['versionCode']) if 'versionCode' in values else None
+            except ValueError:
+                uid = version_code = None
+            entries.append((fields[0][len('package:'):], uid, version_code))
+        return cls(entries, options)
+
+
+class ApkBundle(object):
+    """The APK files of one app, base first then splits, read from disk once.
+
+    Contents and hashes are kept, so installing the bundle to many devices
+    reads and hashes the files only here.
+    """
+
+    def __init__(self, paths):
+        if not isinstance(paths, (list, tuple)):
+            paths = [paths]
+        self.paths = list(paths)
+        self.data = []
+        for path in self.paths:
+            with open(path, 'rb') as f:
+                self.data.append(f.read())
+        self.sizes = [len(x) for x in self.data]
+        self.sha1s = [hashlib.sha1(x).hexdigest() for x in self.data]
+        info = ADB.get_apk_info(self.paths[0])
+        self.package_name = info.package_name
+        self.version_code = info.version_code
+
+
+class InstallResult(namedtuple('InstallResult', 'serial package_name action timings')):
+    """Outcome of ADB.install_package, action is 'skipped', 'installed' or 'reinstalled'.
+
+    timings maps the phases check, transfer and install to seconds.
+    """
+
+    @property
+    def skipped(self):
+        return self.action == 'skipped'
+
+
+class WaitResult(namedtuple('WaitResult', 'ok value waited polls')):
+    """Outcome of ADB.wait_until, true if the condition was met; waited is in seconds."""
+
+    def __bool__(self):
+        return self.ok
+
+    __nonzero__ = __bool__
+
+
+def _frame_sample(frame, step):
+    """Return every step-th pixel of every step-th row of a RawScreenshot."""
+    bpp = RawScreenshot.bytes_per_pixel.get(frame.format, 4)
+    if numpy is not None:
+        pixels = numpy.frombuffer(frame.pixels, numpy.uint8)
+        return pixels.reshape(frame.height, frame.width, bpp)[::step, ::step].astype(numpy.int16)
+    stride = frame.width * bpp
+    sample = bytearray()
+    for row in range(0, frame.height, step):
+        line = frame.pixels[row * stride:(row + 1) * stride]
+        for offset in range(bpp):
+            sample += line[offset::step * bpp]
+    return sample
+
+
+def _frame_difference(a, b):
+    """Return the mean absolute difference of two _frame_sample results, from 0 to 1."""
+    if len(a) != len(b) or (numpy is not None and a.shape != b.shape):
+        return 1.0
+    if not len(a):
+        return 0.0
+    if numpy is not None:
+        return float(numpy.abs(a - b).mean()) / 255
+    return float(sum(abs(x - y) for x, y in zip(a, b))) / len(a) / 255
+
+
+class LaunchTiming(namedtuple('LaunchTiming', 'activity cold launch_state this_time total_time wait_time elapsed')):
+    """Times of `am start -W` in milliseconds, None where the device doesn't report them.
+
+    launch_state is COLD, WARM or HOT on Android 10+, elapsed is the
+    seconds the host waited for the command.
+    """
+
+    re_field = re.compile(r'^(Status|LaunchState|ThisTime|TotalTime|WaitTime): *(\S+)', re.M)
+    # "Error: Activity class {...} does not exist." and "Error type 3", not a component named *Error*.
+    re_error = re.compile(r'^Error', re.M)
+
+    @classmethod
+    def parse(cls, output, activity, elapsed):
+        fields = dict(cls.re_field.findall(output))
+        if cls.re_error.search(output) or fields.get('Status', 'ok') != 'ok':
+            raise ADBException("am start -W %s failed: %s" % (activity, output.strip()))
+        times = [int(fields[x]) if x in fields else None for x in ('ThisTime', 'TotalTime', 'WaitTime')]
+        cold = fields.get('LaunchState') == 'COLD' if 'LaunchState' in fields else None
+        return cls(activity, cold, fields.get('LaunchState'), *(times + [elapsed]))
+
+
+class UINode(namedtuple('UINode', 'order text resource_id class_name description package bounds center clickable')):
+    """One node of a UI dump, bounds is (left, top, right, bottom) and center the point to tap."""
+
+    __slots__ = ()
+
+    keys = {'text': 'text', 'resource-id': 'resource_id', 'class': 'class_name',
+            'content-desc': 'description', 'package': 'package'}
+
+    def get(self, key, default=None):
+        """Return an attribute by its uiautomator dump name, like the dicts of dump_ui_nodes."""
+        value = getattr(self, self.keys.get(key, key), None)
+        return default if value is None else value
+
+
+class UITable(object):
+    """Nodes of a UI dump in document order, indexed by text, resource-id and class."""
+
+    re_bounds = re.compile(r'-?\d+')
+
+    def __init__(self, nodes, timestamp=None):
+        self.nodes = list(nodes)
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.by_text = {}
+        self.by_resource_id = {}
+        self.by_class = {}
+        for node in self.nodes:
+            for index, key in ((self.by_text, node.text), (self.by_resource_id, node.resource_id),
+                               (self.by_class, node.class_name)):
+                if key:
+                    index.setdefault(key, []).append(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    @classmethod
+    def parse(cls, xml):
+        """Parse `uiautomator dump` XML, dropping each element once it is read."""
+        if not isinstance(xml, bytes):
+            xml = xml.encode('utf-8')
+        nodes = []
+        for event, element in ElementTree.iterparse(io.BytesIO(xml), events=('start', 'end')):
+            if element.tag != 'node':
+                continue
+            if event == 'end':
+                element.clear()
+                continue
+            get = element.attrib.get
+            bounds = tuple(int(x) for x in cls.re_bounds.findall(get('bounds', '')))
+            if len(bounds) != 4:
+                bounds = (0, 0, 0, 0)
+            center = ((bounds[0] + bounds[2]) // 2, (bounds[1] + bounds[3]) // 2)
+            nodes.append(UINode(len(nodes), get('text'), get('resource-id'), get('class'), get('content-desc'),
+                                get('package'), bounds, center, get('clickable') == 'true'))
+        return cls(nodes)
+
+    def find(self, text=None, resource_id=None, class_name=None, description=None, contains=False):
+        """Return the nodes matching all given attributes, in document order."""
+        if resource_id is not None:
+            candidates = self.by_resource_id.get(resource_id, ())
+        elif text is not None and not contains:
+            candidates = self.by_text.get(text, ())
+        elif class_name is not None:
+            candidates = self.by_class.get(class_name, ())
+        else:
+            candidates = self.nodes
+
+        def matches(value, wanted):
+            if wanted is None:
+                return True
+            return value is not None and (wanted in value if contains else value == wanted)
+
+        return [x for x in candidates
+                if matches(x.text, text) and matches(x.description, description)
+                and (resource_id is None or x.resource_id == resource_id)
+                and (class_name is None or x.class_name == class_name)]
+
+    def find_one(self, text=None, resource_id=None, class_name=None, description=None, contains=False):
+        """Return the first node find returns, None if there is none."""
+        nodes = self.find(text, resource_id, class_name, description, contains)
+        return nodes[0] if nodes else None
+
+
+class GestureStep(namedtuple('GestureStep', 'at command')):
+    """A shell command of a GestureScript, run at seconds after the start."""
+
+
+class GestureScript(object):
+    """Timed input commands: `input ...` recorded from ADB methods, or `sendevent ...` from getevent.
+
+    render() makes a shell script that runs every step at its time, with
+    the device clock, and prints when each one actually started.
+    """
+
+    re_getevent = re.compile(r'^\[\s*(\d+\.\d+)\]\s+(/dev/input/\S+):\s+([0-9a-f]{4})\s+([0-9a-f]{4})\s+([0-9a-f]{8})\s*$', re.M)
+
+    # Waits with /proc/uptime, in hundredths of seconds, since mksh has no better clock.
+    player = (
+        'read u _ </proc/uptime; t0=${u%.*}${u#*.}\n'
+        'step() { read u _ </proc/uptime; w=$(($2 + t0 - ${u%.*}${u#*.}))\n'
+        '  [ $w -gt 0 ] && sleep $((w / 100)).$((w % 100 / 10))$((w % 10))\n'
+        '  read u _ </proc/uptime; echo "@$1 $((${u%.*}${u#*.} - t0))"; }\n')
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    @property
+    def duration(self):
+        return self.steps[-1].at if self.steps else 0.0
+
+    def render(self):
+        lines = [self.player]
+        for index, step in enumerate(self.steps):
+            lines.append("step %d %d; %s\n" % (index, int(round(step.at * 100)), step.command))
+        return "".join(lines)
+
+    @classmethod
+    def from_getevent(cls, output):
+        """Parse `getevent -t` output, one step per event report, times from the first event."""
+        steps = []
+        events = []
+        start = None
+        for match in cls.re_getevent.finditer(output):
+            timestamp, device = float(match.group(1)), match.group(2)
+            type_, code, value = [int(x, 16) for x in match.group(3, 4, 5)]
+            if start is None:
+                start = timestamp
+            if not events:
+                at = round(timestamp - start, 3)
+            # sendevent takes the value as signed, getevent prints it as unsigned.
+            events.append("sendevent %s %d %d %d" % (device, type_, code, value - (value >> 31 << 32)))
+            if type_ == 0 and code == 0:
+                steps.append(GestureStep(at, "; ".join(events)))
+                events = []
+        if events:
+            steps.append(GestureStep(at, "; ".join(events)))
+        return cls(steps)
+
+    def to_json(self):
+        return json.dumps([list(x) for x in self.steps])
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(GestureStep(at, command) for at, command in json.loads(text))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_json(f.read())
+
+
+class ReplayResult(namedtuple('ReplayResult', 'serial scheduled actual')):
+    """Scheduled and actual start times of the steps of a replay, in seconds, to 0.01 s."""
+
+    @property
+    def deviations(self):
+        return [round(a - s, 3) for s, a in zip(self.scheduled, self.actual)]
+
+    @property
+    def complete(self):
+        return len(self.actual) == len(self.scheduled)
+
+    @property
+    def max_deviation(self):
+        return max([abs(x) for x in self.deviations] or [0.0])
+
+    @property
+    def mean_deviation(self):
+        deviations = self.deviations
+        return sum(abs(x) for x in deviations) / len(deviations) if deviations else 0.0
+
+
+class PeriodicSampler(object):
+    """Call sample() every interval seconds in a background thread.
+
+    Ticks are scheduled from the start time, so a slow sample doesn't make
+    the following ones drift. Exceptions are counted, not raised.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.errors = 0
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        next_tick = time.time()
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+            next_tick += self.interval
+            now = time.time()
+            if next_tick < now:
+                # Too slow for the interval: skip the missed ticks instead of bursting.
+                next_tick = now
+            self._stop.wait(next_tick - now)
+
+    def sample(self):
+        raise NotImplementedError
+
+
+class TimeSeries(object):
+    """Columns of floats kept in array.array, appended one row at a time.
+
+    Missing values are NaN. With a capacity, the oldest rows are dropped
+    once it is exceeded, so a long run keeps bounded memory.
+    """
+
+    def __init__(self, columns, capacity=None):
+        self.columns = list(columns)
+        self.capacity = capacity
+        self._data = dict((x, array.array('d')) for x in self.columns)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data[self.columns[0]]) if self.columns else 0
+
+    def append(self, **values):
+        with self._lock:
+            for column in self.columns:
+                self._data[column].append(values.get(column, float('nan')))
+            if self.capacity and len(self) > self.capacity:
+                # Drop a quarter at once so trimming stays amortized O(1) per row.
+                excess = len(self) - self.capacity + self.capacity // 4
+                for column in self.columns:
+                    del self._data[column][:excess]
+
+    def column(self, name):
+        """Return a copy of one column as a list."""
+        with self._lock:
+            return self._data[name].tolist()
+
+    def rows(self):
+        """Return all rows as dicts, oldest first."""
+        with self._lock:
+            columns = [self._data[x] for x in self.columns]
+            return [dict(zip(self.columns, row)) for row in zip(*columns)]
+
+
+class Histogram(object):
+    """Log-linear histogram in the spirit of HdrHistogram.
+
+    Every power of two is split in sub_buckets buckets, so percentiles have a
+    relative error under 1/sub_buckets while memory only grows with the
+    range of the values, not their number.
+    """
+
+    def __init__(self, sub_buckets=64):
+        self.sub_buckets = sub_buckets
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._buckets = {}
+
+    def _key(self, value):
+        if value <= 0:
+            return (-1075, 0)
+        mantissa, exponent = math.frexp(value)
+        return (exponent, int((mantissa - 0.5) * 2 * self.sub_buckets))
+
+    def _value(self, key):
+        exponent, index = key
+        if exponent == -1075:
+            return 0.0
+        return math.ldexp(0.5 + (index + 0.5) / (2.0 * self.sub_buckets), exponent)
+
+    def add(self, value, count=1):
+        key = self._key(value)
+        self._buckets[key] = self._buckets.get(key, 0) + count
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for key, count in other._buckets.items():
+            self._buckets[key] = self._buckets.get(key, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """Return the value below which percent % of the values fall, None if empty."""
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for key in sorted(self._buckets):
+            seen += self._buckets[key]
+            if seen >= rank:
+                return min(max(self._value(key), self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'min': self.min, 'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+
+class CommandRecord(namedtuple('CommandRecord', 'category serial command elapsed output_size exit_status')):
+    """One adb command: elapsed in seconds, output_size in bytes, exit_status None if it never exited."""
+
+
+class CommandStats(object):
+    """Command hook keeping a latency Histogram per category and device.
+
+    Turn it on with `ADB.command_hook = CommandStats()` and off with
+    `ADB.command_hook = None`; while off commands are not even timed.
+    """
+
+    fields = ('category', 'serial', 'count', 'failures', 'output_bytes',
+              'total', 'mean', 'p50', 'p90', 'p99', 'max')
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        key = (record.category, record.serial)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {'histogram': Histogram(), 'failures': 0, 'output_bytes': 0}
+            stats['histogram'].add(record.elapsed)
+            stats['output_bytes'] += record.output_size
+            if record.exit_status != 0:
+                stats['failures'] += 1
+
+    def histogram(self, category=None, serial=None):
+        """Return the latencies of category and serial, None meaning all of them, merged."""
+        merged = Histogram()
+        with self._lock:
+            for (c, s), stats in self._stats.items():
+                if category in (None, c) and serial in (None, s):
+                    merged.merge(stats['histogram'])
+        return merged
+
+    def summary(self):
+        """Return a dict of fields per category and device, latencies in seconds, slowest total first."""
+        rows = []
+        with self._lock:
+            for (category, serial), stats in self._stats.items():
+                row = stats['histogram'].summary()
+                row.update(category=category, serial=serial, total=stats['histogram'].total,
+                           failures=stats['failures'], output_bytes=stats['output_bytes'])
+                rows.append(dict((x, row[x]) for x in self.fields))
+        return sorted(rows, key=lambda x: -x['total'])
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_csv(self):
+        lines = [",".join(self.fields)]
+        for row in self.summary():
+            lines.append(",".join("" if row[x] is None else str(row[x]) for x in self.fields))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class ScreenCapture(PeriodicSampler):
+    """Take screenshots in a background thread, keeping the last frames in a ring buffer.
+
+    Frames are (timestamp, data) where data is a RawScreenshot if raw, else
+    PNG bytes, so memory use is bounded by frames times the frame size.
+    """
+
+    def __init__(self, adb, frames=30, interval=0.2, raw=True):
+        PeriodicSampler.__init__(self, interval)
+        self.adb = adb
+        self.raw = raw
+        self._frames = deque(maxlen=frames)
+
+    def sample(self):
+        start = time.time()
+        self._frames.append((start, self.adb.get_screenshot_data(raw=self.raw)))
+
+    def frames(self):
+        """Return the frames in the buffer, oldest first."""
+        return list(self._frames)
+
+    def save(self, directory):
+        """Write the buffered frames to directory, raw ones as .rgba files, return their paths."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = []
+        for timestamp, data in self.frames():
+            name = time.strftime('%y%m%d_%H%M%S', time.localtime(timestamp)) + "_%03d" % (timestamp * 1000 % 1000)
+            if isinstance(data, RawScreenshot):
+                path = os.path.join(directory, "%s_%dx%d_%d.rgba" % (name, data.width, data.height, data.format))
+                data = data.pixels
+            else:
+                path = os.path.join(directory, name + ".png")
+            with open(path, 'wb') as f:
+                f.write(data)
+            paths.append(path)
+        return paths
+
+
+class CpuSampler(PeriodicSampler):
+    """Sample CPU usage of the device and of packages from /proc.
+
+    Each tick is one `cat` of /proc/stat and /proc/<pid>/stat, deltas are
+    computed at host like ADB._get_uptime_of_system_and_idle. The device
+    shell running the sampler reads its own /proc/$$/stat too, and that CPU
+    time is taken out of the device totals. Use the "session" backend for
+    high rates, so a tick doesn't cost a new adb process.
+
+    Values are percentages of all CPUs, as `dumpsys cpuinfo` reports them,
+    in self.series: time, total, user, kernel and <package>, <package>.user,
+    <package>.kernel per package.
+    """
+
+    def __init__(self, adb, packages=(), interval=0.1, capacity=None):
+        PeriodicSampler.__init__(self, interval)
+        self.adb = adb
+        self.packages = list(packages)
+        columns = ['time', 'total', 'user', 'kernel']
+        for package in self.packages:
+            columns.extend([package, package + '.user', package + '.kernel'])
+        self.series = TimeSeries(columns, capacity)
+        self._pids = {}
+        self._pid_lookups = {}
+        self._previous = None
+
+    @staticmethod
+    def _parse(output):
+        """Return (pid of the sampling shell, /proc/stat cpu jiffies, {pid: [utime, stime, cutime, cstime]})."""
+        lines = output.splitlines()
+        shell_pid = int(lines[0])
+        cpu = None
+        processes = {}
+        for line in lines[1:]:
+            if line.startswith('cpu '):
+                cpu = [int(x) for x in line.split()[1:8]]
+            elif ') ' in line:
+                # The command name in parentheses may contain spaces.
+                head, rest = line.rsplit(')', 1)
+                processes[int(head.split(' (', 1)[0])] = [int(x) for x in rest.split()[11:15]]
+        return shell_pid, cpu, processes
+
+    def _read(self):
+        now = time.time()
+        for package in self.packages:
+            # Look up a missing pid at most once a second, not on every tick.
+            if self._pids.get(package) is None and now - self._pid_lookups.get(package, 0) >= 1:
+                self._pid_lookups[package] = now
+                self._pids[package] = self.adb.get_pid(package)
+        paths = ['/proc/stat', '/proc/$$/stat'] + ['/proc/%d/stat' % x for x in self._pids.values() if x]
+        output = self.adb._adb_shell('echo $$; cat %s 2>/dev/null || true' % ' '.join(paths))
+        return self._parse(output)
+
+    def sample(self):
+        """Take one sample, return the row added to self.series (None for the first sample)."""
+        now = time.time()
+        shell_pid, cpu, processes = self._read()
+        previous, self._previous = self._previous, (shell_pid, cpu, processes)
+        if previous is None:
+            return None
+        previous_shell_pid, previous_cpu, previous_processes = previous
+        delta = [x - y for x, y in zip(cpu, previous_cpu)]
+        elapsed = float(sum(delta)) or 1.0
+        sampler = processes.get(shell_pid, [0, 0, 0, 0])
+        if shell_pid == previous_shell_pid and shell_pid in previous_processes:
+            sampler = [x - y for x, y in zip(sampler, previous_processes[shell_pid])]
+        # /proc/stat: user nice system idle iowait irq softirq
+        user = max(0, delta[0] + delta[1] - sampler[0] - sampler[2])
+        kernel = max(0, delta[2] + delta[5] + delta[6] - sampler[1] - sampler[3])
+        row = {'time': now, 'total': (user + kernel) * 100 / elapsed,
+               'user': user * 100 / elapsed, 'kernel': kernel * 100 / elapsed}
+        for package in self.packages:
+            pid = self._pids.get(package)
+            if pid not in processes:
+                # Not running or restarted, look the pid up again on the next tick.
+                self._pids[package] = None
+                continue
+            if pid in previous_processes:
+                utime = processes[pid][0] - previous_processes[pid][0]
+                stime = processes[pid][1] - previous_processes[pid][1]
+                row[package] = (utime + stime) * 100 / elapsed
+                row[package + '.user'] = utime * 100 / elapsed
+                row[package + '.kernel'] = stime * 100 / elapsed
+        self.series.append(**row)
+        return row
+
+
+class MemorySampler(PeriodicSampler):
+    """Sample PSS and RSS (kB) of packages.
+
+    Each tick reads /proc/<pid>/smaps_rollup of all packages in one shell
+    call. Processes whose rollup can't be read (kernel before 4.14, or not
+    readable by the shell user) fall back to `dumpsys meminfo <pid>`.
+    Values go to self.series as <package>.pss and <package>.rss, and to a
+    Histogram per package and value for the run summary.
+    """
+
+    re_rollup = re.compile(r'^(Rss|Pss):\s+(\d+) kB', re.M)
+    re_meminfo_total = re.compile(r'TOTAL PSS:\s*(\d+).*?TOTAL RSS:\s*(\d+)')
+    re_meminfo_table_total = re.compile(r'^\s*TOTAL\s+(\d+)', re.M)
+
+    def __init__(self, adb, packages, interval=1.0, capacity=3600):
+        PeriodicSampler.__init__(self, interval)
+        self.adb = adb
+        self.packages = list(packages)
+        columns = ['time']
+        for package in self.packages:
+            columns.extend([package + '.pss', package + '.rss'])
+        self.series = TimeSeries(columns, capacity)
+        self.histograms = dict((x, {'pss': Histogram(), 'rss': Histogram()}) for x in self.packages)
+
+    @classmethod
+    def _parse_rollups(cls, output):
+        """Parse `== <pid>` separated smaps_rollup into {pid: {'pss': kB, 'rss': kB}}."""
+        result = {}
+        for section in output.split('== ')[1:]:
+            pid, _, body = section.partition('\n')
+            values = dict((k.lower(), int(v)) for k, v in cls.re_rollup.findall(body))
+            if 'pss' in values:
+                result[int(pid)] = values
+        return result
+
+    @classmethod
+    def _parse_meminfo(cls, output):
+        """Parse `dumpsys meminfo <pid>` into {'pss': kB, 'rss': kB}, rss is missing before Android 10."""
+        match = cls.re_meminfo_total.search(output)
+        if match:
+            return {'pss': int(match.group(1)), 'rss': int(match.group(2))}
+        match = cls.re_meminfo_table_total.search(output)
+        return {'pss': int(match.group(1))} if match else {}
+
+    def sample(self):
+        """Take one sample, return the row added to self.series."""
+        now = time.time()
+        pids = dict((x, self.adb.get_pid(x)) for x in self.packages)
+        running = [x for x in pids.values() if x]
+        values = {}
+        if running:
+            script = "for p in %s; do echo \"== $p\"; cat /proc/$p/smaps_rollup; done 2>/dev/null || true"
+            values = self._parse_rollups(self.adb._adb_shell(script % " ".join(str(x) for x in running)))
+        row = {'time': now}
+        for package, pid in pids.items():
+            if not pid:
+                continue
+            memory = values.get(pid) or self._parse_meminfo(self.adb._adb_shell('dumpsys meminfo %d' % pid))
+            for name in ('pss', 'rss'):
+                if name in memory:
+                    row['%s.%s' % (package, name)] = memory[name]
+                    self.histograms[package][name].add(memory[name])
+        self.series.append(**row)
+        return row
+
+    def summary(self):
+        """Return {package: {'pss': summary, 'rss': summary}} of the run so far."""
+        return dict((p, dict((k, h.summary()) for k, h in x.items())) for p, x in self.histograms.items())
+
+
+class FrameStatsCollector(PeriodicSampler):
+    """Collect frame times of a package from `dumpsys gfxinfo <package> framestats`.
+
+    gfxinfo keeps about the last 120 frames, so polls overlap: rows are
+    parsed line by line and only frames with an IntendedVsync later than the
+    newest one already seen are kept. Frame time is FrameCompleted minus
+    IntendedVsync, a frame is janky above jank_threshold milliseconds. The
+    last capacity frames are kept in self.frames, all of them in
+    self.histogram.
+    """
+
+    def __init__(self, adb, package_name, interval=1.0, capacity=10000, jank_threshold=1000.0 / 60):
+        PeriodicSampler.__init__(self, interval)
+        self.adb = adb
+        self.package_name = package_name
+        self.jank_threshold = jank_threshold
+        self.frames = TimeSeries(['vsync', 'duration'], capacity)
+        self.histogram = Histogram()
+        self.janky = 0
+        self._last_vsync = 0
+
+    def _parse(self, output):
+        """Return [(IntendedVsync ns, duration ms)] of the frames not seen yet, oldest first."""
+        frames = []
+        columns = None
+        in_profile = False
+        for line in output.splitlines():
+            line = line.strip()
+            if line == '---PROFILEDATA---':
+                in_profile = not in_profile
+                columns = None
+                continue
+            if not in_profile or not line:
+                continue
+            fields = line.rstrip(',').split(',')
+            if columns is None:
+                columns = dict((name, i) for i, name in enumerate(fields))
+                continue
+            if fields[columns['Flags']] != '0':
+                continue
+            vsync = int(fields[columns['IntendedVsync']])
+            if vsync > self._last_vsync:
+                frames.append((vsync, (int(fields[columns['FrameCompleted']]) - vsync) / 1e6))
+        frames.sort()
+        return frames
+
+    def sample(self):
+        """Poll gfxinfo once, return the number of new frames."""
+        frames = self._parse(self.adb._adb_shell('dumpsys gfxinfo %s framestats' % self.package_name))
+        for vsync, duration in frames:
+            self.frames.append(vsync=vsync, duration=duration)
+            self.histogram.add(duration)
+            if duration > self.jank_threshold:
+                self.janky += 1
+        if frames:
+            self._last_vsync = frames[-1][0]
+        return len(frames)
+
+    def summary(self):
+        """Return frame count, janky frames and frame time percentiles (ms) of the run so far."""
+        result = self.histogram.summary()
+        result['janky'] = self.janky
+        result['jank_ratio'] = float(self.janky) / self.histogram.count if self.histogram.count else None
+        return result
+
+
+class LogcatRecord(namedtuple('LogcatRecord', 'time pid tid level tag message')):
+    """One logcat -v threadtime line, time is the device's "MM-DD HH:MM:SS.mmm"."""
+
+    __slots__ = ()
+
+
+class LogcatStream(object):
+    """Iterate over the LogcatRecords of one running logcat, made by ADB.logcat.
+
+    Lines are parsed as they arrive, lines that are not records, like
+    "--------- beginning of main", are skipped. Nothing is buffered beyond
+    the pipe or socket: a slow reader makes adb wait, and the device drops
+    old lines from its own log buffer. close() ends the iteration, from any
+    thread.
+    """
+
+    levels = 'VDIWEFA'
+    re_line = re.compile(r'^(\d\d-\d\d \d\d:\d\d:\d\d\.\d+)\s+(\d+)\s+(\d+)\s+([VDIWEFA])\s+(.*?)\s*: (.*)$')
+
+    def __init__(self, adb, args, pid=None, tags=None, level=None):
+        self.adb = adb
+        self.args = args
+        self.pid = pid
+        self.tags = tags
+        self.level = level
+        self._proc = None
+        self._sock = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _lines(self):
+        if self.adb.backend == "socket":
+            # adb logcat quotes its arguments for the device shell, do the same.
+            args = " ".join("'%s'" % x.replace("'", "'\\''") for x in self.args)
+            self._sock = ADBSocketClient.get_default().pool(self.adb.device)._open_service("exec:logcat %s" % args)
+            return iter(self._sock.makefile('rb').readline, b"")
+        self._proc = subprocess.Popen(['adb', '-s', self.adb.device, 'logcat'] + self.args, stdout=subprocess.PIPE)
+        return iter(self._proc.stdout.readline, b"")
+
+    def _wanted(self, record):
+        if self.pid is not None and record.pid != self.pid:
+            return False
+        if self.tags is not None:
+            level = self.tags.get(record.tag)
+            return level is not None and self.levels.find(record.level) >= self.levels.find(level)
+        return self.level is None or self.levels.find(record.level) >= self.levels.find(self.level)
+
+    @classmethod
+    def parse(cls, line):
+        """Return the LogcatRecord of a line, None if it is not one."""
+        match = cls.re_line.match(_to_str(line).rstrip('\r\n'))
+        if match is None:
+            return None
+        time_, pid, tid, level, tag, message = match.groups()
+        return LogcatRecord(time_, int(pid), int(tid), level, tag, message)
+
+    def __iter__(self):
+        if self._closed:
+            return
+        try:
+            for line in self._lines():
+                if self._closed:
+                    break
+                record = self.parse(line)
+                if record is not None and self._wanted(record):
+                    yield record
+        except (socket.error, ValueError):
+            # The socket or pipe was closed under the reader by close().
+            if not self._closed:
+                raise
+        finally:
+            self.close()
+
+    def close(self):
+        self._closed = True
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+
+
+class LogcatMonitor(object):
+    """Read logcat in a background thread into a ring buffer of capacity records.
+
+    watch(pattern, callback) calls callback(record, context) for records
+    whose "tag: message" matches the regexp pattern, context being the last
+    context records up to it. Callbacks run in the reader thread, so a slow
+    one holds the reader back instead of piling records up at host.
+    """
+
+    crash_patterns = (r'^AndroidRuntime: FATAL EXCEPTION', r'^ActivityManager: ANR in ', r'^DEBUG: \*\*\* \*\*\* \*\*\*')
+
+    def __init__(self, adb, capacity=10000, context=200, **filters):
+        self.adb = adb
+        self.filters = filters
+        self.context = context
+        self.records = deque(maxlen=capacity)
+        self.count = 0
+        self.errors = 0
+        self.last_error = None
+        self._watches = []
+        self._lock = threading.Lock()
+        self._stream = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def watch(self, pattern, callback):
+        self._watches.append((re.compile(pattern), callback))
+
+    def start(self):
+        if self._thread is None:
+            self._stream = self.adb.logcat(**self.filters)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stream.close()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        try:
+            for record in self._stream:
+                with self._lock:
+                    self.records.append(record)
+                    self.count += 1
+                text = "%s: %s" % (record.tag, record.message)
+                for regexp, callback in self._watches:
+                    if regexp.search(text):
+                        try:
+                            callback(record, self.tail(self.context))
+                        except Exception as e:
+                            self.errors += 1
+                            self.last_error = e
+        except Exception as e:
+            self.errors += 1
+            self.last_error = e
+
+    def tail(self, count=None):
+        """Return the last count records kept, all of them if count is None."""
+        with self._lock:
+            records = list(self.records)
+        return records if count is None else records[-count:]
+
+
+class ProcessMonitor(PeriodicSampler):
+    """Take a ProcessTable every interval and report what changed.
+
+    callback(added, removed) is called when processes started or went away;
+    a name in both lists restarted, e.g. after a crash. restarts counts them
+    per process name.
+    """
+
+    def __init__(self, adb, interval=1.0, callback=None):
+        PeriodicSampler.__init__(self, interval)
+        self.adb = adb
+        self.callback = callback
+        self.table = None
+        self.restarts = {}
+
+    def sample(self):
+        table = self.adb.get_process_table(max_age=0)
+        previous, self.table = self.table, table
+        if previous is None:
+            return [], []
+        added, removed = table.diff(previous)
+        for name in set(x.name for x in added) & set(x.name for x in removed):
+            self.restarts[name] = self.restarts.get(name, 0) + 1
+        if self.callback is not None and (added or removed):
+            self.callback(added, removed)
+        return added, removed
+
+
+class PopupWatcher(PeriodicSampler):
+    """Tap through popups with PopupRules without polling the UI hierarchy.
+
+    Each tick only reads the window focus. The UI is dumped when the focus
+    changed, once more on the next tick since a dialog may be drawn after it
+    is focused, after every tap, and every rescan seconds if rescan is set.
+    The interval is reset to min_interval on any change and grows by backoff
+    up to max_interval while nothing happens.
+
+    handled counts taps per rule name, dumps the UI dumps taken, and
+    callback(rule, node) is called after each tap.
+    """
+
+    def __init__(self, adb, rules, min_interval=0.2, max_interval=3.0, backoff=1.5, rescan=None, callback=None):
+        PeriodicSampler.__init__(self, min_interval)
+        self.adb = adb
+        self.rules = list(rules)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.rescan = rescan
+        self.callback = callback
+        self.handled = {}
+        self.dumps = 0
+        self.ticks = 0
+        self.last_change = time.time()
+        self._focus = None
+        self._recheck = False
+        self._last_dump = 0
+
+    def sample(self):
+        focus = self.adb.get_window_focus()
+        changed, self._focus = focus != self._focus, focus
+        due = changed or self._recheck or (self.rescan is not None and time.time() - self._last_dump >= self.rescan)
+        tapped = self._handle() if due else None
+        self.ticks += 1
+        self._recheck = changed or tapped is not None
+        if self._recheck:
+            self.last_change = time.time()
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return tapped
+
+    def _handle(self):
+        self._last_dump = time.time()
+        self.dumps += 1
+        nodes = self.adb.get_ui_table(max_age=0).nodes
+        for rule in self.rules:
+            node = rule.find(nodes)
+            if node is not None:
+                self.adb.touch_node(node)
+                self.handled[rule.name] = self.handled.get(rule.name, 0) + 1
+                if self.callback is not None:
+                    self.callback(rule, node)
+                return rule
+        return None
+
+    def wait_quiet(self, quiet=2.0, timeout=None):
+        """Block until neither the focus changed nor a popup was tapped for quiet seconds.
+
+        Waits at least quiet seconds and a tick, so what happened just before
+        the call is seen. Return False if timeout seconds passed first.
+        """
+        start, ticks = time.time(), self.ticks
+        self.interval = self.min_interval
+        while self.ticks == ticks or time.time() - max(self.last_change, start) < quiet:
+            if timeout is not None and time.time() - start >= timeout:
+                return False
+            time.sleep(min(0.1, self.min_interval))
+        return True
+
+
+class FleetResult(namedtuple('FleetResult', 'serial value exception elapsed')):
+    """Outcome of one device in a DeviceFleet run, elapsed is in seconds."""
+
+    @property
+    def ok(self):
+        return self.exception is None
+
+
+class DeviceFleet(object):
+    """Run the same work on many devices at once.
+
+    ADB instances are created lazily, inside the worker threads, and kept for
+    later runs. At most max_workers devices are busy at the same time.
+    """
+
+    def __init__(self, serials=None, max_workers=8, **adb_kwargs):
+        if serials is None:
+            serials = ADB.device_registry.devices(adb_kwargs.get('backend', 'subprocess'))
+        self.serials = list(serials)
+        self.max_workers = max_workers
+        self.adb_kwargs = adb_kwargs
+        self._adbs = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.serials)
+
+    def adb(self, serial):
+        """Return the ADB of serial, creating it on first use."""
+        with self._lock:
+            instance = self._adbs.get(serial)
+        if instance is None:
+            instance = ADB(serial, **self.adb_kwargs)
+            with self._lock:
+                instance = self._adbs.setdefault(serial, instance)
+        return instance
+
+    def subset(self, serials):
+        """Return a fleet of the given serials sharing this fleet's ADB instances."""
+        fleet = DeviceFleet(serials, self.max_workers, **self.adb_kwargs)
+        fleet._adbs = self._adbs
+        fleet._lock = self._lock
+        return fleet
+
+    def select(self, predicate, timeout=None):
+        """Return the subset of devices for which predicate(adb) is true, evaluated in parallel."""
+        results = self.run(predicate, timeout=timeout)
+        return self.subset([x for x in self.serials if results[x].ok and results[x].value])
+
+    def _call(self, serial, func, args, kwargs):
+        adb = self.adb(serial)
+        if callable(func):
+            return func(adb, *args, **kwargs)
+        return getattr(adb, func)(*args, **kwargs)
+
+    def imap(self, func, *args, **kwargs):
+        """Run func on every device, yield a FleetResult per device as soon as it is done.
+
+        func is an ADB method name, called with args and kwargs, or a callable
+        called as func(adb, *args, **kwargs). A device still running after
+        timeout seconds is reported with ADBTimeoutException and its worker
+        slot is given to the next device; the stuck call is abandoned.
+        """
+        timeout = kwargs.pop('timeout', None)
+        results = queue.Queue()
+        slots = threading.Semaphore(self.max_workers)
+        started = {}
+        finished = set()
+        lock = threading.Lock()
+
+        def finish(serial):
+            # True for the first of completion and timeout to report serial.
+            with lock:
+                if serial in finished:
+                    return False
+                finished.add(serial)
+            slots.release()
+            return True
+
+        def work(serial):
+            start = started[serial] = time.time()
+            try:
+                result = FleetResult(serial, self._call(serial, func, args, kwargs), None, time.time() - start)
+            except Exception as e:
+                result = FleetResult(serial, None, e, time.time() - start)
+            if finish(serial):
+                results.put(result)
+
+        def dispatch():
+            for serial in self.serials:
+                slots.acquire()
+                t = threading.Thread(target=work, args=(serial,))
+                t.daemon = True
+                t.start()
+
+        dispatcher = threading.Thread(target=dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+
+        for _ in range(len(self.serials)):
+            while True:
+                wait = None
+                if timeout is not None:
+                    now = time.time()
+                    running = [(s, t) for s, t in list(started.items()) if s not in finished]
+                    expired = [s for s, t in running if now - t >= timeout]
+                    for serial in expired:
+                        if finish(serial):
+                            results.put(FleetResult(serial, None, ADBTimeoutException(
+                                "%s did not finish within %s seconds." % (serial, timeout)), now - started[serial]))
+                    deadlines = [t + timeout - now for s, t in running if s not in expired]
+                    wait = max(min(deadlines), 0.01) if deadlines else 0.1
+                try:
+                    yield results.get(timeout=wait) if wait is not None else results.get()
+                    break
+                except queue.Empty:
+                    continue
+
+    def run(self, func, *args, **kwargs):
+        """Like imap but wait for all devices, return {serial: FleetResult}."""
+        return dict((x.serial, x) for x in self.imap(func, *args, **kwargs))
+
+    def install(self, apk_paths, skip_if_current=True, timeout=None, reinstall=False):
+        """Install APKs on all devices at once, see ADB.install_package.
+
+        The APKs are read and hashed once for the whole fleet. Returns
+        {serial: FleetResult} whose values are InstallResults.
+        """
+        return self.run('install_package', ApkBundle(apk_paths), skip_if_current, reinstall, timeout=timeout)
+
+    def replay(self, script, timeout=None):
+        """Replay a GestureScript on all devices at once, return {serial: FleetResult} of ReplayResults.
+
+        The player is pushed to every device first, so the replays start together.
+        """
+        self.run('prepare_gestures', script, timeout=timeout)
+        return self.run('play_gestures', script, timeout=timeout)
+
+    def benchmark_launch(self, activity, runs=10, modes=('cold', 'warm'), drop_caches=True, settle=1.0, timeout=None):
+        """Measure launches of activity on all devices, see LaunchBenchmark."""
+        return LaunchBenchmark(self, activity, runs, modes, drop_caches, settle).run(timeout)
+
+
+class LaunchBenchmark(object):
+    """Launch an activity runs times per mode on every device of a fleet.
+
+    Devices run in parallel, each one launch at a time. cold launches
+    force-stop the app and, if drop_caches and adbd runs as root, drop
+    the page cache first; warm launches go home and bring the running app
+    back. settle seconds pass between launches. Timings are kept per
+    (serial, mode), failed launches in errors.
+    """
+
+    fields = ('serial', 'mode', 'count', 'min', 'mean', 'p50', 'p90', 'max', 'errors')
+
+    def __init__(self, fleet, activity, runs=10, modes=('cold', 'warm'), drop_caches=True, settle=1.0):
+        self.fleet = fleet
+        self.activity = activity
+        self.runs = runs
+        self.modes = modes
+        self.drop_caches = drop_caches
+        self.settle = settle
+        self.timings = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def run(self, timeout=None):
+        """Run the launches, return self; a device failing as a whole is reported in errors."""
+        for result in self.fleet.imap(self._run_device, timeout=timeout):
+            if not result.ok:
+                self._record(result.serial, None, None, result.exception)
+        return self
+
+    def _run_device(self, adb):
+        for mode in self.modes:
+            if mode == 'warm':
+                # Make sure the process is there to be warm.
+                adb.start_activity_timed(self.activity)
+                time.sleep(self.settle)
+            for _ in range(self.runs):
+                try:
+                    if mode == 'cold':
+                        if self.drop_caches:
+                            adb.drop_caches()
+                        timing = adb.start_activity_timed(self.activity, cold=True)
+                    else:
+                        adb.key_home()
+                        time.sleep(self.settle)
+                        timing = adb.start_activity_timed(self.activity)
+                except ADBException as e:
+                    self._record(adb.device, mode, None, e)
+                else:
+                    self._record(adb.device, mode, timing, None)
+                time.sleep(self.settle)
+
+    def _record(self, serial, mode, timing, error):
+        with self._lock:
+            if error is not None:
+                self.errors.setdefault((serial, mode), []).append(error)
+            else:
+                self.timings.setdefault((serial, mode), []).append(timing)
+
+    def summary(self, field='total_time'):
+        """Return a dict of fields per device and mode, over the field of LaunchTiming in milliseconds."""
+        rows = []
+        with self._lock:
+            for key in sorted(set(self.timings) | set(self.errors), key=lambda x: (x[0], x[1] or '')):
+                histogram = Histogram()
+                for timing in self.timings.get(key, ()):
+                    value = getattr(timing, field)
+                    if value is not None:
+                        histogram.add(value)
+                row = histogram.summary()
+                row.update(serial=key[0], mode=key[1], errors=len(self.errors.get(key, ())))
+                rows.append(dict((x, row[x]) for x in self.fields))
+        return rows
+
+    def to_json(self, field='total_time'):
+        return json.dumps(self.summary(field), indent=2)
+
+    def to_csv(self, field='total_time'):
+        lines = [",".join(self.fields)]
+        for row in self.summary(field):
+            lines.append(",".join("" if row[x] is None else str(row[x]) for x in self.fields))
+        return "\n".join(lines) + "\n"
+
+
+ADB.device_registry = DeviceRegistry()
+
+
 if __name__ == '__main__':
     adb = ADB()
     adb.wifienableordis(False)
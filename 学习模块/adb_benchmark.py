@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of the ADB wrapper against simulated devices.
+
+A fake `adb` executable and a fake adb server are generated in a temporary
+directory. Device commands run in a local /bin/sh, with fake getprop, input,
+am, pm, screencap, dumpsys and ps first on its PATH, so no device is needed.
+Every adb invocation and every adb server connection waits --latency seconds
+first, like a round trip to a real device. A "session" shell only waits once.
+
+Usage:
+    python adb_benchmark.py [--latency 0.005] [--devices 4] [--repeat 30]
+                            [--backends subprocess,session,socket]
+                            [--output results.json] [--compare baseline.json]
+    python adb_benchmark.py --device SERIAL [--text TEXT]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from adb import ADB, ADBSocketClient, CpuSampler, DeviceFleet, Histogram
+
+
+def bench_keystrokes(adb, text, repeat=3):
+    """Compare keystrokes per second of one keyevent per char with send_keys."""
+    keycodes = [adb.keycodes_of_char[x] for x in text]
+    result = {}
+
+    start = time.time()
+    for _ in range(repeat):
+        for keycode in keycodes:
+            adb._keyevent(keycode)
+    result['per_key'] = len(keycodes) * repeat / (time.time() - start)
+
+    start = time.time()
+    for _ in range(repeat):
+        adb.send_keys(keycodes)
+    result['send_keys'] = len(keycodes) * repeat / (time.time() - start)
+    return result
+
+
+FAKE_ADB = r"""#!/bin/sh
+[ -n "$FAKE_ADB_LATENCY" ] && sleep "$FAKE_ADB_LATENCY"
+if [ "$1" = "devices" ]; then
+    echo 'List of devices attached'
+    for d in $FAKE_ADB_DEVICES; do printf '%s\tdevice\n' $d; done
+    exit 0
+fi
+[ "$1" = "-s" ] && shift 2
+cmd=$1; shift
+PATH=$FAKE_DEVICE_BIN:$PATH; export PATH
+case "$cmd" in
+    shell) [ $# -eq 0 ] && exec /bin/sh; exec /bin/sh -c "$*";;
+    exec-out) exec /bin/sh -c "$*";;
+    *) echo "fake adb: $cmd is not simulated" >&2; exit 1;;
+esac
+"""
+
+DEVICE_SCRIPTS = {
+    'getprop': r"""#!/bin/sh
+if [ $# -eq 0 ]; then
+    printf '[ro.build.version.release]: [9]\n[ro.build.version.sdk]: [28]\n'
+    printf '[ro.product.model]: [Simulated]\n[ro.product.name]: [simulated]\n'
+    i=0; while [ $i -lt 300 ]; do printf '[sys.simulated.prop%d]: [%d]\n' $i $i; i=$((i+1)); done
+    exit 0
+fi
+case "$1" in
+    ro.build.version.release) echo 9;;
+    ro.build.version.sdk) echo 28;;
+    ro.product.model) echo Simulated;;
+    ro.product.name) echo simulated;;
+    *) echo;;
+esac
+""",
+    'am': "#!/bin/sh\n",
+    'input': "#!/bin/sh\n",
+    'pm': r"""#!/bin/sh
+[ "$1" = list ] || { echo Success; exit 0; }
+i=0; while [ $i -lt 150 ]; do
+    echo "package:com.simulated.app$i versionCode:$i uid:$((10000+i))"; i=$((i+1))
+done
+echo "package:com.example.app versionCode:42 uid:10200"
+""",
+    'screencap': r"""#!/bin/sh
+# A 1080x1920 RGBA frame, or 2 MB of "PNG".
+[ "$1" = -p ] && exec head -c 2000000 /dev/zero
+printf '\070\004\000\000\200\007\000\000\001\000\000\000'
+head -c 8294400 /dev/zero
+""",
+    'dumpsys': r"""#!/bin/sh
+echo "  mCurrentFocus=Window{1 u0 com.example.app/com.example.app.MainActivity}"
+echo "  mFocusedApp=AppWindowToken{2 token=Token{3 ActivityRecord{4 u0 com.example.app/.MainActivity t5}}}"
+""",
+    'ps': r"""#!/bin/sh
+if [ "$1" = -A ]; then
+    echo "  PID  PPID   UID   RSS NAME"
+    echo "    1     0 10200  5000 com.example.app"
+    exit 0
+fi
+# Like Android 8.0+, plain ps only lists the processes of the shell.
+echo "USER PID PPID VSZ RSS WCHAN ADDR S NAME"
+echo "shell 2 1 100 200 0 0 S sh"
+""",
+}
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+class FakeADBServerHandler(socketserver.BaseRequestHandler):
+    """Answers host:devices, host:transport, shell,v2, shell:, exec: and sync:.
+
+    Like the shell commands, sync: works on the local file system.
+    """
+
+    def _read_request(self):
+        return _recv_exactly(self.request, int(_recv_exactly(self.request, 4), 16)).decode('utf-8')
+
+    def _fail(self, message):
+        message = message.encode('utf-8')
+        self.request.sendall(b"FAIL" + ("%04x" % len(message)).encode('ascii') + message)
+
+    def _run(self, command):
+        proc = subprocess.Popen(['/bin/sh', '-c', command], stdout=subprocess.PIPE, env=self.server.env)
+        return proc.communicate()[0], proc.returncode
+
+    def _sync_reply(self, ident, data=b""):
+        self.request.sendall(ident + struct.pack("<I", len(data)) + data)
+
+    def _sync(self):
+        """Serve STAT, RECV, SEND and QUIT requests until the client quits."""
+        while True:
+            ident, length = struct.unpack("<4sI", _recv_exactly(self.request, 8))
+            if ident == b"QUIT":
+                return
+            path = _recv_exactly(self.request, length).decode('utf-8')
+            if ident == b"STAT":
+                try:
+                    st = os.stat(path)
+                    stat = (st.st_mode, st.st_size, int(st.st_mtime))
+                except OSError:
+                    stat = (0, 0, 0)
+                self.request.sendall(b"STAT" + struct.pack("<III", *stat))
+            elif ident == b"RECV":
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except (IOError, OSError) as e:
+                    self._sync_reply(b"FAIL", str(e).encode('utf-8'))
+                    continue
+                for i in range(0, len(data), 64 * 1024):
+                    self._sync_reply(b"DATA", data[i:i + 64 * 1024])
+                self._sync_reply(b"DONE")
+            elif ident == b"SEND":
+                path, mode = path.rsplit(',', 1)
+                chunks = []
+                while True:
+                    ident, length = struct.unpack("<4sI", _recv_exactly(self.request, 8))
+                    if ident != b"DATA":
+                        break
+                    chunks.append(_recv_exactly(self.request, length))
+                try:
+                    with open(path, 'wb') as f:
+                        f.write(b"".join(chunks))
+                    os.chmod(path, int(mode) & 0o777)
+                    os.utime(path, (length, length))
+                except (IOError, OSError) as e:
+                    self._sync_reply(b"FAIL", str(e).encode('utf-8'))
+                    continue
+                self._sync_reply(b"OKAY")
+            else:
+                return self._sync_reply(b"FAIL", b"unknown sync request")
+
+    def handle(self):
+        try:
+            request = self._read_request()
+            if request == 'host:devices':
+                body = "".join("%s\tdevice\n" % x for x in self.server.serials).encode('utf-8')
+                self.request.sendall(b"OKAY" + ("%04x" % len(body)).encode('ascii') + body)
+                return
+            if not request.startswith('host:transport:'):
+                return self._fail("unknown service %s" % request)
+            if request.split(':', 2)[2] not in self.server.serials:
+                return self._fail("device not found")
+            self.request.sendall(b"OKAY")
+            request = self._read_request()
+            time.sleep(self.server.latency)
+            if request.startswith('shell,v2,raw:'):
+                self.request.sendall(b"OKAY")
+                output, returncode = self._run(request.split(':', 1)[1])
+                if output:
+                    self.request.sendall(struct.pack("<BI", 1, len(output)) + output)
+                self.request.sendall(struct.pack("<BIB", 3, 1, returncode & 0xff))
+            elif request.startswith('shell:') or request.startswith('exec:'):
+                self.request.sendall(b"OKAY")
+                self.request.sendall(self._run(request.split(':', 1)[1])[0])
+            elif request == 'sync:':
+                self.request.sendall(b"OKAY")
+                self._sync()
+            else:
+                self._fail("%s is not simulated" % request)
+        except (EOFError, socket.error):
+            pass
+
+
+class FakeADBServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, serials, latency, env):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeADBServerHandler)
+        self.serials = serials
+        self.latency = latency
+        self.env = env
+
+
+class SimulatedDevices(object):
+    """Context manager pointing ADB at count simulated devices.
+
+    Inside it, the fake adb is first on PATH and ANDROID_ADB_SERVER_PORT is
+    the fake adb server, for all three ADB backends.
+    """
+
+    def __init__(self, count=4, latency=0.0):
+        self.serials = ["sim%02d" % i for i in range(count)]
+        self.latency = latency
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix='adb_benchmark_')
+        device_bin = os.path.join(self.directory, 'device')
+        os.mkdir(device_bin)
+        scripts = [(os.path.join(self.directory, 'adb'), FAKE_ADB)]
+        scripts += [(os.path.join(device_bin, name), body) for name, body in DEVICE_SCRIPTS.items()]
+        for path, body in scripts:
+            with open(path, 'w') as f:
+                f.write(body)
+            os.chmod(path, 0o755)
+
+        self._environ = dict(os.environ)
+        os.environ['PATH'] = self.directory + os.pathsep + os.environ.get('PATH', '')
+        os.environ['FAKE_DEVICE_BIN'] = device_bin
+        os.environ['FAKE_ADB_DEVICES'] = " ".join(self.serials)
+        os.environ['FAKE_ADB_LATENCY'] = str(self.latency) if self.latency else ""
+        env = dict(os.environ, PATH=device_bin + os.pathsep + os.environ['PATH'])
+        self.server = FakeADBServer(self.serials, self.latency, env)
+        os.environ['ANDROID_ADB_SERVER_PORT'] = str(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        ADBSocketClient._default = None
+        ADB.device_registry.invalidate()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        if ADBSocketClient._default is not None:
+            ADBSocketClient._default.close()
+            ADBSocketClient._default = None
+        ADB.device_registry.invalidate()
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def measure(func, repeat):
+    """Call func repeat times, return ops/s and latency percentiles in milliseconds."""
+    func()
+    histogram = Histogram()
+    start = time.time()
+    for _ in range(repeat):
+        t = time.time()
+        func()
+        histogram.add(time.time() - t)
+    elapsed = time.time() - start
+    result = {'ops': repeat, 'seconds': elapsed, 'ops_per_sec': repeat / elapsed if elapsed else None}
+    for name in ('p50', 'p90', 'p99', 'max'):
+        value = histogram.max if name == 'max' else histogram.percentile(int(name[1:]))
+        result[name + '_ms'] = value * 1000
+    return result
+
+
+def benchmarks(adb, serials, backend, text):
+    """Return {name: callable} of the operations measured on one backend."""
+    fleet = DeviceFleet(serials, backend=backend)
+    sampler = CpuSampler(adb, ['com.example.app'])
+
+    def getprop():
+        adb.invalidate_device_properties('ro.product.model')
+        adb.get_device_product_model()
+
+    def list_packages():
+        adb.invalidate_package_index()
+        adb.list_packages()
+
+    def fanout_getprop(device):
+        device.invalidate_device_properties('ro.product.model')
+        return device.get_device_product_model()
+
+    return {
+        'getprop_cached': adb.get_device_product_model,
+        'getprop': getprop,
+        'keyevent': adb.key_back,
+        'input_text': lambda: adb.input_text(text, wait=0),
+        'list_packages': list_packages,
+        'screenshot': adb.get_screenshot_data,
+        'cpu_sample': sampler.sample,
+        'fanout_getprop': lambda: fleet.run(fanout_getprop),
+    }
+
+
+def run_suite(backends=('subprocess', 'session', 'socket'), devices=4, latency=0.0, repeat=30,
+              only=None, text="the quick brown fox 0123456789"):
+    """Run the benchmarks on each backend, return a JSON-able dict."""
+    results = {}
+    with SimulatedDevices(devices, latency) as simulated:
+        for backend in backends:
+            adb = ADB(simulated.serials[0], backend=backend)
+            try:
+                results[backend] = {}
+                for name, func in sorted(benchmarks(adb, simulated.serials, backend, text).items()):
+                    if only and name not in only:
+                        continue
+                    results[backend][name] = measure(func, repeat)
+            finally:
+                adb.close()
+    return {'meta': _meta(devices=devices, latency=latency, repeat=repeat), 'results': results}
+
+
+def _meta(**params):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=open(os.devnull, 'w')).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    params.update(commit=commit, python=platform.python_version(), time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    return params
+
+
+def report(suite, baseline=None):
+    """Format the results, with the ops/s ratio to a baseline suite if given."""
+    lines = ["%-12s %-16s %10s %9s %9s %9s %8s" % ('backend', 'benchmark', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms',
+                                                    'vs base')]
+    for backend, results in sorted(suite['results'].items()):
+        for name, result in sorted(results.items()):
+            ratio = ""
+            old = (baseline or {}).get('results', {}).get(backend, {}).get(name)
+            if old and old.get('ops_per_sec') and result['ops_per_sec']:
+                ratio = "%.2fx" % (result['ops_per_sec'] / old['ops_per_sec'])
+            lines.append("%-12s %-16s %10.1f %9.2f %9.2f %9.2f %8s" % (
+                backend, name, result['ops_per_sec'], result['p50_ms'], result['p90_ms'], result['p99_ms'], ratio))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ADB wrapper against simulated devices.")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated round trip in seconds")
+    parser.add_argument('--devices', type=int, default=4, help="simulated devices, for fan-out")
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--backends', default='subprocess,session,socket')
+    parser.add_argument('--only', help="comma separated benchmark names")
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--compare', help="JSON results of an earlier run")
+    parser.add_argument('--device', help="measure keystrokes on this real device instead")
+    parser.add_argument('--text', default="the quick brown fox 0123456789")
+    args = parser.parse_args(argv)
+
+    if args.device:
+        for name, rate in sorted(bench_keystrokes(ADB(args.device), args.text).items()):
+            print("%-10s %8.1f keystrokes/s" % (name, rate))
+        return
+
+    suite = run_suite(args.backends.split(','), args.devices, args.latency, args.repeat,
+                      args.only.split(',') if args.only else None, args.text)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(report(suite, baseline))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(suite, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""asyncio version of the ADB wrapper, needs Python 3.7+.
+
+Parsing is shared with adb.ADB, only the I/O is asynchronous. Commands run
+as asyncio subprocesses, or over asyncio streams to the adb server with
+backend="socket", so hundreds of them can be in flight from one event loop.
+"""
+
+import asyncio
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+import weakref
+
+from adb import (ADB, ADBException, ADBNoDeviceFoundException, ADBSocketException, DevicePropertyCache, PackageIndex,
+                 ProcessTable, _to_str)
+
+
+class AsyncADB(object):
+    """Coroutine mirror of ADB, create it with `await AsyncADB.create(device)`.
+
+    At most device_concurrency commands run on one device at a time, whatever
+    the number of AsyncADB instances bound to it. Cancelling a coroutine kills
+    its adb process or closes its adb server connection.
+    """
+
+    device_concurrency = 8
+    # Per loop semaphores of loops that take no attributes, like uvloop's.
+    _semaphores = weakref.WeakKeyDictionary()
+
+    max_shell_command_length = ADB.max_shell_command_length
+    keycodes_of_char = ADB.keycodes_of_char
+    volatile_properties = ADB.volatile_properties
+
+    _split_for_command_line = ADB._split_for_command_line
+    _android_major_version = ADB._android_major_version
+    _supports_multiple_keyevents = ADB._supports_multiple_keyevents
+    _quote_input_text = staticmethod(ADB._quote_input_text)
+
+    def __init__(self, device, backend="subprocess", property_cache_ttl=60):
+        if backend not in ("subprocess", "socket"):
+            raise ADBException("Unknown backend %s." % backend)
+        self.device = device
+        self.backend = backend
+        self.android_version = None
+        self._properties = DevicePropertyCache(property_cache_ttl, self.volatile_properties)
+        self._properties_lock = asyncio.Lock()
+        self._ps_columns = None
+
+    @classmethod
+    async def create(cls, device=None, backend="subprocess", property_cache_ttl=60):
+        """Bind to a device, like ADB.__init__."""
+        devices = await cls.list_devices(backend)
+        if not devices:
+            raise ADBNoDeviceFoundException("No device attached.")
+        if device is None:
+            device = devices[0]
+        elif device not in devices:
+            raise ADBNoDeviceFoundException("Device %s not found." % device)
+        self = cls(device, backend, property_cache_ttl)
+        self.android_version = await self._get_device_prop('ro.build.version.release')
+        return self
+
+    # ------------------------------ Transport ------------------------------
+
+    def _semaphore(self):
+        # Kept on the loop itself: a semaphore refers to its loop once waited
+        # on, so a dict keyed by loop would keep every finished loop alive.
+        loop = asyncio.get_running_loop()
+        semaphores = getattr(loop, '_adb_semaphores', None)
+        if semaphores is None:
+            try:
+                semaphores = loop._adb_semaphores = {}
+            except AttributeError:
+                semaphores = self._semaphores.setdefault(loop, {})
+        if self.device not in semaphores:
+            semaphores[self.device] = asyncio.Semaphore(self.device_concurrency)
+        return semaphores[self.device]
+
+    @staticmethod
+    async def _run(*cmd):
+        """Run cmd, return its stdout, raise CalledProcessError on non-zero exit code."""
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE)
+        try:
+            output, _ = await proc.communicate()
+        except asyncio.CancelledError:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+        return output
+
+    @staticmethod
+    async def _connect():
+        port = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+        return await asyncio.open_connection('127.0.0.1', port)
+
+    @staticmethod
+    async def _request(reader, writer, payload):
+        payload = payload.encode('utf-8')
+        writer.write(("%04x" % len(payload)).encode('ascii') + payload)
+        status = await reader.readexactly(4)
+        if status == b"FAIL":
+            length = int(await reader.readexactly(4), 16)
+            raise ADBSocketException(_to_str(await reader.readexactly(length)))
+        if status != b"OKAY":
+            raise ADBSocketException("Unexpected adb server status %r." % status)
+
+    async def _open_service(self, service):
+        reader, writer = await self._connect()
+        try:
+            await self._request(reader, writer, "host:transport:%s" % self.device)
+            await self._request(reader, writer, service)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _socket_shell(self, command):
+        """Run command with the shell v2 service, return (output, exit code)."""
+        reader, writer = await self._open_service("shell,v2,raw:%s" % command)
+        stdout = []
+        try:
+            while True:
+                packet_id, length = struct.unpack("<BI", await reader.readexactly(5))
+                data = await reader.readexactly(length)
+                if packet_id == 1:
+                    stdout.append(data)
+                elif packet_id == 2:
+                    sys.stderr.write(_to_str(data))
+                elif packet_id == 3:
+                    return b"".join(stdout), data[0]
+        except asyncio.IncompleteReadError:
+            raise ADBSocketException("Shell on %s closed without exit code." % self.device)
+        finally:
+            writer.close()
+
+    async def _socket_read_all(self, service):
+        reader, writer = await self._open_service(service)
+        try:
+            return await reader.read()
+        finally:
+            writer.close()
+
+    @classmethod
+    async def list_devices(cls, backend="subprocess"):
+        """List all devices attached."""
+        if backend == "socket":
+            reader, writer = await cls._connect()
+            try:
+                await cls._request(reader, writer, "host:devices")
+                output = _to_str(await reader.readexactly(int(await reader.readexactly(4), 16)))
+            finally:
+                writer.close()
+            return [x.split("\t")[0] for x in output.splitlines() if x.strip()]
+        output = _to_str(await cls._run('adb', 'devices')).strip()
+        return [x.split("\t")[0] for x in output.splitlines()[1:]]
+
+    async def _adb_shell(self, *args):
+        """Execute adb shell command."""
+        command = " ".join(args)
+        async with self._semaphore():
+            if self.backend == "socket":
+                output, returncode = await self._socket_shell(command)
+                if returncode:
+                    raise subprocess.CalledProcessError(returncode, command, output)
+            else:
+                output = await self._run('adb', '-s', self.device, 'shell', *args)
+        return _to_str(output).strip()
+
+    async def exec_out(self, *args):
+        """Execute command at device and return its raw binary output."""
+        async with self._semaphore():
+            if self.backend == "socket":
+                return await self._socket_read_all("exec:%s" % " ".join(args))
+            return await self._run('adb', '-s', self.device, 'exec-out', *args)
+
+    # ------------------------------ Device Info ------------------------------
+
+    async def _get_device_prop(self, prop):
+        if self._properties.ttl > 0 and not self._properties.is_stale(prop):
+            return (await self._get_property_snapshot()).get(prop, "")
+        value = await self._adb_shell('getprop %s' % prop)
+        self._properties.set(prop, value)
+        return value
+
+    async def _get_property_snapshot(self):
+        # One getprop dump even if many getters miss the cache at the same time.
+        async with self._properties_lock:
+            properties = self._properties.get_all()
+            if properties is None:
+                properties = await self.get_device_all_properties()
+            return properties
+
+    async def get_device_all_properties(self):
+        """Get info of device."""
+        properties = ADB._parse_properties(await self._adb_shell('getprop'))
+        self._properties.update(properties)
+        return properties
+
+    async def find_device_property_like(self, regexp):
+        """Find device properties via regexp."""
+        await self._get_property_snapshot()
+        return self._properties.find_like(regexp)
+
+    def invalidate_device_properties(self, *props):
+        """Re-read the given properties on next access, or the whole snapshot if none given."""
+        self._properties.invalidate(*props)
+
+    async def get_app_uid(self, package_name):
+        """Get app's uid, if app is not installed, return None."""
+        index = await self.get_package_index()
+        if package_name not in index:
+            return None
+        if index.uid(package_name) is not None:
+            return str(index.uid(package_name))
+        output = await self._adb_shell('dumpsys package %s | grep userId= || true' % package_name)
+        candidate = ADB.re_uid.findall(output)
+        return candidate[0] if candidate else None
+
+    async def get_app_version_code(self, package_name):
+        """Get versionCode of an installed app as a str, None if unknown or not installed."""
+        version_code = (await self.get_package_index()).version_code(package_name)
+        return str(version_code) if version_code is not None else None
+
+    async def get_focused_app_window_token(self):
+        """Get the focused app package name as well as its activity."""
+        output = await self._adb_shell('dumpsys window windows | grep -E "mCurrentFocus|mFocusedApp"')
+        token = ADB.re_focused_app_window_token.findall(output)
+        return token[0] if token else None
+
+    async def get_current_activity(self):
+        """Alias of method self.get_focused_app_window_token."""
+        return await self.get_focused_app_window_token()
+
+    async def get_pid(self, package_name):
+        """Get app's pid, None if it isn't running."""
+        return (await self.get_process_table()).pid_of(package_name)
+
+    async def get_process_table(self):
+        """Return a ProcessTable of all processes, read fresh like ADB.get_process_table(max_age=0)."""
+        # toybox ps (Android 8.0+) selects columns, older toolbox ps doesn't know -A / -o.
+        if self._ps_columns is not False:
+            output = await self._adb_shell('ps -A -o PID,PPID,UID,RSS,NAME 2>/dev/null || true')
+            table = ProcessTable.parse(output)
+            self._ps_columns = len(table) > 0
+            if self._ps_columns:
+                return table
+        return ProcessTable.parse(await self._adb_shell('ps'))
+
+    # ------------------------------ Package Management ------------------------------
+
+    async def clear_user_data(self, package_name):
+        """Clear application's user data."""
+        try:
+            return await self._adb_shell("pm", "clear", package_name)
+        finally:
+            self.invalidate_package_index()
+
+    async def install_apk(self, apk_path):
+        """Install app using apk specified with apk_path at development machine."""
+        try:
+            async with self._semaphore():
+                return _to_str(await self._run('adb', '-s', self.device, 'install', apk_path))
+        finally:
+            self.invalidate_package_index()
+
+    async def uninstall_apk(self, package_name):
+        """Uninstall app from device."""
+        try:
+            return await self._adb_shell('pm uninstall %s' % package_name)
+        finally:
+            self.invalidate_package_index()
+
+    async def get_package_index(self, max_age=None):
+        """Return the PackageIndex of the device, shared with ADB instances of the device."""
+        index, stale = ADB._cached_package_index(self.device, max_age)
+        if stale:
+            for command in PackageIndex.commands(index):
+                index = PackageIndex.parse(await self._adb_shell(command), command)
+                if len(index):
+                    break
+            ADB._store_package_index(self.device, index)
+        return index
+
+    def invalidate_package_index(self):
+        """Make the next package lookup list the packages again."""
+        ADB._expire_package_index(self.device)
+
+    async def list_packages(self):
+        """List all apps installed at device."""
+        return list((await self.get_package_index()).names)
+
+    async def is_installed(self, package_name):
+        """Check whether or not the app has been installed at device."""
+        return package_name in await self.get_package_index()
+
+    async def launch_app(self, package_name, activity_name):
+        """Launch app."""
+        await self._adb_shell("am", "start", "%s/%s" % (package_name, activity_name))
+
+    async def start_activity(self, activity):
+        await self._adb_shell('am start -n {activity}'.format(activity=activity))
+
+    async def get_screenshot(self, directory=None, filename=None):
+        """Get screenshot, streamed with exec-out so nothing is written at device."""
+        if directory is None:
+            directory = os.getcwd()
+        else:
+            directory = os.path.join(os.getcwd(), directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if filename is None:
+            filename = "%s%02d" % (time.strftime('%y%m%d_%H%M%S'), random.randint(0, 100))
+        if not filename.upper().endswith(".PNG"):
+            filename += ".png"
+        path = os.path.join(directory, filename)
+        data = await self.exec_out('screencap', '-p')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    # ------------------------------ User Action ------------------------------
+
+    async def drag(self, start, end, duration, **kwargs):
+        args = [str(x) for x in start + end + (duration * 1000,)]
+        return await self._adb_shell("input", "swipe", *args)
+
+    async def long_press(self, dx, dy):
+        return await self.drag((dx, dy), (dx, dy), 5)
+
+    async def touch(self, x, y, **kwargs):
+        return await self._adb_shell("input", "tap", str(x), str(y))
+
+    async def type(self, message):
+        """Send text to device, see ADB.type."""
+        output = []
+        for chunk in self._split_for_command_line(message, self._quote_input_text, len("input text ")):
+            output.append(await self._adb_shell("input", "text", self._quote_input_text(chunk)))
+        return "\n".join(output)
+
+    async def _keyevent(self, keycode):
+        await self._adb_shell("input", "keyevent", str(keycode))
+
+    async def send_keys(self, keycodes):
+        """Send a sequence of key codes with as few adb shell calls as possible, see ADB.send_keys."""
+        keycodes = [str(x) for x in keycodes]
+        if self._supports_multiple_keyevents():
+            render = lambda codes: "input keyevent " + " ".join(codes)
+        else:
+            render = lambda codes: "; ".join("input keyevent " + x for x in codes)
+        for chunk in self._split_for_command_line(keycodes, render, 0):
+            await self._adb_shell(render(chunk))
+
+    async def input_text(self, text, wait=3):
+        unknown = [x for x in text if x not in self.keycodes_of_char]
+        if unknown:
+            raise ADBException("No key code for %r." % "".join(unknown))
+        await self.send_keys([self.keycodes_of_char[x] for x in text] + [self.keycodes_of_char['\n']])
+        await asyncio.sleep(wait)
+
+    async def press_back(self):
+        await self.key_back()
+
+    async def press_home(self):
+        await self.key_home()
+
+
+class _Recorder(object):
+    """Stands in for an ADB to learn which key code or property an ADB method uses."""
+
+    def _keyevent(self, keycode):
+        self.argument = keycode
+
+    def _get_device_prop(self, prop):
+        self.argument = prop
+
+
+def _mirror(name, method):
+    recorder = _Recorder()
+    method(recorder)
+    argument = recorder.argument
+    if name.startswith('key_'):
+        async def mirrored(self):
+            await self._keyevent(argument)
+    else:
+        async def mirrored(self):
+            return await self._get_device_prop(argument)
+    mirrored.__name__ = name
+    mirrored.__doc__ = method.__doc__
+    return mirrored
+
+
+# key_* and get_device_* property getters are one-liners in ADB, mirror them all.
+for _name, _method in list(vars(ADB).items()):
+    if _name.startswith('key_') or (_name.startswith('get_device_') and _name != 'get_device_all_properties'):
+        setattr(AsyncADB, _name, _mirror(_name, _method))
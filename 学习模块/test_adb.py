@@ -0,0 +1,638 @@
+# -*- coding: utf-8 -*-
+"""Tests of adb.py on synthetic APKs and on the simulated devices of adb_benchmark."""
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+import adb
+from adb import (ADB, ADBException, ADBInstallException, ADBShellSession, ADBShellSessionException, ADBSocketClient,
+                 ADBSocketException, ADBTimeoutException, ApkInfo,
+                 ApkManifestException, ApkManifestReader, LaunchTiming)
+from adb_benchmark import SimulatedDevices
+
+ANDROID_NS = u'http://schemas.android.com/apk/res/android'
+ATTRIBUTE_IDS = dict((name, res_id) for res_id, name in ApkManifestReader.attribute_ids.items())
+
+# Resource ids of the string type (0x7f package, type 2) in the test table.
+APP_NAME = 0x7f020000
+VERSION_NAME = 0x7f020001
+MAIN_LABEL = 0x7f020002
+MAIN_LABEL_TARGET = 0x7f020003
+
+
+def reference(res_id):
+    return ('reference', res_id)
+
+
+def chunk(chunk_type, header, body):
+    """Return a chunk, header is the part of the header after type, header size and size."""
+    return struct.pack('<HHI', chunk_type, 8 + len(header), 8 + len(header) + len(body)) + header + body
+
+
+def string_pool(strings, utf8=False):
+    offsets = []
+    data = b''
+    for s in strings:
+        offsets.append(len(data))
+        if utf8:
+            encoded = s.encode('utf-8')
+            data += struct.pack('<BB', len(s), len(encoded)) + encoded + b'\0'
+        else:
+            data += struct.pack('<H', len(s)) + s.encode('utf-16-le') + b'\0\0'
+    data += b'\0' * (-len(data) % 4)
+    header = struct.pack('<5I', len(strings), 0, 0x100 if utf8 else 0, 28 + 4 * len(strings), 0)
+    return chunk(ApkManifestReader.CHUNK_STRING_POOL, header,
+                 struct.pack('<%dI' % len(strings), *offsets) + data)
+
+
+def binary_xml(elements, utf8=False):
+    """Return binary XML for elements, a list of (tag, [(name, value)]) and (tag, None) for the end tag.
+
+    Attribute names with an android resource id go first in the string pool, like aapt does.
+    """
+    strings = [name for name in ATTRIBUTE_IDS]
+
+    def index(s):
+        if s not in strings:
+            strings.append(s)
+        return strings.index(s)
+
+    nodes = b''
+    for tag, attributes in elements:
+        if attributes is None:
+            nodes += chunk(ApkManifestReader.CHUNK_XML_END_ELEMENT, struct.pack('<II', 1, 0xffffffff),
+                           struct.pack('<II', 0xffffffff, index(tag)))
+            continue
+        data = b''
+        for name, value in attributes:
+            namespace = index(ANDROID_NS) if name in ATTRIBUTE_IDS else 0xffffffff
+            if isinstance(value, tuple):
+                raw, value_type, value = 0xffffffff, ApkManifestReader.TYPE_REFERENCE, value[1]
+            elif isinstance(value, int):
+                raw, value_type = 0xffffffff, ApkManifestReader.TYPE_INT_DEC
+            else:
+                raw = value = index(value)
+                value_type = ApkManifestReader.TYPE_STRING
+            data += struct.pack('<IIIHBBI', namespace, index(name), raw, 8, 0, value_type, value)
+        element = struct.pack('<IIHHHHHH', 0xffffffff, index(tag), 20, 20, len(attributes), 0, 0, 0)
+        nodes += chunk(ApkManifestReader.CHUNK_XML_START_ELEMENT, struct.pack('<II', 1, 0xffffffff),
+                       element + data)
+    resource_map = struct.pack('<%dI' % len(ATTRIBUTE_IDS), *ATTRIBUTE_IDS.values())
+    body = (string_pool(strings, utf8) +
+            chunk(ApkManifestReader.CHUNK_XML_RESOURCE_MAP, b'', resource_map) + nodes)
+    return chunk(ApkManifestReader.CHUNK_XML, b'', body)
+
+
+def resource_table(configs, utf8=False):
+    """Return resources.arsc with one package 0x7f and type 2.
+
+    configs is a list of (locale, entries, sparse), locale is 4 bytes, all zero
+    for the default configuration, entries maps an entry index to a string
+    or a reference.
+    """
+    strings = []
+    types = b''
+    for locale, entries, sparse in configs:
+        data = b''
+        offsets = {}
+        for index in sorted(entries):
+            offsets[index] = len(data)
+            value = entries[index]
+            if isinstance(value, tuple):
+                value_type, value = ApkManifestReader.TYPE_REFERENCE, value[1]
+            else:
+                strings.append(value)
+                value_type, value = ApkManifestReader.TYPE_STRING, len(strings) - 1
+            data += struct.pack('<HHI', 8, 0, 0) + struct.pack('<HBBI', 8, 0, value_type, value)
+        if sparse:
+            index_data = b''.join(struct.pack('<HH', i, offsets[i] // 4) for i in sorted(offsets))
+            count = len(offsets)
+        else:
+            count = max(entries) + 1
+            index_data = b''.join(struct.pack('<I', offsets.get(i, 0xffffffff)) for i in range(count))
+        config = struct.pack('<I', 28) + b'\0' * 4 + locale + b'\0' * 16
+        flags = ApkManifestReader.TYPE_FLAG_SPARSE if sparse else 0
+        header_size = 20 + len(config)
+        header = struct.pack('<BBHII', 2, flags, 0, count, header_size + len(index_data)) + config
+        types += chunk(ApkManifestReader.CHUNK_TABLE_TYPE, header, index_data + data)
+    package_header = (struct.pack('<I', 0x7f) + u'com.example.app'.encode('utf-16-le').ljust(256, b'\0') +
+                      struct.pack('<5I', 0, 0, 0, 0, 0))
+    package = chunk(ApkManifestReader.CHUNK_TABLE_PACKAGE, package_header, types)
+    return chunk(ApkManifestReader.CHUNK_TABLE, struct.pack('<I', 1), string_pool(strings, utf8) + package)
+
+
+def manifest_elements(version_name=reference(VERSION_NAME)):
+    return [
+        ('manifest', [('package', u'com.example.app'), ('versionCode', 42), ('versionName', version_name)]),
+        ('uses-sdk', [('minSdkVersion', 21)]), ('uses-sdk', None),
+        ('uses-permission', [('name', u'android.permission.INTERNET')]), ('uses-permission', None),
+        ('uses-permission', [('name', u'android.permission.CAMERA')]), ('uses-permission', None),
+        ('application', [('label', reference(APP_NAME))]),
+        ('activity', [('name', u'.Settings')]),
+        ('intent-filter', []),
+        ('action', [('name', u'android.intent.action.VIEW')]), ('action', None),
+        ('intent-filter', None),
+        ('activity', None),
+        ('activity', [('name', u'.MainActivity'), ('label', reference(MAIN_LABEL))]),
+        ('intent-filter', []),
+        ('action', [('name', ApkManifestReader.MAIN_ACTION)]), ('action', None),
+        ('category', [('name', ApkManifestReader.LAUNCHER_CATEGORY)]), ('category', None),
+        ('intent-filter', None),
+        ('activity', None),
+        ('application', None),
+        ('manifest', None),
+    ]
+
+
+def table_configs(sparse=False):
+    # The French configuration comes first, the default one must still win.
+    return [
+        (b'fr\0\0', {0: u'Exemple', 2: u'Appli'}, sparse),
+        (b'\0\0\0\0', {0: u'Example', 1: u'1.2.3', 2: reference(MAIN_LABEL_TARGET), 3: u'Example App'}, sparse),
+    ]
+
+
+EXPECTED = ApkInfo(package_name=u'com.example.app',
+                   version_code=u'42',
+                   version_name=u'1.2.3',
+                   sdk_version=u'21',
+                   launchable_activity=u'com.example.app.MainActivity',
+                   label=u'Example App',
+                   permissions=[u'android.permission.INTERNET', u'android.permission.CAMERA'],
+                   native_code=[u'arm64-v8a', u'armeabi-v7a'])
+
+
+class ApkManifestReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, name, manifest, table=None):
+        path = os.path.join(self.directory, name)
+        with zipfile.ZipFile(path, 'w') as apk:
+            apk.writestr('AndroidManifest.xml', manifest)
+            if table is not None:
+                apk.writestr('resources.arsc', table)
+            apk.writestr('classes.dex', b'dex\n035\0')
+            apk.writestr('lib/arm64-v8a/libexample.so', b'')
+            apk.writestr('lib/armeabi-v7a/libexample.so', b'')
+        return path
+
+    def read(self, path):
+        with ApkManifestReader(path) as reader:
+            return reader.read_info()
+
+    def test_utf16_string_pools(self):
+        path = self.build('utf16.apk', binary_xml(manifest_elements()), resource_table(table_configs()))
+        self.assertEqual(self.read(path), EXPECTED)
+
+    def test_utf8_string_pools(self):
+        path = self.build('utf8.apk', binary_xml(manifest_elements(), utf8=True),
+                          resource_table(table_configs(), utf8=True))
+        self.assertEqual(self.read(path), EXPECTED)
+
+    def test_non_ascii_strings(self):
+        for utf8 in (False, True):
+            configs = [(b'\0\0\0\0', {0: u'Example', 1: u'1.2.3', 2: u'Démo 例'}, False)]
+            path = self.build('non_ascii.apk', binary_xml(manifest_elements(), utf8), resource_table(configs, utf8))
+            self.assertEqual(self.read(path).label, u'Démo 例')
+
+    def test_sparse_type(self):
+        path = self.build('sparse.apk', binary_xml(manifest_elements()), resource_table(table_configs(sparse=True)))
+        self.assertEqual(self.read(path), EXPECTED)
+
+    def test_default_configuration_wins_over_locale(self):
+        configs = [(b'fr\0\0', {1: u'1.2.3-fr', 2: u'Appli'}, False),
+                   (b'\0\0\0\0', {2: u'Example App'}, False)]
+        path = self.build('locale.apk', binary_xml(manifest_elements()), resource_table(configs))
+        info = self.read(path)
+        self.assertEqual(info.label, u'Example App')
+        # Without a default value the localized one is used.
+        self.assertEqual(info.version_name, u'1.2.3-fr')
+
+    def test_unresolved_reference(self):
+        configs = [(b'\0\0\0\0', {0: u'Example', 1: u'1.2.3', 2: reference(0x7f02ffff)}, False)]
+        path = self.build('dangling.apk', binary_xml(manifest_elements()), resource_table(configs))
+        self.assertEqual(self.read(path).label, u'')
+
+    def test_plain_version_name_without_table(self):
+        path = self.build('plain.apk', binary_xml([('manifest', [('package', u'com.example.app'),
+                                                                 ('versionCode', 1),
+                                                                 ('versionName', u'1.0')]),
+                                                   ('manifest', None)]))
+        info = self.read(path)
+        self.assertEqual((info.package_name, info.version_code, info.version_name), (u'com.example.app', u'1', u'1.0'))
+        self.assertEqual((info.launchable_activity, info.label), (None, None))
+
+    def test_not_an_apk(self):
+        path = os.path.join(self.directory, 'broken.apk')
+        with open(path, 'wb') as f:
+            f.write(b'not a zip')
+        self.assertRaises(ApkManifestException, self.read, path)
+
+    def test_text_manifest(self):
+        path = self.build('text.apk', b'<manifest package="com.example.app"/>')
+        self.assertRaises(ApkManifestException, self.read, path)
+
+
+class ApkReaderDifferenceTest(unittest.TestCase):
+    """The aapt path only matches versionName made of digits and dots, the reader returns it as is."""
+
+    badging = ("package: name='com.example.app' versionCode='42' versionName='1.2-beta'\n"
+               "sdkVersion:'21'\n")
+
+    def test_aapt_regex_drops_non_numeric_version_name(self):
+        self.assertIsNone(ADB._parse_badging_apk(self.badging).version_name)
+
+    def test_reader_keeps_non_numeric_version_name(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'beta.apk')
+            with zipfile.ZipFile(path, 'w') as apk:
+                apk.writestr('AndroidManifest.xml', binary_xml(manifest_elements(version_name=u'1.2-beta')))
+                apk.writestr('resources.arsc', resource_table(table_configs()))
+            with ApkManifestReader(path) as reader:
+                self.assertEqual(reader.read_info().version_name, u'1.2-beta')
+        finally:
+            shutil.rmtree(directory)
+
+
+@unittest.skipIf(which('aapt') is None, "aapt is not on PATH")
+class AaptComparisonTest(unittest.TestCase):
+
+    def test_same_info_as_aapt(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for sparse in (False, True):
+                for utf8 in (False, True):
+                    path = os.path.join(directory, 'example.apk')
+                    with zipfile.ZipFile(path, 'w') as apk:
+                        apk.writestr('AndroidManifest.xml', binary_xml(manifest_elements(), utf8))
+                        apk.writestr('resources.arsc', resource_table(table_configs(sparse), utf8))
+                    with ApkManifestReader(path) as reader:
+                        info = reader.read_info()
+                    badging = ADB._parse_badging_apk(ADB._dump_badging_apk(path))
+                    self.assertEqual(info, badging)
+        finally:
+            shutil.rmtree(directory)
+
+
+class RunCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = ADB.command_timeouts, ADB.command_retries, ADB.circuit_breaker_threshold
+        ADB.command_timeouts, ADB.command_retries, ADB.circuit_breaker_threshold = {}, {'shell': 2}, 3
+        self.serial = 'run-command-test'
+        self.calls = []
+
+    def tearDown(self):
+        ADB.command_timeouts, ADB.command_retries, ADB.circuit_breaker_threshold = self.settings
+        ADB._circuit_breakers.pop(self.serial, None)
+
+    def timing_out(self, timeout):
+        self.calls.append(timeout)
+        raise ADBTimeoutException("timed out")
+
+    def test_deadline_is_not_a_device_failure(self):
+        for _ in range(3):
+            with adb.deadline(0.05):
+                self.assertRaises(ADBTimeoutException, adb._run_command, self.serial, ['shell', 'sleep 2'],
+                                  self.timing_out)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(ADB.get_circuit_breaker(self.serial).state, 'closed')
+        self.assertEqual(adb._run_command(self.serial, ['shell', 'echo'], lambda timeout: 'ok'), 'ok')
+
+    def test_passed_deadline_raises_without_running(self):
+        with adb.deadline(0.01):
+            time.sleep(0.02)
+            self.assertRaises(ADBTimeoutException, adb._run_command, self.serial, ['shell', 'echo'],
+                              self.timing_out)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(ADB.get_circuit_breaker(self.serial).failures, 0)
+
+    def test_command_timeouts_are_retried_and_open_the_breaker(self):
+        ADB.command_timeouts = {'shell': 0.01}
+        self.assertRaises(ADBTimeoutException, adb._run_command, self.serial, ['shell', 'sleep 2'],
+                          self.timing_out)
+        self.assertEqual(self.calls, [0.01] * 3)
+        self.assertEqual(ADB.get_circuit_breaker(self.serial).state, 'open')
+
+
+class ShellSessionTest(unittest.TestCase):
+
+    commands = [
+        "echo hello",
+        "cd /; pwd",
+        "pwd",
+        "x=1; echo $x",
+        "echo ${x:-unset}",
+        "echo 'it''s' \"quoted\"",
+        "exit 3",
+        "echo 'abc",
+        "echo )",
+        "cat <<EOF\nline 1\nline 2\nEOF",
+        "false",
+        "printf 'no newline'",
+    ]
+
+    def setUp(self):
+        self.devices = SimulatedDevices(1)
+        self.devices.__enter__()
+        self.serial = self.devices.serials[0]
+        self.session = ADBShellSession(self.serial)
+
+    def tearDown(self):
+        self.session.close()
+        self.devices.__exit__(None, None, None)
+
+    def one_shot(self, command):
+        proc = subprocess.Popen(['adb', '-s', self.serial, 'shell', command],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return proc.communicate()[0], proc.returncode
+
+    def test_same_results_as_one_adb_shell_per_command(self):
+        for command in self.commands:
+            self.assertEqual(self.session.execute(command, timeout=10), self.one_shot(command), command)
+
+    def test_check_output_raises_like_subprocess(self):
+        self.assertEqual(self.session.check_output("echo ok"), "ok\n")
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            self.session.check_output("echo )")
+        self.assertEqual(raised.exception.returncode, 2)
+
+    def test_restart_after_the_shell_died(self):
+        self.assertRaises(ADBShellSessionException, self.session.execute, "kill -9 $$", 10)
+        self.assertEqual(self.session.execute("echo back", timeout=10), (b"back\n", 0))
+        self.session._proc.kill()
+        self.session._proc.wait()
+        self.assertEqual(self.session.execute("echo again", timeout=10), (b"again\n", 0))
+
+    def test_timeout_kills_the_session(self):
+        start = time.time()
+        self.assertRaises(ADBTimeoutException, self.session.execute, "sleep 10", 0.3)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.session.execute("echo after", timeout=10), (b"after\n", 0))
+
+
+class RecordingADB(ADB):
+    """Runs shell commands on the simulated device without adb, keeping them in sent."""
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingADB, self).__init__(*args, **kwargs)
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def _run_shell(self, command, timeout):
+        with self.lock:
+            self.sent.append(command)
+        return subprocess.check_output(['/bin/sh', '-c', 'PATH=$FAKE_DEVICE_BIN:$PATH\n' + command])
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.devices = SimulatedDevices(1)
+        self.devices.__enter__()
+
+    def tearDown(self):
+        self.devices.__exit__(None, None, None)
+
+    def test_batches_of_two_threads_on_one_instance(self):
+        device = RecordingADB(self.devices.serials[0])
+        queued, other_done = threading.Event(), threading.Event()
+
+        def first():
+            with device.batch():
+                device.touch(1, 1)
+                queued.set()
+                other_done.wait(10)
+                device.touch(3, 3)
+
+        def second():
+            queued.wait(10)
+            with device.batch():
+                device.touch(2, 2)
+            other_done.set()
+
+        threads = [threading.Thread(target=first), threading.Thread(target=second)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(len(device.sent), 2)
+        self.assertIn('tap 2 2', device.sent[0])
+        self.assertLess(device.sent[1].index('tap 1 1'), device.sent[1].index('tap 3 3'))
+        self.assertIsNone(device._active_batch())
+
+
+class LaunchTimingTest(unittest.TestCase):
+
+    def test_component_named_error(self):
+        output = ("Starting: Intent { act=android.intent.action.MAIN cmp=com.foo/.ErrorActivity }\n"
+                  "Status: ok\nLaunchState: COLD\nActivity: com.foo/.ErrorActivity\n"
+                  "TotalTime: 512\nWaitTime: 530\nComplete\n")
+        timing = LaunchTiming.parse(output, 'com.foo/.ErrorActivity', 0.6)
+        self.assertEqual((timing.cold, timing.this_time, timing.total_time, timing.wait_time), (True, None, 512, 530))
+
+    def test_am_errors(self):
+        for output in ("Starting: Intent { cmp=com.foo/.Main }\n"
+                       "Error type 3\nError: Activity class {com.foo/com.foo.Main} does not exist.\n",
+                       "Starting: Intent { cmp=com.foo/.Main }\nStatus: timeout\nComplete\n"):
+            self.assertRaises(ADBException, LaunchTiming.parse, output, 'com.foo/.Main', 0.1)
+
+
+class SocketBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.devices = SimulatedDevices(2)
+        self.devices.__enter__()
+        self.directory = tempfile.mkdtemp()
+        self.serial = self.devices.serials[0]
+        self.pool = ADBSocketClient.get_default().pool(self.serial)
+
+    def tearDown(self):
+        self.devices.__exit__(None, None, None)
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_list_devices(self):
+        self.assertEqual(ADBSocketClient.get_default().list_devices(), self.devices.serials)
+
+    def test_shell_v2_exit_codes(self):
+        self.assertEqual(self.pool.shell("echo out; echo err >&2"), (b"out\n", 0))
+        self.assertEqual(self.pool.shell("exit 3"), (b"", 3))
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            self.pool.check_output("echo partial; exit 7")
+        self.assertEqual((raised.exception.returncode, raised.exception.output), (7, b"partial\n"))
+        self.assertTrue(self.pool._shell_v2)
+
+    def test_push_pull_round_trip(self):
+        data = os.urandom(200 * 1024 + 3)
+        with open(self.path('local'), 'wb') as f:
+            f.write(data)
+        self.assertEqual(self.pool.push(self.path('local'), self.path('remote'), mode=0o600), len(data))
+        self.assertEqual(self.pool.pull(self.path('remote'), self.path('pulled')), len(data))
+        with open(self.path('pulled'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+        mode, size, _ = self.pool.stat(self.path('remote'))
+        self.assertEqual((mode & 0o777, size), (0o600, len(data)))
+
+    def test_push_data(self):
+        self.assertEqual(self.pool.push_data(b"gesture script", self.path('script'), mtime=1000000000), 14)
+        with open(self.path('script'), 'rb') as f:
+            self.assertEqual(f.read(), b"gesture script")
+        self.assertEqual(self.pool.stat(self.path('script'))[1:], (14, 1000000000))
+
+    def test_stat_of_missing_file(self):
+        self.assertEqual(self.pool.stat(self.path('missing')), (0, 0, 0))
+
+    def test_pool_reuse_after_error(self):
+        self.pool.push_data(b"x", self.path('file'))
+        self.assertEqual(len(self.pool._idle_sync), 1)
+        idle = self.pool._idle_sync[0]
+        self.assertRaises(ADBSocketException, self.pool.pull, self.path('missing'), self.path('pulled'))
+        # The failed connection is closed, not handed out again.
+        self.assertEqual(self.pool._idle_sync, [])
+        self.assertEqual(idle.sock.fileno(), -1)
+        self.assertEqual(self.pool.pull(self.path('file'), self.path('pulled')), 1)
+        reused = self.pool._idle_sync[0]
+        with self.pool.sync() as conn:
+            self.assertIs(conn, reused)
+        self.assertEqual(self.pool.shell("echo still here"), (b"still here\n", 0))
+
+    def test_adb_on_socket_backend(self):
+        device = ADB(self.serial, backend='socket')
+        self.assertEqual(device.get_device_product_model(), 'Simulated')
+        device._push_data(b"data", self.path('pushed'))
+        device._pull(self.path('pushed'), self.path('pulled'))
+        with open(self.path('pulled'), 'rb') as f:
+            self.assertEqual(f.read(), b"data")
+        self.assertRaises(subprocess.CalledProcessError, device._adb_shell, "exit 2")
+
+
+class ProcessTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.devices = SimulatedDevices(1)
+        self.devices.__enter__()
+        self.serial = self.devices.serials[0]
+
+    def tearDown(self):
+        self.devices.__exit__(None, None, None)
+
+    def test_get_pid_after_process_changing_commands(self):
+        device = RecordingADB(self.serial)
+        self.assertEqual(device.get_pid('com.example.app'), 1)
+        self.assertEqual(device.get_pid('com.example.app'), 1)
+        self.assertEqual(len([x for x in device.sent if 'ps' in x.split()]), 1)
+        for command in ('am force-stop com.example.app', 'pm clear com.example.app', 'kill -0 $$'):
+            device.sent = []
+            device._adb_shell(command)
+            self.assertIsNone(device._process_table, command)
+            device.get_pid('com.example.app')
+            self.assertEqual(len(device.sent), 2, command)
+
+    def test_get_cpu_usage(self):
+        device = RecordingADB(self.serial)
+        usage = device.get_cpu_usage('com.example.app', interval=0.2)
+        self.assertEqual(len(usage), 4)
+        self.assertTrue(0 <= usage[0] <= 100)
+        self.assertTrue(all(x >= 0 for x in usage[1:]))
+        self.assertAlmostEqual(usage[1], usage[2] + usage[3])
+        self.assertFalse([x for x in device.sent if 'dumpsys' in x])
+        self.assertEqual(device.get_cpu_usage('com.example.missing', interval=0)[1:], (0, 0, 0))
+
+    def test_async_get_pid(self):
+        try:
+            import asyncio
+            from async_adb import AsyncADB
+        except (ImportError, SyntaxError):
+            self.skipTest("AsyncADB needs Python 3.7+")
+
+        async def get_pids():
+            device = await AsyncADB.create(self.serial)
+            return await device.get_pid('com.example.app'), await device.get_pid('com.example.missing')
+
+        self.assertEqual(asyncio.run(get_pids()), (1, None))
+
+
+FAILING_PM = r"""#!/bin/sh
+# pm install fails with $FAKE_PM_FAILURE until the app was uninstalled.
+case "$1" in
+    uninstall) touch "$FAKE_PM_STATE"; echo Success;;
+    install) if [ -e "$FAKE_PM_STATE" ]; then echo Success; else echo "Failure [$FAKE_PM_FAILURE: refused]"; fi;;
+    *) echo Success;;
+esac
+"""
+
+
+class InstallPackageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.devices = SimulatedDevices(1)
+        self.devices.__enter__()
+        self.directory = tempfile.mkdtemp()
+        bin_directory = os.path.join(self.directory, 'bin')
+        os.mkdir(bin_directory)
+        with open(os.path.join(bin_directory, 'pm'), 'w') as f:
+            f.write(FAILING_PM)
+        os.chmod(os.path.join(bin_directory, 'pm'), 0o755)
+        os.environ['FAKE_DEVICE_BIN'] = bin_directory + os.pathsep + os.environ['FAKE_DEVICE_BIN']
+        os.environ['FAKE_PM_STATE'] = os.path.join(self.directory, 'uninstalled')
+        self.apk = os.path.join(self.directory, 'app.apk')
+        with zipfile.ZipFile(self.apk, 'w') as apk:
+            apk.writestr('AndroidManifest.xml', binary_xml(manifest_elements(version_name=u'1.0')))
+            apk.writestr('resources.arsc', resource_table(table_configs()))
+        self.device = RecordingADB(self.devices.serials[0], backend='socket')
+        self.device.install_staging_dir = self.directory
+
+    def tearDown(self):
+        self.devices.__exit__(None, None, None)
+        shutil.rmtree(self.directory)
+
+    def install(self, failure, reinstall):
+        os.environ['FAKE_PM_FAILURE'] = failure
+        return self.device.install_package([self.apk], skip_if_current=False, reinstall=reinstall)
+
+    def uninstalled(self):
+        return [x for x in self.device.sent if x.startswith('pm uninstall')]
+
+    def test_reinstall_after_downgrade_or_signature_change(self):
+        for failure in ('INSTALL_FAILED_VERSION_DOWNGRADE', 'INSTALL_FAILED_UPDATE_INCOMPATIBLE'):
+            self.device.sent = []
+            if os.path.exists(os.environ['FAKE_PM_STATE']):
+                os.remove(os.environ['FAKE_PM_STATE'])
+            result = self.install(failure, reinstall=True)
+            self.assertEqual((result.package_name, result.action), (u'com.example.app', 'reinstalled'))
+            self.assertEqual(self.uninstalled(), ['pm uninstall com.example.app || true'])
+
+    def test_failures_reach_the_caller(self):
+        with self.assertRaises(ADBInstallException) as raised:
+            self.install('INSTALL_FAILED_VERSION_DOWNGRADE', reinstall=False)
+        self.assertEqual(raised.exception.reason, 'INSTALL_FAILED_VERSION_DOWNGRADE')
+        with self.assertRaises(ADBInstallException) as raised:
+            self.install('INSTALL_FAILED_INSUFFICIENT_STORAGE', reinstall=True)
+        self.assertEqual(raised.exception.reason, 'INSTALL_FAILED_INSUFFICIENT_STORAGE')
+        self.assertEqual(self.uninstalled(), [])
+        # The staged APK is removed either way.
+        self.assertEqual([x for x in os.listdir(self.directory) if x.endswith('.apk') and x != 'app.apk'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()